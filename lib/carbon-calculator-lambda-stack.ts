@@ -4,6 +4,9 @@ import * as dynamodb from 'aws-cdk-lib/aws-dynamodb';
 import * as s3 from 'aws-cdk-lib/aws-s3';
 import * as ec2 from 'aws-cdk-lib/aws-ec2';
 import * as iam from 'aws-cdk-lib/aws-iam';
+import * as sqs from 'aws-cdk-lib/aws-sqs';
+import * as s3n from 'aws-cdk-lib/aws-s3-notifications';
+import { SqsEventSource } from 'aws-cdk-lib/aws-lambda-event-sources';
 import * as redshift from '@aws-cdk/aws-redshift-alpha';
 import { custom_resources as cr } from 'aws-cdk-lib';
 import { Construct } from 'constructs';
@@ -12,6 +15,7 @@ import emission_factors from './emissions_factor_model_2022-05-22.json';
 
 const DDB_BATCH_WRITE_ITEM_CHUNK_SIZE = 25;
 const REDSHIFT_DB_NAME = "emissions";
+const S3_PREFIXES = ["scope1-cleansed-data", "scope2-bill-extracted-data"];
 
 export class CarbonCalculatorLambdaStack extends Stack {
   public readonly calculatorOutputTable: dynamodb.Table;
@@ -77,7 +81,31 @@ export class CarbonCalculatorLambdaStack extends Stack {
         { name: "co2_amount", dataType: "decimal(32,16)"},
         { name: "co2_unit", dataType: "text"},
         { name: "emissions_factor_amount", dataType: "decimal(32,16)"},
-        { name: "emissions_factor_unit", dataType: "text"}
+        { name: "emissions_factor_unit", dataType: "text"},
+        { name: "co2e_ar4_amount", dataType: "decimal(32,16)"},
+        { name: "co2e_ar6_amount", dataType: "decimal(32,16)"},
+        { name: "emissions_factor_version", dataType: "text"}
+      ]
+    });
+    // Totals of calculated_emissions by scope, category, activity, asset and month, for the reports
+    new redshift.Table(this, 'CarbonCalculatorRedshiftRollupTable', {
+      cluster: this.outputCluster,
+      databaseName: REDSHIFT_DB_NAME,
+      tableName: "calculated_emissions_rollup",
+      tableColumns: [
+        { name: "scope", dataType: "integer"},
+        { name: "category", dataType: "text"},
+        { name: "activity", dataType: "text"},
+        { name: "asset_id", dataType: "text"},
+        { name: "month", dataType: "date"},
+        { name: "events_count", dataType: "bigint"},
+        { name: "raw_data", dataType: "decimal(38,16)"},
+        { name: "co2_amount", dataType: "decimal(38,16)"},
+        { name: "ch4_amount", dataType: "decimal(38,16)"},
+        { name: "n2o_amount", dataType: "decimal(38,16)"},
+        { name: "co2e_amount", dataType: "decimal(38,16)"},
+        { name: "co2e_ar4_amount", dataType: "decimal(38,16)"},
+        { name: "co2e_ar6_amount", dataType: "decimal(38,16)"}
       ]
     });
 
@@ -95,31 +123,94 @@ export class CarbonCalculatorLambdaStack extends Stack {
       billingMode: dynamodb.BillingMode.PAY_PER_REQUEST
     });
 
+    // Processed input objects, so that only new or changed objects are processed
+    const calculatorCheckpointTable = new dynamodb.Table(this, "CarbonCalculatorCheckpointTable", {
+      partitionKey: { name: "object_key", type: dynamodb.AttributeType.STRING },
+      removalPolicy: RemovalPolicy.DESTROY,
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST
+    });
+
+    const calculatorEnvironment = {
+      EMISSIONS_FACTOR_TABLE_NAME: emissionsFactorReferenceTable.tableName,
+      CALCULATOR_OUTPUT_TABLE_NAME: this.calculatorOutputTable.tableName,
+      CALCULATOR_CHECKPOINT_TABLE_NAME: calculatorCheckpointTable.tableName,
+      TRANSFORMED_BUCKET_NAME: this.inputBucket.bucketName,
+      OUTPUT_S3_BUCKET_NAME: outputBucket.bucketName,
+      REDSHIFT_SECRET: this.outputCluster.secret!.secretArn,
+      REDSHIFT_ROLE_ARN: redshiftRole.roleArn
+    };
+    // Processes the byte ranges of the objects larger than BYTE_RANGE_SPLIT_SIZE, invoked by the calculator functions:
+    // it stages them and writes their activity_events to DynamoDB, the calculator functions load them in Redshift.
+    // Its timeout is shorter than the calculator functions': they wait for their workers, then load the parts
+    const byteRangeWorkerFunction = new lambda.Function(this, 'CarbonCalculatorByteRangeLambdaFunction', {
+      runtime: lambda.Runtime.PYTHON_3_9,
+      code: lambda.Code.fromAsset(path.join(__dirname, './lambda')),
+      handler: "full_calculator_lambda.byte_range_handler",
+      timeout: Duration.minutes(10),
+      environment: calculatorEnvironment
+    });
+    emissionsFactorReferenceTable.grantReadData(byteRangeWorkerFunction);
+    this.calculatorOutputTable.grantWriteData(byteRangeWorkerFunction);
+    this.inputBucket.grantRead(byteRangeWorkerFunction);
+    outputBucket.grantWrite(byteRangeWorkerFunction);
+
     this.calculatorFunction = new lambda.Function(this, 'CarbonCalculatorLambdaFunction', {
       runtime: lambda.Runtime.PYTHON_3_9,
       code: lambda.Code.fromAsset(path.join(__dirname, './lambda')),
       handler: "full_calculator_lambda.lambda_handler",
-      timeout: Duration.minutes(5),
-      environment: {
-        EMISSIONS_FACTOR_TABLE_NAME: emissionsFactorReferenceTable.tableName,
-        CALCULATOR_OUTPUT_TABLE_NAME: this.calculatorOutputTable.tableName,
-        TRANSFORMED_BUCKET_NAME: this.inputBucket.bucketName,
-        OUTPUT_S3_BUCKET_NAME: outputBucket.bucketName,
-        REDSHIFT_SECRET: this.outputCluster.secret!.secretArn,
-        REDSHIFT_ROLE_ARN: redshiftRole.roleArn
-      }
+      timeout: Duration.minutes(15),
+      environment: { ...calculatorEnvironment, BYTE_RANGE_WORKER_FUNCTION: byteRangeWorkerFunction.functionName }
     });
+    const calculatorFunctions = [this.calculatorFunction];
 
-    emissionsFactorReferenceTable.grantReadData(this.calculatorFunction);
-    this.calculatorOutputTable.grantWriteData(this.calculatorFunction);
-    this.inputBucket.grantRead(this.calculatorFunction);
-    outputBucket.grantWrite(this.calculatorFunction);
-    this.outputCluster.secret!.grantRead(this.calculatorFunction);
-    this.calculatorFunction.addToRolePolicy(new iam.PolicyStatement({
-      actions: ["redshift-data:ExecuteStatement"],
-      resources: ['arn:aws:redshift:'+this.region+':'+this.account+':cluster:'+this.outputCluster.clusterName],
-      effect: iam.Effect.ALLOW
-    }))
+    // Optional event-driven mode (cdk deploy -c calculatorEventMode=true): objects created under the prefixes
+    // are notified through SQS to a function processing only them
+    if (this.node.tryGetContext('calculatorEventMode')) {
+      const eventsDeadLetterQueue = new sqs.Queue(this, 'CarbonCalculatorEventsDeadLetterQueue', {
+        retentionPeriod: Duration.days(14)
+      });
+      const eventsQueue = new sqs.Queue(this, 'CarbonCalculatorEventsQueue', {
+        // At least 6 times the function timeout
+        visibilityTimeout: Duration.minutes(90),
+        deadLetterQueue: { queue: eventsDeadLetterQueue, maxReceiveCount: 5 }
+      });
+      S3_PREFIXES.forEach(prefix => {
+        this.inputBucket.addEventNotification(s3.EventType.OBJECT_CREATED, new s3n.SqsDestination(eventsQueue), { prefix: prefix });
+      });
+      const calculatorEventFunction = new lambda.Function(this, 'CarbonCalculatorEventLambdaFunction', {
+        runtime: lambda.Runtime.PYTHON_3_9,
+        code: lambda.Code.fromAsset(path.join(__dirname, './lambda')),
+        handler: "full_calculator_lambda.s3_event_handler",
+        timeout: Duration.minutes(15),
+        environment: { ...calculatorEnvironment, BYTE_RANGE_WORKER_FUNCTION: byteRangeWorkerFunction.functionName }
+      });
+      calculatorEventFunction.addEventSource(new SqsEventSource(eventsQueue, {
+        batchSize: 10,
+        reportBatchItemFailures: true
+      }));
+      calculatorFunctions.push(calculatorEventFunction);
+    }
+
+    calculatorFunctions.forEach(calculatorFunction => {
+      emissionsFactorReferenceTable.grantReadData(calculatorFunction);
+      this.calculatorOutputTable.grantWriteData(calculatorFunction);
+      calculatorCheckpointTable.grantReadWriteData(calculatorFunction);
+      this.inputBucket.grantRead(calculatorFunction);
+      outputBucket.grantReadWrite(calculatorFunction);
+      this.outputCluster.secret!.grantRead(calculatorFunction);
+      byteRangeWorkerFunction.grantInvoke(calculatorFunction);
+      calculatorFunction.addToRolePolicy(new iam.PolicyStatement({
+        actions: ["redshift-data:ExecuteStatement", "redshift-data:BatchExecuteStatement"],
+        resources: ['arn:aws:redshift:'+this.region+':'+this.account+':cluster:'+this.outputCluster.clusterName],
+        effect: iam.Effect.ALLOW
+      }))
+      // Statements don't have an ARN, only the statements run by the function itself can be described
+      calculatorFunction.addToRolePolicy(new iam.PolicyStatement({
+        actions: ["redshift-data:DescribeStatement"],
+        resources: ['*'],
+        effect: iam.Effect.ALLOW
+      }))
+    });
 
 
     checkDuplicatedEmissionFactors();
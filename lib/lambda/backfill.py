@@ -0,0 +1,398 @@
+import argparse
+import datetime
+import io
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from urllib.parse import urlparse
+import full_calculator_lambda as calculator
+
+# Recalculates the emissions of historical activity_events outside of Lambda, with the enrichment of
+# full_calculator_lambda: the files of a local directory or S3 prefix are spread over a pool of processes,
+# one file at a time, and each one is written as a shard (same formats as REDSHIFT_STAGING_FORMAT) next to
+# a manifest listing the shards for COPY. Files larger than --split-size are split in line aligned byte ranges,
+# each one processed by a process and written as a shard of its own. Completed files are recorded in a state file: an interrupted backfill
+# is resumed by running the same command again, only the new or changed files are processed.
+# Usage: python backfill.py SOURCE OUTPUT [--format csv] [--workers N] [--split-size BYTES] [--emission-factors SNAPSHOT] [--load]
+# SOURCE and OUTPUT are local directories or s3://bucket/prefix URLs.
+
+LOGGER = logging.getLogger('backfill')
+
+STATE_FILE_NAME = 'backfill-state.jsonl'
+MANIFEST_FILE_NAME = 'manifest.json'
+
+
+def _parse_location(location):
+    # (bucket, prefix) of an s3://bucket/prefix URL, (None, directory) otherwise
+    if location.startswith('s3://'):
+        url = urlparse(location)
+        prefix = url.path.lstrip('/')
+        return url.netloc, prefix if not prefix or prefix.endswith('/') else prefix + '/'
+    return None, location
+
+
+def _location_url(location, relative_path):
+    bucket, prefix = _parse_location(location)
+    if bucket is None:
+        return os.path.join(prefix, relative_path)
+    return "s3://" + bucket + "/" + prefix + relative_path
+
+
+def _list_sources(source):
+    # Relative path, identity and size of each file. The identity is its ETag on S3, its size and modification time on disk.
+    bucket, prefix = _parse_location(source)
+    sources = []
+    if bucket is None:
+        for directory, _, file_names in os.walk(prefix):
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                stat = os.stat(path)
+                sources.append((os.path.relpath(path, prefix), "%s-%s" % (stat.st_size, stat.st_mtime_ns), stat.st_size))
+    else:
+        paginator = calculator._client('s3').get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            sources += [(object['Key'][len(prefix):], object['ETag'], object['Size']) for object in page.get('Contents', [])]
+    return sorted(sources)
+
+
+def _read_range(source, relative_path, start, end, etag=None):
+    # Bytes [start, end) of a file, of the version with etag on S3
+    bucket, prefix = _parse_location(source)
+    if bucket is None:
+        with open(os.path.join(prefix, relative_path), 'rb') as source_file:
+            source_file.seek(start)
+            return source_file.read(end - start)
+    return calculator._client('s3').get_object(Bucket=bucket, Key=prefix + relative_path, Range='bytes=%d-%d' % (start, end - 1), IfMatch=etag)['Body'].read()
+
+
+def _source_parts(source, relative_path, identity, size, split_size):
+    # Byte ranges of a file larger than split_size (as _events_object_parts in the Lambda function), None for the other files
+    if not split_size or size <= split_size:
+        return None
+    etag = identity if source.startswith('s3://') else None
+    byte_ranges = calculator._plan_byte_ranges(size, split_size, lambda start, end: _read_range(source, relative_path, start, end, etag))
+    return [{'number': number, 'start': start, 'end': end, 'etag': etag} for number, (start, end) in enumerate(byte_ranges, 1)]
+
+
+def _read_lines(source, relative_path, part=None):
+    bucket, prefix = _parse_location(source)
+    if bucket is None:
+        with open(os.path.join(prefix, relative_path), 'rb') as source_file:
+            if part is None:
+                for line in source_file:
+                    yield line.rstrip(b'\r\n')
+                return
+            # Byte ranges end with a line
+            source_file.seek(part['start'])
+            remaining = part['end'] - part['start']
+            while remaining > 0:
+                line = source_file.readline(remaining)
+                if not line:
+                    return
+                remaining -= len(line)
+                yield line.rstrip(b'\r\n')
+    else:
+        s3 = calculator._client('s3')
+        if part is None:
+            body = s3.get_object(Bucket=bucket, Key=prefix + relative_path)['Body']
+        else:
+            body = s3.get_object(Bucket=bucket, Key=prefix + relative_path, Range='bytes=%d-%d' % (part['start'], part['end'] - 1), IfMatch=part['etag'])['Body']
+        yield from body.iter_lines(chunk_size=calculator.READ_CHUNK_SIZE)
+
+
+class _LocalStagingWriter(io.RawIOBase):
+    # Same interface as _S3StagingWriter: the file only appears under its name once it is complete
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.partial_path = path + '.partial'
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(self.partial_path, 'wb')
+        self.content_length = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.file.write(data)
+        self.content_length += len(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.file.close()
+        os.replace(self.partial_path, self.path)
+        super().close()
+
+    def abort(self):
+        if self.closed:
+            return
+        self.file.close()
+        os.remove(self.partial_path)
+        super().close()
+
+
+def _open_output(output, relative_path):
+    bucket, prefix = _parse_location(output)
+    if bucket is None:
+        return _LocalStagingWriter(os.path.join(prefix, relative_path))
+    return calculator._S3StagingWriter(bucket, prefix + relative_path)
+
+
+def _shard_path(relative_path, extension):
+    # Same name as the objects staged by the Lambda function
+    return calculator._staged_key(relative_path, extension)
+
+
+def _init_worker(staging_format, emission_factors_path):
+    # The emission factors are loaded once per process, and not reloaded during the backfill.
+    # Forked processes create their own clients rather than sharing the connections of the parent.
+    calculator.clients.clear()
+    calculator.REDSHIFT_STAGING_FORMAT = staging_format
+    calculator.EMISSION_FACTORS_CACHE_TTL_SECONDS = float('inf')
+    if emission_factors_path:
+        calculator.EMISSION_FACTORS_SNAPSHOT_PATH = emission_factors_path
+    calculator._staging_format()
+
+
+def _backfill_source(source, output, relative_path, part=None):
+    # Processes a file, or the byte range of one of its parts
+    extension, _, open_staging = calculator._staging_format()
+    shard_path = _shard_path(calculator._part_key(relative_path, part), extension)
+    staging_writer = _open_output(output, shard_path)
+    dead_letters = calculator._DeadLetters(relative_path, lambda: _open_output(output, dead_letters.key), part)
+    events_count = 0
+    rollup = {}
+    try:
+        staging = open_staging(staging_writer)
+        activity_events = calculator._decode_activity_events(_read_lines(source, relative_path, part), dead_letters)
+        for chunk in calculator._chunks(activity_events, calculator.EVENTS_CHUNK_SIZE):
+            chunk = calculator._append_emissions_batch(chunk, rollup, dead_letters)
+            staging.write_events(chunk)
+            events_count += len(chunk)
+        staging.close()
+        dead_letters.close()
+    except Exception:
+        staging_writer.abort()
+        dead_letters.abort()
+        raise
+    return {
+        'source': relative_path,
+        'shard': shard_path,
+        'content_length': staging_writer.content_length,
+        'events_count': events_count,
+        'rejected_count': dead_letters.count,
+        'emission_factors_version': calculator.emission_factors_cache_state['version'],
+        'rollup': calculator._rollup_to_rows(rollup),
+    }
+
+
+def _combine_parts(relative_path, part_records):
+    # Record of a file split in byte ranges, listing the shards of its parts
+    rollup = {}
+    for part_record in part_records:
+        calculator._merge_rollups(rollup, calculator._rollup_from_rows(part_record['rollup']))
+    return {
+        'source': relative_path,
+        'parts': [{key: part_record[key] for key in ('shard', 'content_length', 'events_count')} for part_record in part_records],
+        'events_count': sum(part_record['events_count'] for part_record in part_records),
+        'rejected_count': sum(part_record['rejected_count'] for part_record in part_records),
+        'emission_factors_version': part_records[0]['emission_factors_version'],
+        'rollup': calculator._rollup_to_rows(rollup),
+    }
+
+
+def _shards(record):
+    # Shards of a completed file with activity_events: its own, or the ones of its parts
+    return [shard for shard in record.get('parts', [record]) if shard['events_count'] > 0]
+
+
+def _read_state(state_path):
+    # Completed files by relative path (the last record wins), and the files already loaded in Redshift
+    completed = {}
+    loaded = set()
+    if not os.path.exists(state_path):
+        return completed, loaded
+    with open(state_path) as state_file:
+        for line in state_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Last line of an interrupted backfill
+                continue
+            if 'load' in record:
+                loaded.update(record['sources'])
+            else:
+                completed[record['source']] = record
+                loaded.discard(record['source'])
+    return completed, loaded
+
+
+def _open_state(state_path):
+    # Records are appended after the truncated last line of an interrupted backfill, if any, rather than to it
+    state_file = open(state_path, 'a+')
+    if state_file.tell() > 0:
+        state_file.seek(state_file.tell() - 1)
+        if state_file.read(1) != "\n":
+            state_file.write("\n")
+    return state_file
+
+
+def _append_state(state_file, record):
+    state_file.write(json.dumps(record) + "\n")
+    state_file.flush()
+    os.fsync(state_file.fileno())
+
+
+def _write_manifest(output, records):
+    # Same manifest as the Lambda function, with the shards of all the completed files
+    manifest = {
+        "entries": [{
+            "url": _location_url(output, shard['shard']),
+            "mandatory": True,
+            "meta": {"content_length": shard['content_length']}
+        } for record in records for shard in _shards(record)]
+    }
+    writer = _open_output(output, MANIFEST_FILE_NAME)
+    writer.write(json.dumps(manifest).encode('utf-8'))
+    writer.close()
+    return _location_url(output, MANIFEST_FILE_NAME)
+
+
+def _load(output, records):
+    # COPY of the shards and merge of their rollups with the Lambda function's load. The backfill recalculates
+    # activity_events that can already be loaded (by the Lambda function, or an earlier backfill of a file changed since):
+    # as for the objects processed again, their rows are replaced and their totals subtracted from the rollup first.
+    # Unlike the Lambda function, the command has no time limit: it waits until the COPY is done, however long it runs.
+    bucket, prefix = _parse_location(output)
+    calculator.OUTPUT_S3_BUCKET_NAME = bucket
+    calculator.REDSHIFT_STATEMENT_TIMEOUT_SECONDS = float('inf')
+    staged_objects = [{
+        'parts': [{'key': prefix + shard['shard'], 'content_length': shard['content_length']} for shard in _shards(record)],
+        'rollup': calculator._rollup_from_rows(record['rollup']),
+        'reprocessed': True,
+    } for record in records if record['events_count'] > 0]
+    manifest_key = prefix + "manifests/backfill-" + time.strftime('%Y-%m-%dT%H-%M-%S', time.gmtime()) + ".manifest"
+    return calculator._copy_staged_events_to_redshift(staged_objects, manifest_key)
+
+
+def _default_workers():
+    # Cores available to this process, which can be fewer than the cores of the machine
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Recalculate the emissions of historical activity_events")
+    parser.add_argument('source', help="directory or s3://bucket/prefix of the activity_events files")
+    parser.add_argument('output', help="directory or s3://bucket/prefix of the shards, dead letters and manifest")
+    parser.add_argument('--format', default='csv', choices=sorted(calculator.STAGING_FORMATS), help="format of the shards")
+    parser.add_argument('--workers', type=int, default=_default_workers(), help="processes enriching the files (default: available cores)")
+    parser.add_argument('--split-size', type=int, default=calculator.BYTE_RANGE_SPLIT_SIZE,
+                        help="files larger than this size in bytes are split in byte ranges processed in parallel, 0 to disable (default: %(default)s)")
+    parser.add_argument('--emission-factors', help="emission factors snapshot, instead of the EMISSIONS_FACTOR_TABLE_NAME table")
+    parser.add_argument('--state', help="state file of the completed files (default: %s in the output directory, or the current one for S3)" % STATE_FILE_NAME)
+    parser.add_argument('--load', action='store_true', help="COPY the shards not loaded yet to Redshift once all the files are completed (S3 output only)")
+    arguments = parser.parse_args(argv)
+    output_bucket, output_directory = _parse_location(arguments.output)
+    if arguments.load and output_bucket is None:
+        parser.error("--load needs an s3:// output")
+    if arguments.state is None:
+        arguments.state = os.path.join(output_directory if output_bucket is None else '.', STATE_FILE_NAME)
+    if arguments.workers < 1:
+        parser.error("--workers must be at least 1")
+    if arguments.split_size < 0:
+        parser.error("--split-size can't be negative")
+    return arguments
+
+
+def main(argv=None):
+    arguments = _parse_arguments(argv)
+    _init_worker(arguments.format, arguments.emission_factors)
+    os.makedirs(os.path.dirname(os.path.abspath(arguments.state)), exist_ok=True)
+    completed, loaded = _read_state(arguments.state)
+    sources = _list_sources(arguments.source)
+    # Files processed again when they changed, or with another format
+    pending = [(relative_path, identity, size) for relative_path, identity, size in sources
+               if relative_path not in completed or completed[relative_path]['identity'] != identity or completed[relative_path]['format'] != arguments.format]
+    LOGGER.info('%s files to process out of %s, with %s processes', len(pending), len(sources), arguments.workers)
+    started_at = time.perf_counter()
+    events_count = 0
+    errors = []
+    executor = ProcessPoolExecutor(max_workers=arguments.workers, initializer=_init_worker, initargs=(arguments.format, arguments.emission_factors))
+    with _open_state(arguments.state) as state_file, executor:
+        futures = {}
+        # Byte ranges of the files split in parts, and the records of the parts completed so far
+        sources_parts = {}
+        part_records = {}
+        for relative_path, identity, size in pending:
+            try:
+                sources_parts[relative_path] = _source_parts(arguments.source, relative_path, identity, size, arguments.split_size)
+            except Exception as error:
+                LOGGER.exception('Failed to split %s', relative_path)
+                errors.append({'source': relative_path, 'error': repr(error)})
+                continue
+            for part in sources_parts[relative_path] or [None]:
+                futures[executor.submit(_backfill_source, arguments.source, arguments.output, relative_path, part)] = (relative_path, identity)
+        try:
+            for future in as_completed(futures):
+                relative_path, identity = futures[future]
+                if relative_path not in sources_parts:
+                    # Another part of the file failed
+                    continue
+                try:
+                    record = future.result()
+                except Exception as error:
+                    LOGGER.exception('Failed to process %s', relative_path)
+                    errors.append({'source': relative_path, 'error': repr(error)})
+                    del sources_parts[relative_path]
+                    continue
+                parts = sources_parts[relative_path]
+                if parts is not None:
+                    # The file is completed with its last part
+                    part_records.setdefault(relative_path, []).append(record)
+                    if len(part_records[relative_path]) < len(parts):
+                        continue
+                    record = _combine_parts(relative_path, sorted(part_records.pop(relative_path), key=lambda part_record: part_record['shard']))
+                record = dict(record, identity=identity, format=arguments.format, completed_at=datetime.datetime.now(datetime.timezone.utc).isoformat())
+                _append_state(state_file, record)
+                completed[relative_path] = record
+                # Loaded again once it changed
+                loaded.discard(relative_path)
+                events_count += record['events_count']
+                seconds = time.perf_counter() - started_at
+                LOGGER.info('%s: %s activity_events, %s rejected (%.0f activity_events/s overall)', relative_path, record['events_count'], record['rejected_count'], events_count / seconds)
+        except KeyboardInterrupt:
+            LOGGER.warning('Interrupted: run the same command again to resume')
+            executor.shutdown(cancel_futures=True)
+            raise
+        source_paths = {relative_path for relative_path, _, _ in sources}
+        records = [completed[relative_path] for relative_path in sorted(completed) if relative_path in source_paths]
+        manifest_url = _write_manifest(arguments.output, records)
+        LOGGER.info('Wrote %s shards of %s activity_events to %s in %.1fs', len(records), sum(record['events_count'] for record in records),
+                    manifest_url, time.perf_counter() - started_at)
+        if errors:
+            LOGGER.error('%s files failed: %s', len(errors), ', '.join(error['source'] for error in errors))
+            return 1
+        if arguments.load:
+            records = [record for record in records if record['source'] not in loaded]
+            if records:
+                # A failed COPY raises. Only a finished COPY is recorded: the sources of any other one are loaded again
+                # by a resumed backfill.
+                load = _load(arguments.output, records)
+                if load['status'] != 'FINISHED':
+                    LOGGER.error('Redshift COPY of %s is %s (statement %s)', load['manifest'], load['status'], load['statement_id'])
+                    return 1
+                _append_state(state_file, {'load': load['statement_id'], 'manifest': load['manifest'], 'sources': [record['source'] for record in records]})
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+    sys.exit(main())
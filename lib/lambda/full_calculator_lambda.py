@@ -1,10 +1,38 @@
 import logging
 import os
+import collections
+import contextlib
+import cProfile
+import csv
+import datetime
+import gzip
+import io
 import json
+import itertools
+import math
+import pstats
+import random
+import re
+import threading
+import time
+import tracemalloc
+import uuid
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from urllib.parse import urlparse
-from decimal import Decimal
+from urllib.parse import urlparse, unquote_plus
+from decimal import Decimal, Context
+
+# Optional dependencies of the compressed and columnar staging formats, only imported when they are used
+# (see _staging_format) since importing pyarrow takes longer than the rest of the cold start
+zstandard = None
+pyarrow = None
+# numpy is not part of the Lambda Python runtime (it can be added with a layer): emissions are then calculated with
+# plain Python. It is imported by the first calculation (see _import_numpy), rather than by every cold start.
+numpy = None
+numpy_missing = False
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
@@ -17,111 +45,994 @@ REDSHIFT_SECRET = os.environ.get('REDSHIFT_SECRET')
 OUTPUT_S3_BUCKET_NAME = os.environ.get('OUTPUT_S3_BUCKET_NAME')
 REDSHIFT_ROLE_ARN = os.environ.get('REDSHIFT_ROLE_ARN')
 OUTPUT_DYNAMODB_TABLE_NAME = os.environ.get('CALCULATOR_OUTPUT_TABLE_NAME')
+# Processed objects and their ETag, only new or changed objects are processed when it is set
+CHECKPOINT_TABLE_NAME = os.environ.get('CALCULATOR_CHECKPOINT_TABLE_NAME')
+
+# Number of activity_events enriched and written to the sinks at once
+EVENTS_CHUNK_SIZE = int(os.environ.get('EVENTS_CHUNK_SIZE', '1000'))
+# Size of the S3 reads when streaming activity_events objects
+READ_CHUNK_SIZE = 64 * 1024
+# S3 multipart uploads need parts of at least 5 MiB (except for the last one)
+MIN_STAGING_PART_SIZE = 5 * 1024 * 1024
+STAGING_PART_SIZE = max(int(os.environ.get('STAGING_PART_SIZE', str(8 * 1024 * 1024))), MIN_STAGING_PART_SIZE)
+# Format of the objects staged for the Redshift COPY, one of STAGING_FORMATS
+REDSHIFT_STAGING_FORMAT = os.environ.get('REDSHIFT_STAGING_FORMAT', 'csv')
+# Number of activity_events objects processed concurrently
+MAX_CONCURRENT_OBJECTS = max(int(os.environ.get('MAX_CONCURRENT_OBJECTS', '4')), 1)
+# Objects larger than BYTE_RANGE_SPLIT_SIZE bytes are split in line aligned byte ranges of about that size, processed
+# in parallel (see _plan_byte_ranges). 0 disables the split.
+BYTE_RANGE_SPLIT_SIZE = max(int(os.environ.get('BYTE_RANGE_SPLIT_SIZE', str(128 * 1024 * 1024))), 0)
+# Bytes read by each ranged GET looking for the end of a line
+BYTE_RANGE_PROBE_SIZE = 64 * 1024
+# Function processing each byte range in its own invocation (byte_range_handler), at most BYTE_RANGE_WORKER_CONCURRENCY
+# at once. Without it, the byte ranges are processed by the threads of the invocation, as objects.
+BYTE_RANGE_WORKER_FUNCTION = os.environ.get('BYTE_RANGE_WORKER_FUNCTION')
+BYTE_RANGE_WORKER_CONCURRENCY = max(int(os.environ.get('BYTE_RANGE_WORKER_CONCURRENCY', '16')), 1)
+# BatchGetItem reads at most 100 items at once
+DDB_BATCH_GET_ITEM_SIZE = 100
+# BatchWriteItem writes at most 25 items at once
+DDB_BATCH_WRITE_ITEM_SIZE = 25
+# Number of BatchWriteItem requests in flight, shared by all the objects processed concurrently
+DYNAMODB_WRITE_CONCURRENCY = max(int(os.environ.get('DYNAMODB_WRITE_CONCURRENCY', '8')), 1)
+# Unprocessed items are retried with an exponential backoff (with jitter) before giving up
+DYNAMODB_WRITE_MAX_ATTEMPTS = 8
+DYNAMODB_WRITE_BASE_BACKOFF_SECONDS = 0.05
+DYNAMODB_WRITE_MAX_BACKOFF_SECONDS = 5
+# Maximum time spent waiting for the Redshift COPY of an invocation, it is reported as pending after that
+REDSHIFT_STATEMENT_TIMEOUT_SECONDS = float(os.environ.get('REDSHIFT_STATEMENT_TIMEOUT_SECONDS', '60'))
+REDSHIFT_STATEMENT_MAX_POLL_INTERVAL_SECONDS = 5
+# Emission factors are loaded once per container and reloaded after this delay
+EMISSION_FACTORS_CACHE_TTL_SECONDS = int(os.environ.get('EMISSION_FACTORS_CACHE_TTL_SECONDS', '900'))
+# Optional emission factors snapshot (same format as lib/emissions_factor_model_2022-05-22.json) used instead of the DynamoDB table
+EMISSION_FACTORS_SNAPSHOT_PATH = os.environ.get('EMISSION_FACTORS_SNAPSHOT_PATH')
+# The Redshift secret is read on the first COPY of a container and read again after this delay
+REDSHIFT_SECRET_CACHE_TTL_SECONDS = int(os.environ.get('REDSHIFT_SECRET_CACHE_TTL_SECONDS', '3600'))
+# Timers and counters of each invocation, logged as CloudWatch Embedded Metric Format (EMF)
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() != 'false'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'CarbonCalculator')
+# 'cprofile' or 'tracemalloc' to log a profile of each invocation
+CALCULATOR_PROFILER = os.environ.get('CALCULATOR_PROFILER', '')
+# activity_events that are invalid or without emissions factor are written under this prefix of the output bucket
+DEAD_LETTERS_PREFIX = 'dead-letters/'
+
+# Shared by the objects processed concurrently, its threads are only started on the first writes
+dynamodb_write_executor = ThreadPoolExecutor(max_workers=DYNAMODB_WRITE_CONCURRENCY)
+
+# Clients, resources and the Redshift secret are created on first use: a cold start only pays for the
+# services the invocation actually calls. boto3 clients are thread safe, but resources are not: each
+# thread gets its own DynamoDB resource. The default session is shared by all threads, so creations are serialized.
+clients = {}
+thread_local = threading.local()
+resources_lock = threading.Lock()
+# Invocations of BYTE_RANGE_WORKER_FUNCTION are synchronous: the response can take up to the 15 minutes of a Lambda timeout.
+# They are not retried: a retry after a read timeout would process the part again while the first invocation still runs.
+CLIENT_OPTIONS = {'lambda': {'config': Config(read_timeout=900, retries={'max_attempts': 0})}}
+
+def _client(service_name):
+    client = clients.get(service_name)
+    if client is None:
+        with resources_lock:
+            client = clients.get(service_name)
+            if client is None:
+                client = clients[service_name] = boto3.client(service_name, **CLIENT_OPTIONS.get(service_name, {}))
+    return client
+
+
+def _dynamodb():
+    dynamodb = getattr(thread_local, 'dynamodb', None)
+    if dynamodb is None:
+        with resources_lock:
+            dynamodb = thread_local.dynamodb = boto3.resource('dynamodb')
+    return dynamodb
+
+
+# Redshift cluster and database names, read from the secret and refreshed after a delay (in case it is rotated)
+redshift_connection_cache = {'connection': None, 'loaded_at': None}
+redshift_connection_lock = threading.Lock()
+
+def _get_redshift_connection():
+    with redshift_connection_lock:
+        loaded_at = redshift_connection_cache['loaded_at']
+        if loaded_at is None or time.monotonic() - loaded_at >= REDSHIFT_SECRET_CACHE_TTL_SECONDS:
+            secret_value = _client('secretsmanager').get_secret_value(SecretId=REDSHIFT_SECRET)
+            secret_json = json.loads(secret_value['SecretString'])
+            redshift_connection_cache['connection'] = (secret_json['dbname'], secret_json['dbClusterIdentifier'])
+            redshift_connection_cache['loaded_at'] = time.monotonic()
+        return redshift_connection_cache['connection']
+
+
+class _Metrics:
+    # Timers (in milliseconds, summed over the threads) and counters of an invocation
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.values = collections.Counter()
+
+    def add(self, name, value):
+        with self.lock:
+            self.values[name] += value
+
+
+metrics = _Metrics()
+# Instrumentation is per chunk or per object, never per event: when disabled, it costs a function call
+NO_TIMER = contextlib.nullcontext()
+
+@contextlib.contextmanager
+def _timer(name):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add(name, (time.perf_counter() - started_at) * 1000)
+
+def _timed(name):
+    return _timer(name) if METRICS_ENABLED else NO_TIMER
+
+def _count(name, value=1):
+    if METRICS_ENABLED:
+        metrics.add(name, value)
+
+
+def _metric_unit(name):
+    if name.endswith('Time'):
+        return 'Milliseconds'
+    if name.endswith('Bytes'):
+        return 'Bytes'
+    if name.endswith('PerSecond'):
+        return 'Count/Second'
+    return 'Count'
+
+
+def _emf_log_line(function_name, values):
+    return json.dumps(dict(values, **{
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['FunctionName']],
+                'Metrics': [{'Name': name, 'Unit': _metric_unit(name)} for name in sorted(values)],
+            }]
+        },
+        'FunctionName': function_name,
+    }))
+
 
-dynamodb = boto3.resource('dynamodb')
-s3 = boto3.resource('s3')
-s3client = boto3.client("s3")
-secretsmanager = boto3.client('secretsmanager')
-redshift = boto3.client('redshift-data')
+# cProfile only profiles the thread it is enabled in: each object is profiled in its own thread,
+# and the profiles are merged at the end of the invocation
+profiles = []
+profiles_lock = threading.Lock()
 
-# Get Redshift cluster and database names
-secret_value = secretsmanager.get_secret_value(SecretId=REDSHIFT_SECRET)
-secret = secret_value['SecretString']
-secret_json = json.loads(secret)
-redshift_db_name = secret_json['dbname']
-redshift_cluster_identifier = secret_json['dbClusterIdentifier']
+def _profiled(function, *args):
+    if CALCULATOR_PROFILER != 'cprofile':
+        return function(*args)
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(function, *args)
+    finally:
+        with profiles_lock:
+            profiles.append(profile)
 
+
+@contextlib.contextmanager
+def _profiling():
+    if CALCULATOR_PROFILER == 'tracemalloc':
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            top_stats = snapshot.statistics('lineno')[:20]
+            LOGGER.info('Peak traced memory: %.1f MiB, top allocations:\n%s', peak / 2**20, '\n'.join(map(str, top_stats)))
+    elif CALCULATOR_PROFILER == 'cprofile':
+        del profiles[:]
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile_output = io.StringIO()
+            pstats.Stats(profile, *profiles, stream=profile_output).sort_stats('cumulative').print_stats(40)
+            LOGGER.info('Profile of the invocation:\n%s', profile_output.getvalue())
+    else:
+        yield
+
+
+@contextlib.contextmanager
+def _instrumented(context):
+    # Resets the metrics of the invocation, and logs them at its end (even when it fails)
+    metrics.reset()
+    started_at = time.perf_counter()
+    try:
+        with _profiling():
+            yield
+    finally:
+        if METRICS_ENABLED:
+            values = dict(metrics.values)
+            values['InvocationTime'] = (time.perf_counter() - started_at) * 1000
+            values['EventsPerSecond'] = values.get('EventsProcessed', 0) / (values['InvocationTime'] / 1000)
+            function_name = getattr(context, 'function_name', None) or os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+            # EMF lines must be printed as is, without the prefix of the Lambda logger
+            print(_emf_log_line(function_name, values), flush=True)
+
+# Emission factors indexed by (category, activity)
 emission_factors_cache = {}
+emission_factors_cache_state = {'version': None, 'loaded_at': None}
+emission_factors_cache_lock = threading.Lock()
+# Numeric coefficients of the cached emission factors, see _get_compiled_emission_factors
+compiled_emission_factors_cache = None
 
 def _list_events_objects_in_s3():
+    # List all the objects under the prefixes, following the pagination
     objects = []
+    paginator = _client('s3').get_paginator('list_objects_v2')
     for prefix in S3_PREFIXES:
-        response = s3client.list_objects_v2(
-            Bucket = INPUT_S3_BUCKET_NAME,
-            Prefix = prefix
-        )
-        if response['KeyCount'] > 0:
-            objects += map(lambda object: object['Key'], response['Contents'])
+        for page in paginator.paginate(Bucket=INPUT_S3_BUCKET_NAME, Prefix=prefix):
+            objects += [{'key': object['Key'], 'etag': object['ETag'], 'size': object['Size']} for object in page.get('Contents', [])]
     return objects
 
-def _read_events_from_s3(object_key):
-    # Read activity_events object
-    obj = s3.Object(INPUT_S3_BUCKET_NAME, object_key)
-    activity_events_string = obj.get()['Body'].read().decode('utf-8')
-    # split into individual activity_events
-    activity_events = [json.loads(jline) for jline in activity_events_string.splitlines()]
-    return activity_events
+class ActivityEvent:
+    # activity_event validated once, when it is read: attributes instead of a dict per event, and the emissions
+    # are kept as floats, the nested emissions_output is only built for the DynamoDB item
+    __slots__ = ('activity_event_id', 'asset_id', 'geo', 'geo_lat', 'geo_lon', 'origin_measurement_timestamp', 'scope', 'category',
+                 'activity', 'source', 'raw_data', 'units', 'other_fields', 'line_number',
+                 'co2', 'ch4', 'n2o', 'co2e', 'emissions_factor', 'co2e_ar4', 'co2e_ar6', 'emissions_factor_version')
 
-def _save_enriched_events_to_redshift(object_key, activity_events):
-    LOGGER.info('Saving %s activity_events in Redshift', len(activity_events))
-    # generate the payload as string
-    csv_body = ""
-    for activity_event in activity_events:
-        csv_body += activity_event['activity_event_id']
-        csv_body +=","+activity_event.get('asset_id','')
-        csv_body +=","+(str(json.loads(activity_event['geo'])[0]) if activity_event.get('geo',None) else '')
-        csv_body +=","+(str(json.loads(activity_event['geo'])[1]) if activity_event.get('geo',None) else '')
-        csv_body +=","+activity_event.get('origin_measurement_timestamp','')
-        csv_body +=","+str(activity_event['scope'])
-        csv_body +=",\""+activity_event['category']+"\""
-        csv_body +=",\""+activity_event['activity']+"\""
-        csv_body +=","+activity_event.get('source','')
-        csv_body +=","+str(activity_event['raw_data'])
-        csv_body +=","+activity_event['units']
-        csv_body +=","+str(activity_event['emissions_output']['calculated_emissions']['co2e']['amount'])
-        csv_body +=","+activity_event['emissions_output']['calculated_emissions']['co2e']['unit']
-        csv_body +=","+str(activity_event['emissions_output']['calculated_emissions']['n2o']['amount'])
-        csv_body +=","+activity_event['emissions_output']['calculated_emissions']['n2o']['unit']
-        csv_body +=","+str(activity_event['emissions_output']['calculated_emissions']['ch4']['amount'])
-        csv_body +=","+activity_event['emissions_output']['calculated_emissions']['ch4']['unit']
-        csv_body +=","+str(activity_event['emissions_output']['calculated_emissions']['co2']['amount'])
-        csv_body +=","+activity_event['emissions_output']['calculated_emissions']['co2']['unit']
-        csv_body +=","+str(activity_event['emissions_output']['emissions_factor']['amount'])
-        csv_body +=","+activity_event['emissions_output']['emissions_factor']['unit']
-        csv_body +="\n"
-    # Write to S3
-    output_object_key = object_key.replace(".json", ".csv")
-    obj = s3.Object(OUTPUT_S3_BUCKET_NAME, output_object_key)
-    obj.put(Body=csv_body)
-    # Copy to Redshift
-    object_url =  "s3://"+OUTPUT_S3_BUCKET_NAME+"/"+output_object_key
-    sql = "COPY calculated_emissions FROM '"+object_url+"' IAM_ROLE '"+REDSHIFT_ROLE_ARN+"' CSV TIMEFORMAT AS 'YYYY-MM-DD HH:MI:SS';"
-    resp = redshift.execute_statement(
+# Same format as the TIMEFORMAT of the CSV COPY
+TIMESTAMP_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\Z')
+
+def _required_text(fields, name):
+    value = fields.pop(name, None)
+    if not isinstance(value, str) or not value:
+        raise ValueError("%s is missing or not a string" % name)
+    return value
+
+def _optional_text(fields, name):
+    value = fields.pop(name, None)
+    if value is not None and not isinstance(value, str):
+        raise ValueError("%s is not a string" % name)
+    return value
+
+def _parse_number(value, name):
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError("%s is missing or not a number" % name)
+    try:
+        number = float(value)
+    except (ValueError, OverflowError):
+        # Integers too large for a float raise OverflowError
+        raise ValueError("%s is not a number: %r" % (name, value))
+    if not math.isfinite(number):
+        raise ValueError("%s is not a finite number: %r" % (name, value))
+    return number
+
+def _parse_geo(geo):
+    # "[latitude, longitude]" in the activity_events
+    coordinates = json.loads(geo) if isinstance(geo, str) else geo
+    if not isinstance(coordinates, list) or len(coordinates) != 2:
+        raise ValueError("geo is not [latitude, longitude]: %r" % (geo,))
+    latitude, longitude = _parse_number(coordinates[0], 'latitude'), _parse_number(coordinates[1], 'longitude')
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("geo is out of range: %r" % (geo,))
+    return latitude, longitude
+
+def _parse_activity_event(fields):
+    # Raises ValueError if a required field is missing or a field is invalid. fields is consumed:
+    # the fields that are not used by the calculator are kept as they are in other_fields.
+    if not isinstance(fields, dict):
+        raise ValueError("activity_event is not a JSON object")
+    activity_event = ActivityEvent()
+    activity_event.activity_event_id = _required_text(fields, 'activity_event_id')
+    scope = fields.pop('scope', None)
+    if isinstance(scope, str) and scope.isdigit():
+        scope = int(scope)
+    if not isinstance(scope, int) or isinstance(scope, bool):
+        raise ValueError("scope is missing or not an integer")
+    activity_event.scope = scope
+    activity_event.category = _required_text(fields, 'category')
+    activity_event.activity = _required_text(fields, 'activity')
+    activity_event.raw_data = _parse_number(fields.pop('raw_data', None), 'raw_data')
+    activity_event.units = _required_text(fields, 'units')
+    activity_event.asset_id = _optional_text(fields, 'asset_id')
+    activity_event.source = _optional_text(fields, 'source')
+    timestamp = _optional_text(fields, 'origin_measurement_timestamp')
+    if timestamp and not TIMESTAMP_PATTERN.match(timestamp):
+        raise ValueError("origin_measurement_timestamp is not YYYY-MM-DD HH:MI:SS: %r" % timestamp)
+    activity_event.origin_measurement_timestamp = timestamp or None
+    geo = fields.pop('geo', None)
+    activity_event.geo = geo or None
+    activity_event.geo_lat, activity_event.geo_lon = _parse_geo(geo) if geo else (None, None)
+    activity_event.other_fields = fields or None
+    activity_event.line_number = None
+    return activity_event
+
+def _decode_activity_event(jline):
+    # ValueError also covers invalid JSON and UTF-8, RecursionError JSON nested too deeply
+    return _parse_activity_event(json.loads(jline))
+
+def _activity_event_fields(activity_event):
+    # Fields of the activity_event as read, without the emissions
+    fields = {
+        'activity_event_id': activity_event.activity_event_id,
+        'scope': activity_event.scope,
+        'category': activity_event.category,
+        'activity': activity_event.activity,
+        'raw_data': activity_event.raw_data,
+        'units': activity_event.units,
+    }
+    for name in ('asset_id', 'geo', 'origin_measurement_timestamp', 'source'):
+        value = getattr(activity_event, name)
+        if value is not None:
+            fields[name] = value
+    if activity_event.other_fields:
+        fields.update(activity_event.other_fields)
+    return fields
+
+class _DeadLetters:
+    # Rejected activity_events of an object, one JSON line each with the reason, so that they don't fail the
+    # other activity_events of the object. The dead letters object is only created for the first one, by open_writer
+    # (an _S3StagingWriter in the output bucket by default).
+
+    def __init__(self, object_key, open_writer=None, part=None):
+        self.object_key = object_key
+        self.part = part
+        self.key = DEAD_LETTERS_PREFIX + _part_key(object_key, part)
+        self.open_writer = open_writer or (lambda: _S3StagingWriter(OUTPUT_S3_BUCKET_NAME, self.key))
+        self.count = 0
+        self.staging_writer = None
+        self.text_stream = None
+
+    def add(self, error, activity_event, line_number=None):
+        # activity_event is the line as read, or the fields of a parsed activity_event
+        if self.text_stream is None:
+            self.staging_writer = self.open_writer()
+            self.text_stream = _open_text_stream(self.staging_writer)
+        if isinstance(activity_event, bytes):
+            activity_event = activity_event.decode('utf-8', errors='replace')
+        dead_letter = {'object_key': self.object_key, 'line_number': line_number, 'error': str(error), 'activity_event': activity_event}
+        if self.part is not None:
+            # Lines are numbered from the start of the byte range
+            dead_letter['byte_range'] = [self.part['start'], self.part['end']]
+        self.text_stream.write(json.dumps(dead_letter) + "\n")
+        self.count += 1
+
+    def close(self):
+        if self.text_stream is not None:
+            self.text_stream.close()
+
+    def abort(self):
+        if self.staging_writer is not None:
+            self.staging_writer.abort()
+
+def _decode_activity_events(jlines, dead_letters):
+    for line_number, jline in enumerate(jlines, 1):
+        if not jline.strip():
+            continue
+        try:
+            activity_event = _decode_activity_event(jline)
+        except (ValueError, RecursionError) as error:
+            dead_letters.add(error, jline, line_number)
+            continue
+        # Kept for the activity_events rejected later, without emissions factor
+        activity_event.line_number = line_number
+        yield activity_event
+
+def _read_events_from_s3(object_key, dead_letters, part=None):
+    # Stream activity_events object (or the byte range of a part) line by line, so that it is never fully loaded in memory
+    if part is None:
+        body = _client('s3').get_object(Bucket=INPUT_S3_BUCKET_NAME, Key=object_key)['Body']
+    else:
+        body = _get_byte_range(object_key, part['etag'], part['start'], part['end'])
+    return _decode_activity_events(body.iter_lines(chunk_size=READ_CHUNK_SIZE), dead_letters)
+
+def _get_byte_range(object_key, etag, start, end):
+    # Body of the bytes [start, end) of the version of the object with etag: the parts of an object overwritten
+    # while it is processed fail (PreconditionFailed), rather than mixing the lines of two versions
+    return _client('s3').get_object(Bucket=INPUT_S3_BUCKET_NAME, Key=object_key, Range='bytes=%d-%d' % (start, end - 1), IfMatch=etag)['Body']
+
+def _line_end(position, size, read_range):
+    # Offset following the first newline at or after position (or size), reading BYTE_RANGE_PROBE_SIZE bytes at a time
+    while position < size:
+        data = read_range(position, min(position + BYTE_RANGE_PROBE_SIZE, size))
+        if not data:
+            break
+        newline = data.find(b'\n')
+        if newline >= 0:
+            return position + newline + 1
+        position += len(data)
+    return size
+
+def _plan_byte_ranges(size, split_size, read_range):
+    # [start, end) ranges of about split_size bytes covering an object of size bytes, ending with a line: each boundary
+    # is moved to the end of the line it falls in, found by a few small reads (read_range(start, end) returns the bytes)
+    byte_ranges = []
+    start = 0
+    while start < size:
+        end = _line_end(start + split_size - 1, size, read_range) if start + split_size < size else size
+        byte_ranges.append((start, end))
+        start = end
+    return byte_ranges
+
+def _part_key(key, part):
+    # Objects written for a byte range are named after its number: events.json -> events.json.part-00002
+    if part is None:
+        return key
+    return key + ".part-%05d" % part['number']
+
+def _staged_key(key, extension):
+    # Staged object of an activity_events object: events.json -> events.json.csv. The extension is appended to the whole
+    # key, so that events.json, events.ndjson and events are staged in objects of their own.
+    return key + extension
+
+def _events_object_parts(events_object):
+    # Byte ranges of an object larger than BYTE_RANGE_SPLIT_SIZE, planned with ranged GETs. None for the other objects,
+    # processed in one piece.
+    size = events_object.get('size')
+    if not BYTE_RANGE_SPLIT_SIZE or size is None or size <= BYTE_RANGE_SPLIT_SIZE:
+        return None
+    object_key, etag = events_object['key'], events_object['etag']
+    with _timed('ByteRangePlanTime'):
+        byte_ranges = _plan_byte_ranges(size, BYTE_RANGE_SPLIT_SIZE, lambda start, end: _get_byte_range(object_key, etag, start, end).read())
+    LOGGER.info('Split %s (%s bytes) in %s byte ranges', object_key, size, len(byte_ranges))
+    _count('ByteRanges', len(byte_ranges))
+    return [{'number': number, 'start': start, 'end': end, 'etag': etag} for number, (start, end) in enumerate(byte_ranges, 1)]
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+class _S3StagingWriter(io.RawIOBase):
+    # Binary stream uploading an object part by part (S3 multipart upload), so that at most one part is held in memory.
+    # Objects smaller than one part are uploaded with a single put_object. The upload is completed by close().
+
+    def __init__(self, bucket, key):
+        super().__init__()
+        self.bucket = bucket
+        self.key = key
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.content_length = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.content_length += len(data)
+        if len(self.buffer) >= STAGING_PART_SIZE:
+            self._upload_part()
+        return len(data)
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = _client('s3').create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        part_number = len(self.parts) + 1
+        response = _client('s3').upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.buffer)
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.upload_id is None:
+            _client('s3').put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+        else:
+            if self.buffer:
+                self._upload_part()
+            _client('s3').complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts}
+            )
+        self.buffer = bytearray()
+        super().close()
+
+    def abort(self):
+        if self.closed:
+            return
+        if self.upload_id is not None:
+            _client('s3').abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.buffer = bytearray()
+        super().close()
+
+def _open_text_stream(binary_stream):
+    return io.TextIOWrapper(io.BufferedWriter(binary_stream, buffer_size=READ_CHUNK_SIZE), encoding='utf-8', newline='')
+
+# Columns of the calculated_emissions table (see carbon-calculator-lambda-stack.ts), in order
+REDSHIFT_COLUMNS = [
+    ("activity_event_id", "text"),
+    ("asset_id", "text"),
+    ("geo_lat", "decimal(10,6)"),
+    ("geo_lon", "decimal(10,6)"),
+    ("origin_measurement_timestamp", "timestamptz"),
+    ("scope", "integer"),
+    ("category", "text"),
+    ("activity", "text"),
+    ("source", "text"),
+    ("raw_data", "decimal(32,16)"),
+    ("units", "text"),
+    ("co2e_amount", "decimal(32,16)"),
+    ("co2e_unit", "text"),
+    ("n2o_amount", "decimal(32,16)"),
+    ("n2o_unit", "text"),
+    ("ch4_amount", "decimal(32,16)"),
+    ("ch4_unit", "text"),
+    ("co2_amount", "decimal(32,16)"),
+    ("co2_unit", "text"),
+    ("emissions_factor_amount", "decimal(32,16)"),
+    ("emissions_factor_unit", "text"),
+    ("co2e_ar4_amount", "decimal(32,16)"),
+    ("co2e_ar6_amount", "decimal(32,16)"),
+    ("emissions_factor_version", "text"),
+]
+REDSHIFT_COLUMN_NAMES = [name for name, _ in REDSHIFT_COLUMNS]
+
+# Columns of the calculated_emissions_rollup table (see carbon-calculator-lambda-stack.ts): totals of the
+# activity_events by key, merged additively into the table with each COPY of calculated_emissions
+ROLLUP_KEY_COLUMNS = [
+    ("scope", "integer"),
+    ("category", "text"),
+    ("activity", "text"),
+    ("asset_id", "text"),
+    ("month", "date"),
+]
+ROLLUP_VALUE_COLUMNS = [
+    ("events_count", "bigint"),
+    ("raw_data", "decimal(38,16)"),
+    ("co2_amount", "decimal(38,16)"),
+    ("ch4_amount", "decimal(38,16)"),
+    ("n2o_amount", "decimal(38,16)"),
+    ("co2e_amount", "decimal(38,16)"),
+    ("co2e_ar4_amount", "decimal(38,16)"),
+    ("co2e_ar6_amount", "decimal(38,16)"),
+]
+ROLLUP_COLUMNS = ROLLUP_KEY_COLUMNS + ROLLUP_VALUE_COLUMNS
+
+def _rollup_key(activity_event):
+    # The month is the first day of the month of origin_measurement_timestamp ('YYYY-MM-DD HH:MI:SS'). A missing asset_id
+    # or month is written as an empty field, loaded as NULL (EMPTYASNULL) like in calculated_emissions
+    timestamp = activity_event.origin_measurement_timestamp
+    return (activity_event.scope, activity_event.category, activity_event.activity,
+            activity_event.asset_id or '', timestamp[:7] + '-01' if timestamp else '')
+
+def _merge_rollups(rollup, other_rollup):
+    for key, totals in other_rollup.items():
+        merged_totals = rollup.get(key)
+        if merged_totals is None:
+            rollup[key] = list(totals)
+        else:
+            for index, total in enumerate(totals):
+                merged_totals[index] += total
+    return rollup
+
+def _rollup_to_rows(rollup):
+    # JSON serializable rows of a rollup: key then totals
+    return [list(key) + list(totals) for key, totals in rollup.items()]
+
+def _rollup_from_rows(rows):
+    return {tuple(row[:len(ROLLUP_KEY_COLUMNS)]): row[len(ROLLUP_KEY_COLUMNS):] for row in rows}
+
+def _rollup_to_csv(rollup):
+    csv_body = io.StringIO()
+    writer = csv.writer(csv_body, lineterminator='\n')
+    for key, totals in rollup.items():
+        writer.writerow(key + tuple(totals))
+    return csv_body.getvalue()
+
+def _redshift_row(activity_event):
+    # Values of an enriched activity_event, in the order of REDSHIFT_COLUMNS: a tuple is built directly, rather than a
+    # dict by column name, since it is built for every activity_event
+    return (
+        activity_event.activity_event_id,
+        activity_event.asset_id or '',
+        activity_event.geo_lat if activity_event.geo_lat is not None else '',
+        activity_event.geo_lon if activity_event.geo_lon is not None else '',
+        activity_event.origin_measurement_timestamp or '',
+        activity_event.scope,
+        activity_event.category,
+        activity_event.activity,
+        activity_event.source or '',
+        activity_event.raw_data,
+        activity_event.units,
+        activity_event.co2e,
+        "tonnes",
+        activity_event.n2o,
+        "tonnes",
+        activity_event.ch4,
+        "tonnes",
+        activity_event.co2,
+        "tonnes",
+        activity_event.emissions_factor,
+        "kgCO2e/unit",
+        activity_event.co2e_ar4,
+        activity_event.co2e_ar6,
+        activity_event.emissions_factor_version or '',
+    )
+
+def _write_events_csv(text_stream, activity_events):
+    # The csv module quotes and escapes every field that needs it
+    writer = csv.writer(text_stream, lineterminator='\n')
+    writer.writerows(map(_redshift_row, activity_events))
+
+def _parse_data_type(data_type):
+    # 'decimal(32,16)' -> ('decimal', 32, 16)
+    name, _, parameters = data_type.partition('(')
+    return (name,) + tuple(int(parameter) for parameter in parameters.rstrip(')').split(',') if parameter)
+
+def _arrow_type(data_type):
+    name, *parameters = _parse_data_type(data_type)
+    if name == 'decimal':
+        return pyarrow.decimal128(*parameters)
+    return {
+        'text': pyarrow.string(),
+        'integer': pyarrow.int32(),
+        'timestamptz': pyarrow.timestamp('us', tz='UTC'),
+    }[name]
+
+# Wide enough for decimal(32,16) values
+DECIMAL_CONTEXT = Context(prec=38)
+
+def _to_decimal(value, scale):
+    value = DECIMAL_CONTEXT.create_decimal(repr(value) if isinstance(value, float) else str(value))
+    return value.quantize(Decimal(1).scaleb(-scale), context=DECIMAL_CONTEXT)
+
+def _to_timestamp(value):
+    # Same format as the TIMEFORMAT of the CSV COPY, in UTC
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S').replace(tzinfo=datetime.timezone.utc)
+
+def _arrow_column(data_type, values):
+    name, *parameters = _parse_data_type(data_type)
+    convert = {
+        'decimal': lambda value: _to_decimal(value, parameters[1]),
+        'timestamptz': _to_timestamp,
+        'integer': int,
+        'text': str,
+    }[name]
+    return pyarrow.array([None if value is None or value == '' else convert(value) for value in values], type=_arrow_type(data_type))
+
+def _events_to_arrow_table(activity_events):
+    rows = [_redshift_row(activity_event) for activity_event in activity_events]
+    return pyarrow.table([_arrow_column(data_type, [row[index] for row in rows]) for index, (_, data_type) in enumerate(REDSHIFT_COLUMNS)], schema=_arrow_schema())
+
+def _arrow_schema():
+    return pyarrow.schema([(name, _arrow_type(data_type)) for name, data_type in REDSHIFT_COLUMNS])
+
+
+class _CsvStaging:
+    def __init__(self, staging_writer, compression):
+        self.staging_writer = staging_writer
+        if compression == 'gzip':
+            binary_stream = gzip.GzipFile(fileobj=staging_writer, mode='wb')
+        elif compression == 'zstd':
+            binary_stream = zstandard.ZstdCompressor().stream_writer(staging_writer, closefd=False)
+        else:
+            binary_stream = staging_writer
+        self.text_stream = _open_text_stream(binary_stream)
+
+    def write_events(self, activity_events):
+        _write_events_csv(self.text_stream, activity_events)
+
+    def close(self):
+        # Compressed streams do not close the staging writer
+        self.text_stream.close()
+        self.staging_writer.close()
+
+
+class _ParquetStaging:
+    def __init__(self, staging_writer):
+        self.staging_writer = staging_writer
+        self.parquet_writer = pyarrow.parquet.ParquetWriter(staging_writer, _arrow_schema())
+
+    def write_events(self, activity_events):
+        # One row group per chunk
+        self.parquet_writer.write_table(_events_to_arrow_table(activity_events))
+
+    def close(self):
+        self.parquet_writer.close()
+        self.staging_writer.close()
+
+
+# Staging formats: object extension, COPY options, and how the objects are written
+STAGING_FORMATS = {
+    # Empty fields are loaded as NULL, as the missing values of the Parquet staging and of the rollups
+    'csv': ('.csv', "CSV EMPTYASNULL TIMEFORMAT AS 'YYYY-MM-DD HH:MI:SS'", lambda staging_writer: _CsvStaging(staging_writer, None)),
+    'csv.gz': ('.csv.gz', "CSV GZIP EMPTYASNULL TIMEFORMAT AS 'YYYY-MM-DD HH:MI:SS'", lambda staging_writer: _CsvStaging(staging_writer, 'gzip')),
+    'csv.zst': ('.csv.zst', "CSV ZSTD EMPTYASNULL TIMEFORMAT AS 'YYYY-MM-DD HH:MI:SS'", lambda staging_writer: _CsvStaging(staging_writer, 'zstd')),
+    'parquet': ('.parquet', "FORMAT AS PARQUET", _ParquetStaging),
+}
+
+def _staging_format():
+    if REDSHIFT_STAGING_FORMAT not in STAGING_FORMATS:
+        raise ValueError("Unknown REDSHIFT_STAGING_FORMAT '%s', expected one of %s" % (REDSHIFT_STAGING_FORMAT, ', '.join(STAGING_FORMATS)))
+    if REDSHIFT_STAGING_FORMAT == 'csv.zst' and not _import_zstandard():
+        raise ValueError("REDSHIFT_STAGING_FORMAT 'csv.zst' needs the zstandard package")
+    if REDSHIFT_STAGING_FORMAT == 'parquet' and not _import_pyarrow():
+        raise ValueError("REDSHIFT_STAGING_FORMAT 'parquet' needs the pyarrow package")
+    return STAGING_FORMATS[REDSHIFT_STAGING_FORMAT]
+
+
+def _import_zstandard():
+    global zstandard
+    if zstandard is None:
+        try:
+            import zstandard
+        except ImportError:
+            return False
+    return True
+
+
+def _import_pyarrow():
+    global pyarrow
+    if pyarrow is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            return False
+    return True
+
+def _open_redshift_staging(output_object_key):
+    _, _, open_staging = _staging_format()
+    staging_writer = _S3StagingWriter(OUTPUT_S3_BUCKET_NAME, output_object_key)
+    try:
+        return staging_writer, open_staging(staging_writer)
+    except Exception:
+        staging_writer.abort()
+        raise
+
+def _save_enriched_events_to_redshift(staging, activity_events):
+    # Append to the object that will be copied to Redshift
+    staging.write_events(activity_events)
+
+def _write_manifest(staged_objects, manifest_key):
+    # Redshift manifest listing the staged objects (or their parts), content_length is required for Parquet
+    manifest = {
+        "entries": [{
+            "url": "s3://"+OUTPUT_S3_BUCKET_NAME+"/"+staged_part['key'],
+            "mandatory": True,
+            "meta": {"content_length": staged_part['content_length']}
+        } for staged_object in staged_objects for staged_part in staged_object.get('parts', [staged_object])]
+    }
+    _client('s3').put_object(Bucket=OUTPUT_S3_BUCKET_NAME, Key=manifest_key, Body=json.dumps(manifest).encode('utf-8'))
+    return "s3://"+OUTPUT_S3_BUCKET_NAME+"/"+manifest_key
+
+def _wait_for_statement(statement_id):
+    # Poll the statement status with an increasing interval, until it is done or REDSHIFT_STATEMENT_TIMEOUT_SECONDS is reached
+    deadline = time.monotonic() + REDSHIFT_STATEMENT_TIMEOUT_SECONDS
+    interval = 0.5
+    while True:
+        statement = _client('redshift-data').describe_statement(Id=statement_id)
+        if statement['Status'] in ('FINISHED', 'FAILED', 'ABORTED'):
+            return statement
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return statement
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, REDSHIFT_STATEMENT_MAX_POLL_INTERVAL_SECONDS)
+
+def _rollup_match(table, other_table):
+    # Rollup keys can be NULL (no asset_id or month)
+    return " AND ".join("("+table+"."+name+" = "+other_table+"."+name+" OR ("+table+"."+name+" IS NULL AND "+other_table+"."+name+" IS NULL))" for name, _ in ROLLUP_KEY_COLUMNS)
+
+def _merge_rollup_sqls(rollup_url):
+    # Adds the totals of the rollup object to calculated_emissions_rollup: existing keys are updated, new keys inserted
+    return [
+        "CREATE TEMP TABLE calculated_emissions_rollup_staging (LIKE calculated_emissions_rollup);",
+        "COPY calculated_emissions_rollup_staging FROM '"+rollup_url+"' IAM_ROLE '"+REDSHIFT_ROLE_ARN+"' CSV EMPTYASNULL DATEFORMAT 'YYYY-MM-DD';",
+        "UPDATE calculated_emissions_rollup SET "+", ".join(name+" = calculated_emissions_rollup."+name+" + s."+name for name, _ in ROLLUP_VALUE_COLUMNS)
+        + " FROM calculated_emissions_rollup_staging s WHERE "+_rollup_match("calculated_emissions_rollup", "s")+";",
+        "INSERT INTO calculated_emissions_rollup SELECT s.* FROM calculated_emissions_rollup_staging s"
+        + " LEFT JOIN calculated_emissions_rollup r ON "+_rollup_match("r", "s")+" WHERE r.scope IS NULL;",
+    ]
+
+def _rollup_totals_query(condition):
+    # Totals of the rows of calculated_emissions matching the condition, in the order of ROLLUP_COLUMNS
+    return ("SELECT scope, category, activity, asset_id, DATE_TRUNC('month', origin_measurement_timestamp) AS month, COUNT(*) AS events_count, "
+            + ", ".join("COALESCE(SUM("+name+"), 0) AS "+name for name, _ in ROLLUP_VALUE_COLUMNS[1:])
+            + " FROM calculated_emissions WHERE "+condition+" GROUP BY 1, 2, 3, 4, 5")
+
+def _replace_events_sqls(manifest_url, copy_options):
+    # Loads of objects processed again replace the rows with the same activity_event_id (delete, then insert): the totals
+    # of the replaced rows are subtracted from calculated_emissions_rollup first, the new ones are merged afterwards
+    replaced_rollup = _rollup_totals_query("activity_event_id IN (SELECT activity_event_id FROM calculated_emissions_staging)")
+    return [
+        "CREATE TEMP TABLE calculated_emissions_staging (LIKE calculated_emissions);",
+        "COPY calculated_emissions_staging FROM '"+manifest_url+"' IAM_ROLE '"+REDSHIFT_ROLE_ARN+"' "+copy_options+" MANIFEST;",
+        "UPDATE calculated_emissions_rollup SET "+", ".join(name+" = calculated_emissions_rollup."+name+" - r."+name for name, _ in ROLLUP_VALUE_COLUMNS)
+        + " FROM ("+replaced_rollup+") r WHERE "+_rollup_match("calculated_emissions_rollup", "r")+";",
+        "DELETE FROM calculated_emissions WHERE activity_event_id IN (SELECT activity_event_id FROM calculated_emissions_staging);",
+        "INSERT INTO calculated_emissions SELECT * FROM calculated_emissions_staging;",
+    ]
+
+# Text columns of calculated_emissions that the CSV COPY statements loaded as empty strings before they used EMPTYASNULL
+EMPTY_TEXT_COLUMNS = ["asset_id", "source", "emissions_factor_version"]
+
+def _rebuild_rollup_sqls():
+    # One-off migration (rebuild_rollup.py): the empty strings of the rows loaded before EMPTYASNULL are set to NULL, then
+    # calculated_emissions_rollup is rebuilt from all the rows of calculated_emissions, including those loaded before it existed
+    return ["UPDATE calculated_emissions SET "+name+" = NULL WHERE "+name+" = '';" for name in EMPTY_TEXT_COLUMNS] + [
+        "DELETE FROM calculated_emissions_rollup;",
+        "INSERT INTO calculated_emissions_rollup "+_rollup_totals_query("TRUE")+";",
+    ]
+
+def _copy_staged_events_to_redshift(staged_objects, manifest_key):
+    # A single COPY for all the objects staged by an invocation, in the same transaction as the merge of their
+    # rollups: the totals of calculated_emissions_rollup are only updated with the COPY of the events
+    _, copy_options, _ = _staging_format()
+    manifest_url = _write_manifest(staged_objects, manifest_key)
+    rollup = {}
+    for staged_object in staged_objects:
+        _merge_rollups(rollup, staged_object['rollup'])
+    rollup_key = manifest_key.replace("manifests/", "rollups/", 1).replace(".manifest", ".csv")
+    _client('s3').put_object(Bucket=OUTPUT_S3_BUCKET_NAME, Key=rollup_key, Body=_rollup_to_csv(rollup).encode('utf-8'))
+    if any(staged_object.get('reprocessed') for staged_object in staged_objects):
+        sqls = _replace_events_sqls(manifest_url, copy_options) + _merge_rollup_sqls("s3://"+OUTPUT_S3_BUCKET_NAME+"/"+rollup_key)
+        sqls.append("DELETE FROM calculated_emissions_rollup WHERE events_count = 0;")
+    else:
+        sqls = ["COPY calculated_emissions FROM '"+manifest_url+"' IAM_ROLE '"+REDSHIFT_ROLE_ARN+"' "+copy_options+" MANIFEST;"]
+        sqls += _merge_rollup_sqls("s3://"+OUTPUT_S3_BUCKET_NAME+"/"+rollup_key)
+    redshift_db_name, redshift_cluster_identifier = _get_redshift_connection()
+    # The statements of a batch run in a single transaction
+    resp = _client('redshift-data').batch_execute_statement(
         Database=redshift_db_name,
         SecretArn=REDSHIFT_SECRET,
         ClusterIdentifier=redshift_cluster_identifier,
-        Sql=sql
+        Sqls=sqls
     )
+    statement = _wait_for_statement(resp['Id'])
+    load = {'statement_id': resp['Id'], 'status': statement['Status'], 'manifest': manifest_url, 'rollup_rows': len(rollup)}
+    if statement['Status'] == 'FINISHED':
+        LOGGER.info('Loaded %s staged objects and %s rollup rows in Redshift (statement %s)', len(staged_objects), len(rollup), resp['Id'])
+    elif statement['Status'] in ('FAILED', 'ABORTED'):
+        raise RuntimeError("Redshift COPY of %s %s: %s" % (manifest_url, statement['Status'].lower(), statement.get('Error', '')))
+    else:
+        LOGGER.warning('Redshift COPY of %s is still %s (statement %s)', manifest_url, statement['Status'], resp['Id'])
+    return load
+
+
+def _to_attribute_value(value):
+    # Floats are written as decimal numbers, with the same digits as json.dumps (repr)
+    if isinstance(value, str):
+        return {'S': value}
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    if isinstance(value, float):
+        return {'N': repr(value)}
+    if isinstance(value, (int, Decimal)):
+        return {'N': str(value)}
+    if isinstance(value, dict):
+        return {'M': {name: _to_attribute_value(item) for name, item in value.items()}}
+    if isinstance(value, (list, tuple)):
+        return {'L': [_to_attribute_value(item) for item in value]}
+    if value is None:
+        return {'NULL': True}
+    raise TypeError("Unsupported type %s for DynamoDB" % type(value).__name__)
+
+
+def _dynamodb_item_fields(activity_event):
+    # Fields of the activity_event as read, with its emissions_output
+    fields = _activity_event_fields(activity_event)
+    fields['emissions_output'] = _emissions_output(activity_event.co2, activity_event.ch4, activity_event.n2o, activity_event.co2e,
+                                                   activity_event.emissions_factor, activity_event.co2e_ar4, activity_event.co2e_ar6)
+    fields['emissions_output']['emissions_factor']['version'] = activity_event.emissions_factor_version
+    return fields
+
+
+def _to_dynamodb_item(activity_event):
+    return {name: _to_attribute_value(value) for name, value in _dynamodb_item_fields(activity_event).items()}
+
+
+def _batch_write_items(items):
+    # Returns the number of BatchWriteItem requests needed to write the items
+    request_items = {OUTPUT_DYNAMODB_TABLE_NAME: [{'PutRequest': {'Item': item}} for item in items]}
+    for attempt in range(DYNAMODB_WRITE_MAX_ATTEMPTS):
+        if attempt:
+            time.sleep(random.uniform(0, min(DYNAMODB_WRITE_MAX_BACKOFF_SECONDS, DYNAMODB_WRITE_BASE_BACKOFF_SECONDS * 2 ** attempt)))
+        request_items = _client('dynamodb').batch_write_item(RequestItems=request_items).get('UnprocessedItems')
+        if not request_items:
+            return attempt + 1
+    raise RuntimeError('%s items still unprocessed by DynamoDB after %s attempts' % (len(request_items[OUTPUT_DYNAMODB_TABLE_NAME]), DYNAMODB_WRITE_MAX_ATTEMPTS))
 
 
 def _save_enriched_events_to_dynamodb(activity_events):
-    table = dynamodb.Table(OUTPUT_DYNAMODB_TABLE_NAME)
-    LOGGER.info('Saving %s activity_events in DynamoDB', len(activity_events))
-    with table.batch_writer() as batch:
-        for activity_event in activity_events:
-            # DynamoDB expects decimals instead of floats
-            activity_event_with_decimal = json.loads(json.dumps(activity_event), parse_float=Decimal)
-            batch.put_item(Item=activity_event_with_decimal)
-
-
-def _get_emissions_factor(activity, category):
-    cache_key = frozenset({activity, category})
-    if cache_key in emission_factors_cache:
-        return emission_factors_cache[cache_key]
+    started_at = time.perf_counter()
+    # BatchWriteItem rejects several requests on the same item, the last event wins as with sequential puts
+    items = {activity_event.activity_event_id: _to_dynamodb_item(activity_event) for activity_event in activity_events}
+    futures = [dynamodb_write_executor.submit(_batch_write_items, batch) for batch in _chunks(items.values(), DDB_BATCH_WRITE_ITEM_SIZE)]
+    requests_count = sum(future.result() for future in futures)
+    return {'items': len(items), 'batches': len(futures), 'requests': requests_count, 'seconds': time.perf_counter() - started_at}
+
+
+def _scan_items(table_name):
+    # Read a whole table, following the Scan pagination
+    table = _dynamodb().Table(table_name)
+    scan_kwargs = {}
+    while True:
+        response = table.scan(**scan_kwargs)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def _scan_emission_factors():
+    return _scan_items(EMISSION_FACTORS_TABLE_NAME)
+
+
+def _read_emission_factors_snapshot(snapshot_path):
+    with open(snapshot_path) as snapshot:
+        emission_factors = json.load(snapshot)
+    # Snapshots use 'AR4-kgco2e' keys, stored as 'AR4_kgco2e' in DynamoDB (see the CDK stack)
+    for emission_factor in emission_factors:
+        ghg = emission_factor['emissions_factor_standards']['ghg']
+        ghg['coefficients'] = {key.replace('-', '_'): value for key, value in ghg['coefficients'].items()}
+    return emission_factors
+
+
+def _emission_factors_version(emission_factors):
+    # The version of a set of emission factors is its most recent update
+    return max((emission_factor['emissions_factor_standards']['ghg'].get('last_updated', '') for emission_factor in emission_factors), default=None)
+
+
+def _load_emission_factors():
+    if EMISSION_FACTORS_SNAPSHOT_PATH:
+        emission_factors = _read_emission_factors_snapshot(EMISSION_FACTORS_SNAPSHOT_PATH)
     else:
-        table = dynamodb.Table(EMISSION_FACTORS_TABLE_NAME)
-        coefficient = table.get_item(
-            Key={
-                'category': category,
-                'activity': activity,
-            }
-        )
-        emission_factors_cache[cache_key] = coefficient
-        return coefficient
+        emission_factors = list(_scan_emission_factors())
+    return _emission_factors_version(emission_factors), _index_emission_factors(emission_factors)
+
+
+def _index_emission_factors(emission_factors):
+    return {(emission_factor['category'], emission_factor['activity']): emission_factor for emission_factor in emission_factors}
+
+
+def _get_emission_factors():
+    global emission_factors_cache
+    loaded_at = emission_factors_cache_state['loaded_at']
+    if loaded_at is not None and time.monotonic() - loaded_at < EMISSION_FACTORS_CACHE_TTL_SECONDS:
+        _count('EmissionFactorsCacheHits')
+        return emission_factors_cache
+    _count('EmissionFactorsCacheMisses')
+    with emission_factors_cache_lock:
+        loaded_at = emission_factors_cache_state['loaded_at']
+        if loaded_at is None or time.monotonic() - loaded_at >= EMISSION_FACTORS_CACHE_TTL_SECONDS:
+            version, index = _load_emission_factors()
+            # Only replace the cached factors when they changed, so that lookups keep using the same objects
+            if version != emission_factors_cache_state['version'] or index != emission_factors_cache:
+                LOGGER.info('Loaded %s emission factors (version %s)', len(index), version)
+                emission_factors_cache = index
+                emission_factors_cache_state['version'] = version
+            emission_factors_cache_state['loaded_at'] = time.monotonic()
+    return emission_factors_cache
 
 
-def _calculate_emission(raw_data, factor):
-    return float(raw_data) * float(0 if factor == '' else factor) / 1000
+def _get_emission_factors_version(min_version):
+    # Version of the emission factors of the invocation: the cached ones are loaded again when they are older than
+    # min_version, without waiting for EMISSION_FACTORS_CACHE_TTL_SECONDS
+    _get_emission_factors()
+    if (emission_factors_cache_state['version'] or '') < min_version:
+        with emission_factors_cache_lock:
+            emission_factors_cache_state['loaded_at'] = None
+        _get_emission_factors()
+    return emission_factors_cache_state['version']
+
 
 class Gas(Enum):
     CO2 = 1  # Carbon dioxide
@@ -131,64 +1042,534 @@ class Gas(Enum):
     SF6 = 5  # Sulfur hexafluoride
 
 
-# Global warming potential (from IPCC report AR5)
-GWP = {
-    Gas.CO2: 1,
-    Gas.CH4: 28,
-    Gas.N2O: 265,
-    Gas.NF3: 16100,
-    Gas.SF6: 23500,
+# Global warming potentials (100-year time horizon) of the IPCC assessment reports.
+# The AR6 value of CH4 does not distinguish fossil and non-fossil methane.
+GWP_SETS = {
+    'AR4': {
+        Gas.CO2: 1,
+        Gas.CH4: 25,
+        Gas.N2O: 298,
+        Gas.NF3: 17200,
+        Gas.SF6: 22800,
+    },
+    'AR5': {
+        Gas.CO2: 1,
+        Gas.CH4: 28,
+        Gas.N2O: 265,
+        Gas.NF3: 16100,
+        Gas.SF6: 23500,
+    },
+    'AR6': {
+        Gas.CO2: 1,
+        Gas.CH4: 27.9,
+        Gas.N2O: 273,
+        Gas.NF3: 17400,
+        Gas.SF6: 24300,
+    },
 }
+# co2e is calculated with AR5, co2e_ar4 and co2e_ar6 with the other sets
+GWP = GWP_SETS['AR5']
+CO2E_GWP_SETS = ['AR5', 'AR4', 'AR6']
 
 
-def _calculate_co2e(co2_emissions, ch4_emissions, n2o_emissions):
-    result = co2_emissions * GWP[Gas.CO2]
-    result += ch4_emissions * GWP[Gas.CH4]
-    result += n2o_emissions * GWP[Gas.N2O]
+def _calculate_co2e(co2_emissions, ch4_emissions, n2o_emissions, gwp=GWP):
+    result = co2_emissions * gwp[Gas.CO2]
+    result += ch4_emissions * gwp[Gas.CH4]
+    result += n2o_emissions * gwp[Gas.N2O]
     return result
 
-def _append_emissions(activity_event):
-    emissions_factor = _get_emissions_factor(activity_event['activity'], activity_event['category'])
-    coefficients = emissions_factor['Item']['emissions_factor_standards']['ghg']['coefficients']
-
-    raw_data = activity_event['raw_data']
-    co2_emissions = _calculate_emission(raw_data, coefficients['co2_factor'])
-    ch4_emissions = _calculate_emission(raw_data, coefficients['ch4_factor'])
-    n2o_emissions = _calculate_emission(raw_data, coefficients['n2o_factor'])
-    co2e_emissions = _calculate_co2e(co2_emissions, ch4_emissions, n2o_emissions)
-    emissions_output = {
-        "emissions_output": {
-            "calculated_emissions": {
-                "co2": {
-                    "amount": co2_emissions,
-                    "unit": "tonnes"
-                },
-                "ch4": {
-                    "amount": ch4_emissions,
-                    "unit": "tonnes"
-                },
-                "n2o": {
-                    "amount": n2o_emissions,
-                    "unit": "tonnes"
-                },
-                "co2e": {
-                    "amount": co2e_emissions,
-                    "unit": "tonnes"
-                }
+def _emissions_output(co2_emissions, ch4_emissions, n2o_emissions, co2e_emissions, emissions_factor_amount, co2e_ar4_emissions, co2e_ar6_emissions):
+    return {
+        "calculated_emissions": {
+            "co2": {
+                "amount": co2_emissions,
+                "unit": "tonnes"
+            },
+            "ch4": {
+                "amount": ch4_emissions,
+                "unit": "tonnes"
+            },
+            "n2o": {
+                "amount": n2o_emissions,
+                "unit": "tonnes"
             },
-            "emissions_factor": {
-                "amount": float(coefficients['AR5_kgco2e']),
-                "unit": "kgCO2e/unit"
+            "co2e": {
+                "amount": co2e_emissions,
+                "unit": "tonnes"
+            },
+            "co2e_ar4": {
+                "amount": co2e_ar4_emissions,
+                "unit": "tonnes"
+            },
+            "co2e_ar6": {
+                "amount": co2e_ar6_emissions,
+                "unit": "tonnes"
             }
+        },
+        "emissions_factor": {
+            "amount": emissions_factor_amount,
+            "unit": "kgCO2e/unit"
         }
     }
-    activity_event.update(emissions_output)
-    return activity_event
+
+def _parse_coefficient(factor):
+    return float(0 if factor == '' else factor)
+
+def _factor_coefficients(emissions_factor):
+    # Numeric coefficients of an emission factor: co2, ch4 and n2o factors, the AR5 kgCO2e factor,
+    # then the tonnes of co2e per unit of raw_data for each of CO2E_GWP_SETS
+    factor_coefficients = emissions_factor['emissions_factor_standards']['ghg']['coefficients']
+    co2_factor = _parse_coefficient(factor_coefficients['co2_factor'])
+    ch4_factor = _parse_coefficient(factor_coefficients['ch4_factor'])
+    n2o_factor = _parse_coefficient(factor_coefficients['n2o_factor'])
+    return (co2_factor, ch4_factor, n2o_factor, float(factor_coefficients['AR5_kgco2e'])) + tuple(
+        _calculate_co2e(co2_factor, ch4_factor, n2o_factor, GWP_SETS[gwp_set]) / 1000 for gwp_set in CO2E_GWP_SETS
+    )
+
+def _compile_emission_factors(emission_factors, version=None):
+    # One row of _factor_coefficients per emission factor
+    positions = {}
+    coefficients = []
+    for key, emissions_factor in emission_factors.items():
+        positions[key] = len(coefficients)
+        coefficients.append(_factor_coefficients(emissions_factor))
+    matrix = numpy.array(coefficients, dtype=float).reshape(-1, 4 + len(CO2E_GWP_SETS)) if numpy is not None else None
+    return emission_factors, positions, coefficients, matrix, version
+
+def _import_numpy():
+    global numpy, numpy_missing
+    if numpy is None and not numpy_missing:
+        try:
+            import numpy
+        except ImportError:
+            numpy_missing = True
+    return numpy is not None
+
+def _get_compiled_emission_factors():
+    # Compiled again only when the emission factors are reloaded with changes
+    global compiled_emission_factors_cache
+    emission_factors = _get_emission_factors()
+    compiled = compiled_emission_factors_cache
+    if compiled is None or compiled[0] is not emission_factors:
+        compiled = _compile_emission_factors(emission_factors, emission_factors_cache_state['version'])
+        compiled_emission_factors_cache = compiled
+    return compiled
+
+def _changed_factor_pairs(previous_emission_factors, emission_factors):
+    # (category, activity) pairs whose emissions change between two indexes of emission factors (see _load_emission_factors):
+    # added, removed, or with other coefficients. Other changes, such as last_updated alone, don't change any emissions.
+    return {
+        key for key in previous_emission_factors.keys() | emission_factors.keys()
+        if key not in previous_emission_factors or key not in emission_factors
+        or _factor_coefficients(previous_emission_factors[key]) != _factor_coefficients(emission_factors[key])
+    }
+
+def _no_emissions_factor(activity_event):
+    return KeyError("No emissions factor for category '%s' and activity '%s'" % (activity_event.category, activity_event.activity))
+
+def _matched_factor_positions(positions, activity_events, dead_letters):
+    # activity_events without emissions factor are rejected, rather than failing the whole object
+    matched_events = []
+    factor_positions = []
+    for activity_event in activity_events:
+        position = positions.get((activity_event.category, activity_event.activity))
+        if position is None:
+            dead_letters.add(_no_emissions_factor(activity_event), _activity_event_fields(activity_event), activity_event.line_number)
+        else:
+            matched_events.append(activity_event)
+            factor_positions.append(position)
+    return matched_events, factor_positions
+
+def _calculate_emissions_batch(activity_events, dead_letters):
+    # Calculate the emissions of a chunk of activity_events at once: a few multiplications per event.
+    # Returns the activity_events with an emissions factor (the other ones are added to dead_letters) and the version of
+    # the emission factors, then their co2, ch4, n2o, co2e, emissions factor, co2e_ar4 and co2e_ar6 columns, in the same order.
+    _import_numpy()
+    _, positions, coefficients, matrix, version = _get_compiled_emission_factors()
+    with _timed('FactorLookupTime'):
+        activity_events, factor_positions = _matched_factor_positions(positions, activity_events, dead_letters)
+    raw_data = [activity_event.raw_data for activity_event in activity_events]
+    if matrix is not None:
+        factors = matrix[numpy.array(factor_positions, dtype=numpy.intp)]
+        raw_data = numpy.array(raw_data, dtype=float)
+        co2 = raw_data * factors[:, 0] / 1000
+        ch4 = raw_data * factors[:, 1] / 1000
+        n2o = raw_data * factors[:, 2] / 1000
+        co2e_ar5, co2e_ar4, co2e_ar6 = (raw_data[:, numpy.newaxis] * factors[:, 4:]).T
+        return activity_events, version, co2.tolist(), ch4.tolist(), n2o.tolist(), co2e_ar5.tolist(), factors[:, 3].tolist(), co2e_ar4.tolist(), co2e_ar6.tolist()
+    factors = [coefficients[position] for position in factor_positions]
+    co2 = [value * factor[0] / 1000 for value, factor in zip(raw_data, factors)]
+    ch4 = [value * factor[1] / 1000 for value, factor in zip(raw_data, factors)]
+    n2o = [value * factor[2] / 1000 for value, factor in zip(raw_data, factors)]
+    co2e_ar5 = [value * factor[4] for value, factor in zip(raw_data, factors)]
+    co2e_ar4 = [value * factor[5] for value, factor in zip(raw_data, factors)]
+    co2e_ar6 = [value * factor[6] for value, factor in zip(raw_data, factors)]
+    return activity_events, version, co2, ch4, n2o, co2e_ar5, [factor[3] for factor in factors], co2e_ar4, co2e_ar6
+
+def _append_emissions_batch(activity_events, rollup, dead_letters):
+    # Returns the enriched activity_events, see _calculate_emissions_batch for dead_letters.
+    # In the same pass, the emissions are added to the totals of rollup, if any, by _rollup_key.
+    activity_events, version, *emissions = _calculate_emissions_batch(activity_events, dead_letters)
+    for activity_event, co2, ch4, n2o, co2e, emissions_factor, co2e_ar4, co2e_ar6 in zip(activity_events, *emissions):
+        activity_event.emissions_factor_version = version
+        activity_event.co2 = co2
+        activity_event.ch4 = ch4
+        activity_event.n2o = n2o
+        activity_event.co2e = co2e
+        activity_event.emissions_factor = emissions_factor
+        activity_event.co2e_ar4 = co2e_ar4
+        activity_event.co2e_ar6 = co2e_ar6
+        if rollup is not None:
+            key = _rollup_key(activity_event)
+            totals = rollup.get(key)
+            if totals is None:
+                rollup[key] = [1, activity_event.raw_data, co2, ch4, n2o, co2e, co2e_ar4, co2e_ar6]
+            else:
+                totals[0] += 1
+                totals[1] += activity_event.raw_data
+                totals[2] += co2
+                totals[3] += ch4
+                totals[4] += n2o
+                totals[5] += co2e
+                totals[6] += co2e_ar4
+                totals[7] += co2e_ar6
+    return activity_events
+
+
+def _get_checkpoints(object_keys):
+    checkpoints = {}
+    for keys in _chunks(object_keys, DDB_BATCH_GET_ITEM_SIZE):
+        request_items = {CHECKPOINT_TABLE_NAME: {'Keys': [{'object_key': key} for key in keys]}}
+        while request_items:
+            response = _dynamodb().batch_get_item(RequestItems=request_items)
+            for checkpoint in response['Responses'].get(CHECKPOINT_TABLE_NAME, []):
+                checkpoints[checkpoint['object_key']] = checkpoint
+            request_items = response.get('UnprocessedKeys')
+            if request_items:
+                time.sleep(0.1)
+    return checkpoints
+
+
+def _get_statements_statuses(checkpoints):
+    # Status of the COPY statements that were still running at the end of previous invocations
+    statuses = {}
+    for checkpoint in checkpoints:
+        statement_id = checkpoint['statement_id']
+        if statement_id not in statuses:
+            try:
+                statuses[statement_id] = _client('redshift-data').describe_statement(Id=statement_id)['Status']
+            except ClientError:
+                # Statements are only kept 24 hours: the objects are processed again rather than lost
+                LOGGER.warning('Status of statement %s is unknown', statement_id, exc_info=True)
+                statuses[statement_id] = 'UNKNOWN'
+    return statuses
+
+
+def _save_checkpoints(checkpoints):
+    with _dynamodb().Table(CHECKPOINT_TABLE_NAME).batch_writer() as batch:
+        for checkpoint in checkpoints:
+            batch.put_item(Item=checkpoint)
+
+
+def _checkpoint(staged_object, status, statement_id=None):
+    checkpoint = {
+        'object_key': staged_object['object_key'],
+        'etag': staged_object['etag'],
+        'status': status,
+        'events_count': staged_object['events_count'],
+        'rejected_count': staged_object['rejected_count'],
+        'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat()
+    }
+    if statement_id is not None:
+        checkpoint['statement_id'] = statement_id
+    # Index of the emission factors used by the object, to only process it again when they change (see _mark_stale_objects)
+    if staged_object['factor_pairs']:
+        checkpoint['factor_pairs'] = {_factor_pair_attribute(pair) for pair in staged_object['factor_pairs']}
+    if staged_object['emission_factors_version']:
+        checkpoint['emission_factors_version'] = staged_object['emission_factors_version']
+    return checkpoint
+
+
+def _factor_pair_attribute(factor_pair):
+    # (category, activity) pairs are stored in a string set
+    return json.dumps(list(factor_pair))
+
+
+def _mark_stale_objects(factor_pairs, emission_factors_version=None):
+    # Objects whose activity_events use any of factor_pairs are processed again by the next invocation, with emission
+    # factors of emission_factors_version or later (see _new_events_objects). Returns their keys.
+    stale_pairs = {_factor_pair_attribute(factor_pair) for factor_pair in factor_pairs}
+    updated_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    stale_checkpoints = [
+        dict(checkpoint, status='stale', updated_at=updated_at)
+        for checkpoint in _scan_items(CHECKPOINT_TABLE_NAME) if checkpoint.get('factor_pairs', set()) & stale_pairs
+    ]
+    if emission_factors_version:
+        for checkpoint in stale_checkpoints:
+            checkpoint['stale_emission_factors_version'] = emission_factors_version
+    _save_checkpoints(stale_checkpoints)
+    LOGGER.info('Marked %s objects stale', len(stale_checkpoints))
+    return [checkpoint['object_key'] for checkpoint in stale_checkpoints]
+
+
+def _new_events_objects(events_objects):
+    # Objects that are new or changed since they were processed, stale, or whose COPY failed.
+    # Objects processed before are flagged as reprocessed: their rows are replaced by the load.
+    if not CHECKPOINT_TABLE_NAME:
+        return events_objects
+    checkpoints = _get_checkpoints([events_object['key'] for events_object in events_objects])
+    pending_checkpoints = [checkpoint for checkpoint in checkpoints.values() if checkpoint['status'] == 'staged']
+    statuses = _get_statements_statuses(pending_checkpoints)
+    _save_checkpoints([
+        dict(checkpoint, status='loaded', updated_at=datetime.datetime.now(datetime.timezone.utc).isoformat())
+        for checkpoint in pending_checkpoints if statuses[checkpoint['statement_id']] == 'FINISHED'
+    ])
+    # Stale objects wait for the emission factors they were marked stale for: a warm container reloads its cached
+    # factors, and the objects stay stale while the table still has older ones
+    stale_versions = [checkpoint['stale_emission_factors_version'] for checkpoint in checkpoints.values()
+                      if checkpoint['status'] == 'stale' and checkpoint.get('stale_emission_factors_version')]
+    emission_factors_version = _get_emission_factors_version(max(stale_versions)) if stale_versions else None
+    new_events_objects = []
+    for events_object in events_objects:
+        checkpoint = checkpoints.get(events_object['key'])
+        if checkpoint is None:
+            new_events_objects.append(events_object)
+        elif (checkpoint['status'] == 'stale' and checkpoint['etag'] == events_object['etag']
+              and checkpoint.get('stale_emission_factors_version', '') > (emission_factors_version or '')):
+            LOGGER.warning('Keeping %s stale: emission factors version %s is older than %s', events_object['key'],
+                           emission_factors_version, checkpoint['stale_emission_factors_version'])
+        elif (checkpoint['etag'] != events_object['etag'] or checkpoint['status'] == 'stale'
+              or checkpoint['status'] == 'staged' and statuses[checkpoint['statement_id']] in ('FAILED', 'ABORTED', 'UNKNOWN')):
+            new_events_objects.append(dict(events_object, reprocessed=True))
+    LOGGER.info('%s new or changed objects out of %s', len(new_events_objects), len(events_objects))
+    return new_events_objects
+
+
+def _process_events_object(object_key, part=None):
+    # Enrich the activity_events chunk by chunk, so that memory does not depend on the object size.
+    # A part (see _events_object_parts) only processes its byte range, and is staged on its own.
+    extension, _, _ = _staging_format()
+    output_object_key = _staged_key(_part_key(object_key, part), extension)
+    staging_writer, staging = _open_redshift_staging(output_object_key)
+    dead_letters = _DeadLetters(object_key, part=part)
+    events_count = 0
+    emission_factors_version = None
+    rollup = {}
+    dynamodb_metrics = {'items': 0, 'batches': 0, 'requests': 0, 'seconds': 0.0}
+    try:
+        chunks = _chunks(_read_events_from_s3(object_key, dead_letters, part), EVENTS_CHUNK_SIZE)
+        while True:
+            with _timed('ReadTime'):
+                activity_events = next(chunks, None)
+            if activity_events is None:
+                break
+            with _timed('EnrichTime'):
+                activity_events_with_emissions = _append_emissions_batch(activity_events, rollup, dead_letters)
+            with _timed('RedshiftStagingTime'):
+                _save_enriched_events_to_redshift(staging, activity_events_with_emissions)
+            with _timed('DynamoDBWriteTime'):
+                for name, value in _save_enriched_events_to_dynamodb(activity_events_with_emissions).items():
+                    dynamodb_metrics[name] += value
+            events_count += len(activity_events_with_emissions)
+            if activity_events_with_emissions:
+                emission_factors_version = activity_events_with_emissions[0].emissions_factor_version
+        with _timed('RedshiftStagingTime'):
+            staging.close()
+        dead_letters.close()
+    except Exception:
+        staging_writer.abort()
+        dead_letters.abort()
+        raise
+    _count('EventsProcessed', events_count)
+    _count('EventsRejected', dead_letters.count)
+    if dead_letters.count:
+        LOGGER.warning('Rejected %s activity_events of %s, see s3://%s/%s', dead_letters.count, object_key, OUTPUT_S3_BUCKET_NAME, dead_letters.key)
+    _count('StagedBytes', staging_writer.content_length)
+    _count('DynamoDBItemsWritten', dynamodb_metrics['items'])
+    _count('DynamoDBWriteRequests', dynamodb_metrics['requests'])
+    _count('DynamoDBWriteRetries', dynamodb_metrics['requests'] - dynamodb_metrics['batches'])
+    LOGGER.info('Saved %s activity_events of %s in DynamoDB and staged them for Redshift', events_count, _part_key(object_key, part))
+    LOGGER.info('Wrote %s DynamoDB items of %s in %.3fs (%.0f items/s, %s BatchWriteItem requests, %s retries)',
+                dynamodb_metrics['items'], _part_key(object_key, part), dynamodb_metrics['seconds'],
+                dynamodb_metrics['items'] / dynamodb_metrics['seconds'] if dynamodb_metrics['seconds'] else 0,
+                dynamodb_metrics['requests'], dynamodb_metrics['requests'] - dynamodb_metrics['batches'])
+    return {'object_key': object_key, 'key': output_object_key, 'content_length': staging_writer.content_length, 'events_count': events_count,
+            'rejected_count': dead_letters.count, 'rollup': rollup, 'emission_factors_version': emission_factors_version,
+            'factor_pairs': sorted({(key[1], key[2]) for key in rollup})}
+
+
+def _combine_parts(object_key, staged_parts):
+    # Staged object of an object split in byte ranges: its parts with activity_events are listed in the manifest of the
+    # invocation, and loaded by the same COPY as the other objects
+    rollup = {}
+    for staged_part in staged_parts:
+        _merge_rollups(rollup, staged_part['rollup'])
+    versions = [staged_part['emission_factors_version'] for staged_part in staged_parts if staged_part['emission_factors_version']]
+    return {'object_key': object_key,
+            'parts': [{'key': staged_part['key'], 'content_length': staged_part['content_length']} for staged_part in staged_parts if staged_part['events_count'] > 0],
+            'content_length': sum(staged_part['content_length'] for staged_part in staged_parts),
+            'events_count': sum(staged_part['events_count'] for staged_part in staged_parts),
+            'rejected_count': sum(staged_part['rejected_count'] for staged_part in staged_parts),
+            'rollup': rollup, 'emission_factors_version': versions[0] if versions else None,
+            'factor_pairs': sorted({factor_pair for staged_part in staged_parts for factor_pair in staged_part['factor_pairs']})}
+
+
+def _staged_part_to_payload(staged_part):
+    return dict(staged_part, rollup=_rollup_to_rows(staged_part['rollup']), factor_pairs=[list(pair) for pair in staged_part['factor_pairs']])
+
+
+def _staged_part_from_payload(payload):
+    return dict(payload, rollup=_rollup_from_rows(payload['rollup']), factor_pairs=[tuple(pair) for pair in payload['factor_pairs']])
+
+
+def _staged_part_record_key(object_key, part):
+    # Staged part written by a worker next to its staged object: events.json -> events.part-00002.staged-part.json
+    return _staged_key(_part_key(object_key, part), '.staged-part.json')
+
+
+def _invoke_byte_range_worker(object_key, part):
+    # Processes a part in an invocation of BYTE_RANGE_WORKER_FUNCTION. The staged part, whose rollup can exceed the
+    # 6 MB limit of an Invoke response, is written to S3 by the worker, which only returns its key.
+    response = _client('lambda').invoke(FunctionName=BYTE_RANGE_WORKER_FUNCTION, Payload=json.dumps({'object_key': object_key, 'part': part}).encode('utf-8'))
+    payload = json.loads(response['Payload'].read())
+    if response.get('FunctionError'):
+        raise RuntimeError("Part %s of %s failed in %s: %s" % (part['number'], object_key, BYTE_RANGE_WORKER_FUNCTION, payload.get('errorMessage')))
+    record = _client('s3').get_object(Bucket=OUTPUT_S3_BUCKET_NAME, Key=payload['staged_part_key'])['Body'].read()
+    _client('s3').delete_object(Bucket=OUTPUT_S3_BUCKET_NAME, Key=payload['staged_part_key'])
+    return _staged_part_from_payload(json.loads(record))
+
+
+def _manifest_key(context):
+    request_id = getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+    return "manifests/"+time.strftime('%Y-%m-%dT%H-%M-%S', time.gmtime())+"-"+request_id+".manifest"
+
+
+def _process_events_objects(events_objects):
+    # Process the objects with a pool of threads, mostly waiting on S3 and DynamoDB. The parts of the objects split
+    # in byte ranges are processed by the same pool, or by invocations of BYTE_RANGE_WORKER_FUNCTION.
+    # Returns the staged objects and the errors of the objects that failed (when any of their parts failed).
+    staged_objects = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_OBJECTS) as executor, ThreadPoolExecutor(max_workers=BYTE_RANGE_WORKER_CONCURRENCY) as invoker:
+        futures = []
+        for events_object in events_objects:
+            try:
+                parts = _events_object_parts(events_object)
+            except Exception as error:
+                LOGGER.exception('Failed to split %s', events_object['key'])
+                errors.append({'object_key': events_object['key'], 'error': repr(error)})
+                continue
+            if parts is None:
+                futures.append((events_object, None, [executor.submit(_profiled, _process_events_object, events_object['key'])]))
+            elif BYTE_RANGE_WORKER_FUNCTION:
+                futures.append((events_object, parts, [invoker.submit(_invoke_byte_range_worker, events_object['key'], part) for part in parts]))
+            else:
+                futures.append((events_object, parts, [executor.submit(_profiled, _process_events_object, events_object['key'], part) for part in parts]))
+        for events_object, parts, object_futures in futures:
+            try:
+                staged_parts = [future.result() for future in object_futures]
+                staged_object = staged_parts[0] if parts is None else _combine_parts(events_object['key'], staged_parts)
+                staged_objects.append(dict(staged_object, etag=events_object['etag'], reprocessed=events_object.get('reprocessed', False)))
+            except Exception as error:
+                LOGGER.exception('Failed to process %s', events_object['key'])
+                errors.append({'object_key': events_object['key'], 'error': repr(error)})
+    _count('ObjectsProcessed', len(staged_objects))
+    _count('ObjectsFailed', len(errors))
+    return staged_objects, errors
+
+
+def _calculate_emissions_of_objects(events_objects, context):
+    # Fail fast on an invalid configuration rather than on each object
+    _staging_format()
+    with _timed('CheckpointsTime'):
+        events_objects = _new_events_objects(events_objects)
+    staged_objects, errors = _process_events_objects(events_objects)
+    result = {
+        'objects_count': len(staged_objects),
+        'events_count': sum(staged_object['events_count'] for staged_object in staged_objects),
+        'rejected_count': sum(staged_object['rejected_count'] for staged_object in staged_objects),
+        'errors': errors,
+        'load': None
+    }
+    loaded_objects = [staged_object for staged_object in staged_objects if staged_object['events_count'] > 0]
+    if loaded_objects:
+        with _timed('RedshiftLoadTime'):
+            result['load'] = _copy_staged_events_to_redshift(loaded_objects, _manifest_key(context))
+    if CHECKPOINT_TABLE_NAME:
+        # Objects whose COPY is still running are checked by the next invocation
+        load = result['load']
+        with _timed('CheckpointsTime'):
+            _save_checkpoints([
+                _checkpoint(staged_object, 'staged', load['statement_id'])
+                if staged_object['events_count'] > 0 and load['status'] != 'FINISHED' else _checkpoint(staged_object, 'loaded')
+                for staged_object in staged_objects
+            ])
+    return result
+
+
+def byte_range_handler(event, context):
+    # Worker of BYTE_RANGE_WORKER_FUNCTION: stages a part of an object ({'object_key': ..., 'part': ...}) and saves its
+    # activity_events in DynamoDB. The invoking function reads the staged part from S3, loads it in Redshift with the
+    # other parts, and checkpoints the object.
+    with _instrumented(context):
+        staged_part = _process_events_object(event['object_key'], event['part'])
+        staged_part_key = _staged_part_record_key(event['object_key'], event['part'])
+        _client('s3').put_object(Bucket=OUTPUT_S3_BUCKET_NAME, Key=staged_part_key,
+                                 Body=json.dumps(_staged_part_to_payload(staged_part)).encode('utf-8'))
+        return {'staged_part_key': staged_part_key}
 
 
 def lambda_handler(event, context):
-    for event_object in _list_events_objects_in_s3():
-        activity_events = _read_events_from_s3(event_object)
-        activity_events_with_emissions = list(map(_append_emissions, activity_events))
-        _save_enriched_events_to_redshift(event_object, activity_events_with_emissions)
-        _save_enriched_events_to_dynamodb(activity_events_with_emissions)
+    # Sweep of all the objects under S3_PREFIXES
+    with _instrumented(context):
+        with _timed('ListTime'):
+            events_objects = _list_events_objects_in_s3()
+        return _calculate_emissions_of_objects(events_objects, context)
+
+
+def _s3_notification_objects(s3_notification):
+    # Objects created under S3_PREFIXES of the input bucket, other records are ignored
+    events_objects = []
+    for record in s3_notification.get('Records', []):
+        if not record.get('eventName', '').startswith('ObjectCreated:'):
+            continue
+        bucket = record['s3']['bucket']['name']
+        # Keys are URL encoded in notifications, and ETags are not quoted as in listings
+        key = unquote_plus(record['s3']['object']['key'])
+        if bucket != INPUT_S3_BUCKET_NAME or not key.startswith(tuple(S3_PREFIXES)):
+            LOGGER.warning('Ignoring s3://%s/%s', bucket, key)
+            continue
+        events_objects.append({'key': key, 'etag': '"'+record['s3']['object']['eTag']+'"', 'size': record['s3']['object'].get('size')})
+    return events_objects
+
+
+def s3_event_handler(event, context):
+    # Processes the objects of S3 ObjectCreated notifications, received directly or through SQS.
+    # SQS messages of the objects that failed are reported as batch item failures, to only retry them.
+    messages_ids = {}
+    events_objects = {}
+    failed_messages_ids = set()
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            # s3:TestEvent messages don't have any record. A malformed message only fails itself, not its batch
+            try:
+                records_objects = _s3_notification_objects(json.loads(record['body']))
+            except Exception:
+                LOGGER.exception('Failed to parse message %s', record['messageId'])
+                failed_messages_ids.add(record['messageId'])
+                continue
+            for events_object in records_objects:
+                messages_ids.setdefault(events_object['key'], []).append(record['messageId'])
+        else:
+            records_objects = _s3_notification_objects({'Records': [record]})
+        for events_object in records_objects:
+            events_objects[events_object['key']] = events_object
+    with _instrumented(context):
+        result = _calculate_emissions_of_objects(list(events_objects.values()), context)
+    failed_keys = [error['object_key'] for error in result['errors']]
+    if not messages_ids and failed_keys:
+        # Direct S3 invocations are retried as a whole
+        raise RuntimeError("Failed to process %s" % ', '.join(failed_keys))
+    failed_messages_ids.update(message_id for key in failed_keys for message_id in messages_ids.get(key, []))
+    result['batchItemFailures'] = [{'itemIdentifier': message_id} for message_id in sorted(failed_messages_ids)]
+    return result
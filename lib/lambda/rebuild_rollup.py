@@ -0,0 +1,48 @@
+import argparse
+import logging
+import sys
+import full_calculator_lambda as calculator
+
+# One-off migration of the calculated_emissions history, to run once when the calculated_emissions_rollup table is
+# deployed: the text columns that the CSV COPY statements loaded as empty strings before they used EMPTYASNULL are
+# set to NULL, as the Lambda function loads them now, and calculated_emissions_rollup is rebuilt from all the rows of
+# calculated_emissions. The statements run in a single transaction, concurrent loads of the Lambda function wait for it.
+# Running it again rebuilds the same totals.
+# Usage: python rebuild_rollup.py [--dry-run]
+# The cluster is read from the REDSHIFT_* environment variables, as in the Lambda function.
+
+LOGGER = logging.getLogger('rebuild_rollup')
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Set the empty strings of calculated_emissions to NULL and rebuild calculated_emissions_rollup")
+    parser.add_argument('--dry-run', action='store_true', help="only print the SQL statements")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    arguments = _parse_arguments(argv)
+    sqls = calculator._rebuild_rollup_sqls()
+    if arguments.dry_run:
+        print("\n".join(sqls))
+        return 0
+    # Unlike the Lambda function, the command has no time limit: it waits until the statements are done
+    calculator.REDSHIFT_STATEMENT_TIMEOUT_SECONDS = float('inf')
+    redshift_db_name, redshift_cluster_identifier = calculator._get_redshift_connection()
+    resp = calculator._client('redshift-data').batch_execute_statement(
+        Database=redshift_db_name,
+        SecretArn=calculator.REDSHIFT_SECRET,
+        ClusterIdentifier=redshift_cluster_identifier,
+        Sqls=sqls
+    )
+    statement = calculator._wait_for_statement(resp['Id'])
+    if statement['Status'] != 'FINISHED':
+        LOGGER.error('Rebuild of calculated_emissions_rollup %s (statement %s): %s', statement['Status'].lower(), resp['Id'], statement.get('Error', ''))
+        return 1
+    LOGGER.info('Rebuilt calculated_emissions_rollup (statement %s)', resp['Id'])
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    sys.exit(main())
@@ -0,0 +1,51 @@
+import argparse
+import logging
+import sys
+import full_calculator_lambda as calculator
+
+# Targeted recalculation after an update of the emission factor model: the (category, activity) pairs whose
+# coefficients differ between two snapshots are looked up in the checkpoints of the calculator, which record the
+# pairs used by each object, and only these objects are marked stale, with the version of the new snapshot. The next
+# invocation of lambda_handler that has emission factors of this version processes them again and replaces their rows
+# in Redshift.
+# Usage: python recalculate.py PREVIOUS_SNAPSHOT SNAPSHOT [--dry-run]
+# The checkpoint table is read from CALCULATOR_CHECKPOINT_TABLE_NAME, as in the Lambda function.
+
+LOGGER = logging.getLogger('recalculate')
+
+
+def _read_snapshot(snapshot_path):
+    # Version and index of the emission factors of a snapshot
+    emission_factors = calculator._read_emission_factors_snapshot(snapshot_path)
+    return calculator._emission_factors_version(emission_factors), calculator._index_emission_factors(emission_factors)
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Mark the objects using emission factors changed between two snapshots for recalculation")
+    parser.add_argument('previous_snapshot', help="emission factors snapshot the objects were calculated with")
+    parser.add_argument('snapshot', help="new emission factors snapshot, as loaded in the EMISSIONS_FACTOR_TABLE_NAME table")
+    parser.add_argument('--dry-run', action='store_true', help="only list the changed emission factors")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    arguments = _parse_arguments(argv)
+    _, previous_emission_factors = _read_snapshot(arguments.previous_snapshot)
+    version, emission_factors = _read_snapshot(arguments.snapshot)
+    changed_pairs = calculator._changed_factor_pairs(previous_emission_factors, emission_factors)
+    for category, activity in sorted(changed_pairs):
+        LOGGER.info('Changed emission factor: category %s, activity %s', category, activity)
+    LOGGER.info('%s changed emission factors (version %s)', len(changed_pairs), version)
+    if arguments.dry_run or not changed_pairs:
+        return 0
+    if not calculator.CHECKPOINT_TABLE_NAME:
+        LOGGER.error('CALCULATOR_CHECKPOINT_TABLE_NAME is not set')
+        return 1
+    for object_key in calculator._mark_stale_objects(changed_pairs, version):
+        LOGGER.info('Stale: %s', object_key)
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    sys.exit(main())
@@ -0,0 +1,180 @@
+import argparse
+import collections
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from emission_cases import EMISSION_CASES
+from local_aws import INPUT_BUCKET_NAME, LocalAWS, install, read_emission_factors_snapshot
+
+# Throughput benchmark of the calculator Lambda function against the local AWS stand-ins (see local_aws.py).
+# Synthetic scope 1 and scope 2 objects cycle through all the emission factors of the snapshot, and the events
+# of the EmissionOutput cases are processed with them to check the calculated emissions.
+# Each size runs in its own interpreter so that the peak RSS is its own.
+# Usage: python bench_calculator.py [--concurrency N] [--json] [events_count ...]
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda'))
+
+PHASES = ['read', 'enrich', 'csv', 'dynamodb', 'load']
+
+
+def synthetic_lines(emission_factors, first_index, events_count):
+    for index in range(first_index, first_index + events_count):
+        # Each of the 500 assets has a single activity, and all the emission factors are used
+        asset = index % 500
+        emission_factor = emission_factors[asset % len(emission_factors)]
+        activity_event = {
+            "activity_event_id": "bench-%d" % index,
+            "asset_id": "asset-%d" % asset,
+            "geo": "[30.14392,-97.59394]",
+            "origin_measurement_timestamp": "2022-06-26 02:31:29",
+            "scope": int(emission_factor['scope']),
+            "category": emission_factor['category'],
+            "activity": emission_factor['activity'],
+            "source": "bench",
+            "raw_data": 100 + index % 1000 / 10,
+            "units": emission_factor['emissions_factor_standards']['ghg']['coefficients']['units'],
+        }
+        yield (json.dumps(activity_event) + "\n").encode('utf-8')
+
+
+class PhaseTimer:
+    # Wall time spent in each phase, summed over the threads processing the objects
+
+    def __init__(self):
+        self.seconds = collections.Counter()
+        self.lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.seconds[phase] += seconds
+
+    def wrap(self, phase, function):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(phase, time.perf_counter() - start)
+        return timed
+
+    def wrap_generator(self, phase, function):
+        def timed(*args, **kwargs):
+            iterator = function(*args, **kwargs)
+            seconds = 0
+            try:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                    finally:
+                        seconds += time.perf_counter() - start
+                    yield item
+            finally:
+                self.add(phase, seconds)
+        return timed
+
+
+def check_emissions(activity_events, expected_emissions, checked):
+    for activity_event in activity_events:
+        expected = expected_emissions.get(activity_event.activity_event_id)
+        if expected is None:
+            continue
+        for actual, expected_value in [
+            (activity_event.co2, expected.co2),
+            (activity_event.ch4, expected.ch4),
+            (activity_event.n2o, expected.n2o),
+            (activity_event.co2e, expected.co2e_ar5),
+            (activity_event.co2e_ar4, expected.co2e_ar4),
+            (activity_event.emissions_factor, expected.emissions_factor_ar5),
+        ]:
+            if not math.isclose(actual, expected_value, rel_tol=1e-5):
+                raise AssertionError("%s: calculated %s instead of %s" % (activity_event.activity_event_id, actual, expected_value))
+        checked.add(activity_event.activity_event_id)
+
+
+def run(events_count, concurrency):
+    aws = install(LocalAWS(retain_writes=False))
+    import full_calculator_lambda as calculator
+    calculator.MAX_CONCURRENT_OBJECTS = concurrency
+
+    emission_factors = read_emission_factors_snapshot()
+    # Scope 1 (and 3) activities are in the cleansed data, scope 2 ones in the bills
+    scope1_factors = [emission_factor for emission_factor in emission_factors if emission_factor['scope'] != '2']
+    scope2_factors = [emission_factor for emission_factor in emission_factors if emission_factor['scope'] == '2']
+    scope1_count = events_count // 2
+    aws.s3.add_generated_object(INPUT_BUCKET_NAME, "scope1-cleansed-data/bench.json", lambda: synthetic_lines(scope1_factors, 0, scope1_count))
+    aws.s3.add_generated_object(INPUT_BUCKET_NAME, "scope2-bill-extracted-data/bench.json", lambda: synthetic_lines(scope2_factors, scope1_count, events_count - scope1_count))
+    expected_emissions = {}
+    for index, events_objects in enumerate(EMISSION_CASES):
+        for events_object in events_objects:
+            aws.s3.add_object(INPUT_BUCKET_NAME, events_object['key'].replace(".json", "-%d.json" % index), events_object['body'])
+            expected_emissions.update((expected.activity_event_id, expected) for expected in events_object['expected'])
+
+    timer = PhaseTimer()
+    checked = set()
+    append_emissions_batch = timer.wrap('enrich', calculator._append_emissions_batch)
+
+    def checked_append_emissions_batch(activity_events, *args):
+        activity_events = append_emissions_batch(activity_events, *args)
+        check_emissions(activity_events, expected_emissions, checked)
+        return activity_events
+
+    calculator._read_events_from_s3 = timer.wrap_generator('read', calculator._read_events_from_s3)
+    calculator._append_emissions_batch = checked_append_emissions_batch
+    calculator._save_enriched_events_to_redshift = timer.wrap('csv', calculator._save_enriched_events_to_redshift)
+    calculator._save_enriched_events_to_dynamodb = timer.wrap('dynamodb', calculator._save_enriched_events_to_dynamodb)
+    calculator._copy_staged_events_to_redshift = timer.wrap('load', calculator._copy_staged_events_to_redshift)
+
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    result = calculator.lambda_handler({}, None)
+    seconds = time.perf_counter() - start
+    if result['errors'] or result['rejected_count']:
+        raise AssertionError(result['errors'] or "%s activity_events rejected" % result['rejected_count'])
+    if checked != set(expected_emissions):
+        raise AssertionError("Emissions not calculated for %s" % sorted(set(expected_emissions) - checked))
+    return {
+        'events': result['events_count'],
+        'seconds': seconds,
+        'events_per_second': result['events_count'] / seconds,
+        # ru_maxrss is in KiB on Linux
+        'start_rss_mb': start_rss / 1024,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'phases': {phase: timer.seconds[phase] for phase in PHASES},
+        'checked_cases': len(checked),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('events_counts', nargs='*', type=int, default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--concurrency', type=int, default=1, help="objects processed concurrently (phase times are summed over the threads)")
+    parser.add_argument('--json', action='store_true', help="print one JSON line per size, to compare runs")
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.run is not None:
+        print(json.dumps(run(arguments.run, arguments.concurrency)))
+        return
+
+    if not arguments.json:
+        print("%10s %10s %12s %10s" % ("events", "time (s)", "events/s", "peak RSS") + "".join("%14s" % (phase + " (s)") for phase in PHASES))
+    for events_count in arguments.events_counts:
+        output = subprocess.run([sys.executable, __file__, '--run', str(events_count), '--concurrency', str(arguments.concurrency)], check=True, capture_output=True, text=True).stdout
+        measure = json.loads(output.splitlines()[-1])
+        if arguments.json:
+            print(json.dumps(measure))
+        else:
+            print("%10d %10.2f %12.0f %8.0fMB" % (measure['events'], measure['seconds'], measure['events_per_second'], measure['peak_rss_mb'])
+                  + "".join("%14.2f" % measure['phases'][phase] for phase in PHASES))
+
+
+if __name__ == '__main__':
+    main()
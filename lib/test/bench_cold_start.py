@@ -0,0 +1,54 @@
+import os
+import statistics
+import subprocess
+import sys
+
+# Cold start benchmark of the calculator Lambda function: each scenario runs in a new interpreter,
+# as in a new Lambda container, and reports the median of its durations.
+# Real boto3 clients are created (no request is sent), with fake credentials.
+# Usage: python bench_cold_start.py [runs]
+
+LAMBDA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')
+
+SERVICES = ['s3', 'dynamodb', 'redshift-data', 'secretsmanager']
+
+SCENARIO = '''
+import sys, time
+sys.path.insert(0, %(lambda_path)r)
+start = time.perf_counter()
+import full_calculator_lambda
+imported = time.perf_counter()
+%(init)s
+print((imported - start) * 1000, (time.perf_counter() - imported) * 1000)
+'''
+
+SCENARIOS = [
+    ('import', ''),
+    # What the module used to do at import, except the GetSecretValue round trip (tens of ms more)
+    ('eager init (previous import)', '\n'.join(["full_calculator_lambda._client(%r)" % service for service in SERVICES] + ["full_calculator_lambda._dynamodb()"])),
+] + [
+    ('first use of %s' % service, "full_calculator_lambda._client(%r)" % service) for service in SERVICES
+] + [
+    ('first use of dynamodb resource', "full_calculator_lambda._dynamodb()"),
+    # Imported by the first calculation of a container
+    ('first import of numpy', "full_calculator_lambda._import_numpy()"),
+]
+
+
+def run(init):
+    environment = dict(os.environ, AWS_ACCESS_KEY_ID='bench', AWS_SECRET_ACCESS_KEY='bench', AWS_DEFAULT_REGION='us-east-1', AWS_EC2_METADATA_DISABLED='true')
+    output = subprocess.run([sys.executable, '-c', SCENARIO % {'lambda_path': LAMBDA_PATH, 'init': init}], env=environment, check=True, capture_output=True, text=True).stdout
+    return [float(duration) for duration in output.split()]
+
+
+def main(runs):
+    print("%-32s %12s %12s %12s" % ("scenario", "import (ms)", "init (ms)", "total (ms)"))
+    for name, init in SCENARIOS:
+        durations = [run(init) for _ in range(runs)]
+        import_time = statistics.median(duration[0] for duration in durations)
+        init_time = statistics.median(duration[1] for duration in durations)
+        print("%-32s %12.1f %12.1f %12.1f" % (name, import_time, init_time, import_time + init_time))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
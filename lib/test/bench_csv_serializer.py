@@ -0,0 +1,108 @@
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+from local_aws import LocalAWS, enrich, install
+
+# Micro-benchmark of the Redshift CSV serializer against the string concatenation it replaced.
+# Usage: python bench_csv_serializer.py [events_count ...]
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda'))
+
+
+def legacy_events_to_csv(activity_events):
+    # Previous implementation of the Redshift payload, kept for comparison
+    csv_body = ""
+    for activity_event in activity_events:
+        csv_body += activity_event['activity_event_id']
+        csv_body +=","+activity_event.get('asset_id','')
+        csv_body +=","+(str(json.loads(activity_event['geo'])[0]) if activity_event.get('geo',None) else '')
+        csv_body +=","+(str(json.loads(activity_event['geo'])[1]) if activity_event.get('geo',None) else '')
+        csv_body +=","+activity_event.get('origin_measurement_timestamp','')
+        csv_body +=","+str(activity_event['scope'])
+        csv_body +=",\""+activity_event['category']+"\""
+        csv_body +=",\""+activity_event['activity']+"\""
+        csv_body +=","+activity_event.get('source','')
+        csv_body +=","+str(activity_event['raw_data'])
+        csv_body +=","+activity_event['units']
+        csv_body +=","+str(activity_event['emissions_output']['calculated_emissions']['co2e']['amount'])
+        csv_body +=","+activity_event['emissions_output']['calculated_emissions']['co2e']['unit']
+        csv_body +=","+str(activity_event['emissions_output']['calculated_emissions']['n2o']['amount'])
+        csv_body +=","+activity_event['emissions_output']['calculated_emissions']['n2o']['unit']
+        csv_body +=","+str(activity_event['emissions_output']['calculated_emissions']['ch4']['amount'])
+        csv_body +=","+activity_event['emissions_output']['calculated_emissions']['ch4']['unit']
+        csv_body +=","+str(activity_event['emissions_output']['calculated_emissions']['co2']['amount'])
+        csv_body +=","+activity_event['emissions_output']['calculated_emissions']['co2']['unit']
+        csv_body +=","+str(activity_event['emissions_output']['emissions_factor']['amount'])
+        csv_body +=","+activity_event['emissions_output']['emissions_factor']['unit']
+        csv_body +="\n"
+    return csv_body
+
+
+def enriched_events(events_count):
+    emissions = {"amount": 1.0562245000000001, "unit": "tonnes"}
+    return [{
+        "activity_event_id": "bench-%d" % index,
+        "asset_id": "vehicle-%d" % (index % 500),
+        "geo": "[30.14392,-97.59394]",
+        "origin_measurement_timestamp": "2022-06-26 02:31:29",
+        "scope": 1,
+        "category": "mobile-combustion",
+        "activity": "Diesel Fuel - Diesel Passenger Cars",
+        "source": "company_fleet_management_database",
+        "raw_data": 103.45,
+        "units": "gal",
+        "emissions_output": {
+            "calculated_emissions": {"co2": emissions, "ch4": emissions, "n2o": emissions, "co2e": emissions},
+            "emissions_factor": {"amount": 10.2162775, "unit": "kgCO2e/unit"}
+        }
+    } for index in range(events_count)]
+
+
+class NullStream(io.RawIOBase):
+    # Stands for the S3 multipart upload the serializer writes to
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return len(data)
+
+
+def measure(serializer, activity_events):
+    tracemalloc.start()
+    start = time.perf_counter()
+    serializer(activity_events)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # A second run without tracemalloc for the timing
+    start = time.perf_counter()
+    serializer(activity_events)
+    return min(elapsed, time.perf_counter() - start), peak
+
+
+def main(events_counts):
+    install(LocalAWS())
+    import full_calculator_lambda
+
+    def streamed_events_to_csv(activity_events):
+        text_stream = full_calculator_lambda._open_text_stream(NullStream())
+        full_calculator_lambda._write_events_csv(text_stream, activity_events)
+        text_stream.close()
+
+    def typed_events(activity_events):
+        # The serializer takes the typed activity_events, enriched by the calculator
+        return enrich(full_calculator_lambda, [{name: value for name, value in activity_event.items() if name != 'emissions_output'} for activity_event in activity_events])
+
+    print("%10s %12s %12s %14s %14s" % ("events", "legacy (s)", "csv (s)", "legacy peak", "csv peak"))
+    for events_count in events_counts:
+        activity_events = enriched_events(events_count)
+        legacy_time, legacy_peak = measure(legacy_events_to_csv, activity_events)
+        csv_time, csv_peak = measure(streamed_events_to_csv, typed_events(activity_events))
+        print("%10d %12.3f %12.3f %12.1fMB %12.1fMB" % (events_count, legacy_time, csv_time, legacy_peak / 2**20, csv_peak / 2**20))
+
+
+if __name__ == '__main__':
+    main([int(events_count) for events_count in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,27 @@
+import importlib
+import os
+import sys
+import boto3
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda'))
+
+from local_aws import LocalAWS
+
+
+@pytest.fixture
+def local_aws(monkeypatch):
+    aws = LocalAWS()
+    monkeypatch.setattr(boto3, 'client', aws.client)
+    monkeypatch.setattr(boto3, 'resource', aws.resource)
+    for name, value in aws.environment().items():
+        monkeypatch.setenv(name, value)
+    return aws
+
+
+@pytest.fixture
+def calculator(local_aws):
+    # The calculator reads its configuration at import time
+    sys.modules.pop('full_calculator_lambda', None)
+    yield importlib.import_module('full_calculator_lambda')
+    sys.modules.pop('full_calculator_lambda', None)
@@ -0,0 +1,53 @@
+from emission_output import EmissionOutput
+
+# Activity events objects with their expected emissions, shared by the end-to-end test (test_calculator.py)
+# and the local benchmark (bench_calculator.py)
+
+SCOPE1 = [
+    {
+        "key": "scope1-cleansed-data/testscope1.json",
+        "body": b'{"activity_event_id": "test-1", "asset_id": "vehicle-1234", "geo": "[30.14392,-97.59394]", "origin_measurement_timestamp":"2022-06-26 02:31:29", "scope": 1, "category": "mobile-combustion", "activity": "Diesel Fuel - Diesel Passenger Cars", "source": "company_fleet_management_database", "raw_data": 103.45, "units": "gal"}',
+        "expected": [EmissionOutput("test-1", 1.0562245000000001, 1.1638125e-06, 2.327625e-06, 1.0569472275625, 1.056873907375, 10.21698625, 10.2162775)]
+    }
+]
+
+SCOPE1_2LINES = [
+    {
+        "key": "scope1-cleansed-data/testscope1_2lines.json",
+        "body": b'''{"activity_event_id": "test-2", "asset_id": "vehicle-1234", "geo": "[30.14392,-97.59394]", "origin_measurement_timestamp":"2022-06-26 02:31:29", "scope": 1, "category": "mobile-combustion", "activity": "Diesel Fuel - Diesel Passenger Cars", "source": "company_fleet_management_database", "raw_data": 103.46, "units": "gal"}
+                    {"activity_event_id": "test-3", "asset_id": "vehicle-1235", "geo": "[30.14392,-97.59394]", "origin_measurement_timestamp":"2022-06-26 02:31:29", "scope": 1, "category": "mobile-combustion", "activity": "Diesel Fuel - Diesel Passenger Cars", "source": "company_fleet_management_database", "raw_data": 13.5, "units": "gal"}''',
+        "expected": [EmissionOutput("test-2", 1.0563266, 1.1639249999e-06, 2.3278499999e-06, 1.057049397425, 1.05697607015, 10.21698625, 10.2162775),
+                     EmissionOutput("test-3", 0.137835, 1.51875e-07, 3.0375e-07, 0.137929314375, 0.13791974625, 10.21698625, 10.2162775)]
+    }
+]
+
+SCOPE2_LOCATION_BASED = [
+    {
+        "key": "scope2-bill-extracted-data/testscope2_location.json",
+        "body": b'{ "activity_event_id": "test-4", "supplier": "eversource", "scope": 2, "category": "grid-region-location-based", "activity": "Quebec", "raw_data": 453, "units": "kwH"}',
+        "expected": [EmissionOutput("test-4", 0.0005436, 0.0, 4.52999999e-08, 0.0005570994, 0.0005556045, 0.0012298, 0.0012265)]
+    }
+]
+
+SCOPE2_MARKET_BASED_RESIDUAL_MIX = [
+    {
+        "key": "scope2-bill-extracted-data/testscope2_market.json",
+        "body": b'{ "activity_event_id": "test-5", "supplier": "eversource", "scope": 2, "category": "egrid-subregion-residual-mix-market-based", "activity": "Quebec", "raw_data": 454, "units": "kwH"}',
+        "expected": [EmissionOutput("test-5", 0.020459238508, 0.0, 0.0, 0.020459238508, 0.020459238508, 0.045064402, 0.045064402)]
+    }
+]
+
+MULTIPLE_EVENTS_OBJECTS = [
+    {
+        "key": "scope2-bill-extracted-data/testscope2_location.json",
+        "body": b'{ "activity_event_id": "test-6", "supplier": "eversource", "scope": 2, "category": "grid-region-location-based", "activity": "Quebec", "raw_data": 455, "units": "kwH"}',
+        "expected": [EmissionOutput("test-6", 0.0005459999999999, 0.0, 4.55e-08, 0.000559559, 0.0005580574999999, 0.0012298, 0.0012265)]
+    },
+    {
+        "key": "scope2-bill-extracted-data/testscope2_market.json",
+        "body": b'{ "activity_event_id": "test-7", "supplier": "eversource", "scope": 2, "category": "egrid-subregion-residual-mix-market-based", "activity": "Quebec", "raw_data": 456, "units": "kwH"}',
+        "expected": [EmissionOutput("test-7", 0.020549367312, 0.0, 0.0, 0.020549367312, 0.020549367312, 0.045064402, 0.045064402)]
+    }
+]
+
+EMISSION_CASES = [SCOPE1, SCOPE1_2LINES, SCOPE2_LOCATION_BASED, SCOPE2_MARKET_BASED_RESIDUAL_MIX, MULTIPLE_EVENTS_OBJECTS]
@@ -0,0 +1,504 @@
+import csv
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from decimal import Decimal
+import boto3
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+# In-memory stand-ins for the AWS services used by the calculator Lambda function,
+# so that it can be run (and measured) without a deployed stack.
+
+EMISSION_FACTORS_SNAPSHOT = os.path.join(os.path.dirname(__file__), '..', 'emissions_factor_model_2022-05-22.json')
+
+INPUT_BUCKET_NAME = 'local-input-bucket'
+OUTPUT_BUCKET_NAME = 'local-output-bucket'
+EMISSION_FACTORS_TABLE_NAME = 'local-emissions-factor-table'
+CALCULATOR_OUTPUT_TABLE_NAME = 'local-calculator-output-table'
+CALCULATOR_CHECKPOINT_TABLE_NAME = 'local-calculator-checkpoint-table'
+REDSHIFT_SECRET = 'local-redshift-secret'
+REDSHIFT_DB_NAME = 'emissions'
+REDSHIFT_CLUSTER_IDENTIFIER = 'local-cluster'
+
+
+class _LinesStream:
+    # File-like object producing the lines of a generated object on demand
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.pending = b''
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        while size < 0 or len(self.pending) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.pending += line
+        if size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+class _LocalPaginator:
+    def __init__(self, operation):
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.operation(**kwargs)
+            yield page
+            if not page['IsTruncated']:
+                return
+            kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+
+class LocalS3:
+    def __init__(self, aws):
+        self.aws = aws
+        self.objects = {}
+        self.uploads = {}
+        self.bytes_written = 0
+        # Simulated network latency of get_object, in seconds
+        self.latency = 0
+        self.reads_in_flight = 0
+        self.max_reads_in_flight = 0
+        # Keys whose get_object fails, as without the permission to read them
+        self.failing_keys = set()
+        self.lock = threading.Lock()
+
+    def add_object(self, bucket, key, body):
+        self.objects[(bucket, key)] = body
+
+    def add_generated_object(self, bucket, key, lines_factory):
+        # lines_factory returns a new iterator of encoded lines each time the object is read
+        self.objects[(bucket, key)] = lines_factory
+
+    def read_object(self, bucket, key):
+        return self.objects[(bucket, key)]
+
+    def _store(self, bucket, key, body):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.bytes_written += len(body)
+        self.objects[(bucket, key)] = body if self.aws.retain_writes else b''
+        return '"' + hashlib.md5(body).hexdigest() + '"'
+
+    def get_object(self, Bucket, Key, **kwargs):
+        with self.lock:
+            self.reads_in_flight += 1
+            self.max_reads_in_flight = max(self.max_reads_in_flight, self.reads_in_flight)
+        try:
+            time.sleep(self.latency)
+        finally:
+            with self.lock:
+                self.reads_in_flight -= 1
+        if Key in self.failing_keys:
+            raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}, 'GetObject')
+        if 'IfMatch' in kwargs and kwargs['IfMatch'] != self.etag(Bucket, Key):
+            raise ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': 'At least one of the pre-conditions you specified did not hold'}}, 'GetObject')
+        body = self.objects[(Bucket, Key)]
+        if 'Range' in kwargs:
+            # 'bytes=start-end', end included
+            start, end = map(int, kwargs['Range'][len('bytes='):].split('-'))
+            body = (b''.join(body()) if callable(body) else body)[start:end + 1]
+            return {'Body': StreamingBody(_LinesStream(iter([body])), len(body)), 'ContentLength': len(body)}
+        if callable(body):
+            return {'Body': StreamingBody(_LinesStream(iter(body())), None)}
+        return {'Body': StreamingBody(_LinesStream(iter([body])), len(body)), 'ContentLength': len(body)}
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        return {'ETag': self._store(Bucket, Key, Body)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def etag(self, bucket, key):
+        body = self.objects[(bucket, key)]
+        return '"' + hashlib.md5(key.encode('utf-8') if callable(body) else body).hexdigest() + '"'
+
+    def size(self, bucket, key):
+        # Generated objects are not measured, they are never split in byte ranges
+        body = self.objects[(bucket, key)]
+        return 0 if callable(body) else len(body)
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken='', MaxKeys=1000, **kwargs):
+        # The continuation token is the last key of the previous page
+        keys = sorted(key for (bucket, key) in self.objects if bucket == Bucket and key.startswith(Prefix) and key > ContinuationToken)
+        page_keys = keys[:MaxKeys]
+        response = {'KeyCount': len(page_keys), 'IsTruncated': len(keys) > MaxKeys}
+        if page_keys:
+            response['Contents'] = [{'Key': key, 'ETag': self.etag(Bucket, key), 'Size': self.size(Bucket, key)} for key in page_keys]
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page_keys[-1]
+        return response
+
+    def get_paginator(self, operation_name):
+        return _LocalPaginator(getattr(self, operation_name))
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = str(uuid.uuid4())
+        self.uploads[upload_id] = []
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self.bytes_written += len(Body)
+        self.uploads[UploadId].append(Body if self.aws.retain_writes else b'')
+        return {'ETag': '"' + hashlib.md5(Body).hexdigest() + '"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        parts = self.uploads.pop(UploadId)
+        assert len(parts) == len(MultipartUpload['Parts'])
+        self.objects[(Bucket, Key)] = b''.join(parts)
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.uploads.pop(UploadId, None)
+        return {}
+
+
+class _LocalBatchWriter:
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+
+class LocalTable:
+    # Number of items returned by a Scan page (DynamoDB pages are limited to 1 MB)
+    scan_page_size = 100
+
+    def __init__(self, aws, key_names):
+        self.aws = aws
+        self.key_names = key_names
+        self.items = {}
+        self.items_written = 0
+        self.requests_count = 0
+
+    def _key(self, item):
+        return tuple(item[name] for name in self.key_names)
+
+    def get_item(self, Key, **kwargs):
+        self.requests_count += 1
+        item = self.items.get(self._key(Key))
+        return {'Item': item} if item is not None else {}
+
+    def put_item(self, Item, **kwargs):
+        self.items_written += 1
+        if self.aws.retain_writes:
+            self.items[self._key(Item)] = Item
+        return {}
+
+    def scan(self, ExclusiveStartKey=None, **kwargs):
+        self.requests_count += 1
+        keys = sorted(self.items)
+        start = keys.index(self._key(ExclusiveStartKey)) + 1 if ExclusiveStartKey else 0
+        page_keys = keys[start:start + self.scan_page_size]
+        response = {'Items': [self.items[key] for key in page_keys], 'Count': len(page_keys)}
+        if start + self.scan_page_size < len(keys):
+            response['LastEvaluatedKey'] = dict(zip(self.key_names, page_keys[-1]))
+        return response
+
+    def batch_writer(self, **kwargs):
+        return _LocalBatchWriter(self)
+
+
+class LocalDynamoDB:
+    def __init__(self, aws):
+        self.aws = aws
+        self.tables = {}
+        # Simulated network latency of batch_write_item, in seconds
+        self.latency = 0
+
+    def create_table(self, name, key_names):
+        self.tables[name] = LocalTable(self.aws, key_names)
+        return self.tables[name]
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        responses = {}
+        for name, request in RequestItems.items():
+            assert len(request['Keys']) <= 100
+            items = [self.tables[name].get_item(Key=key).get('Item') for key in request['Keys']]
+            responses[name] = [item for item in items if item is not None]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+class LocalDynamoDBClient:
+    def __init__(self, dynamodb):
+        self.dynamodb = dynamodb
+        self.deserializer = TypeDeserializer()
+        # Number of the next batch_write_item calls leaving half of their items unprocessed
+        self.unprocessed_batches = 0
+        self.batch_write_requests = 0
+        self.writes_in_flight = 0
+        self.max_writes_in_flight = 0
+        self.lock = threading.Lock()
+
+    def _deserialize(self, item, attributes=None):
+        return {attribute: self.deserializer.deserialize(item[attribute]) for attribute in attributes or item}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        with self.lock:
+            self.batch_write_requests += 1
+            self.writes_in_flight += 1
+            self.max_writes_in_flight = max(self.max_writes_in_flight, self.writes_in_flight)
+            throttled = self.unprocessed_batches > 0
+            if throttled:
+                self.unprocessed_batches -= 1
+        try:
+            time.sleep(self.dynamodb.latency)
+            unprocessed = {}
+            for name, requests in RequestItems.items():
+                assert len(requests) <= 25
+                table = self.dynamodb.tables[name]
+                # Items are only decoded when they are retained, keys are always checked
+                items = [self._deserialize(request['PutRequest']['Item'], None if self.dynamodb.aws.retain_writes else table.key_names) for request in requests]
+                # DynamoDB rejects batches with several requests on the same item
+                assert len(set(table._key(item) for item in items)) == len(items)
+                if throttled:
+                    items, unprocessed[name] = items[:len(items) // 2], requests[len(requests) // 2:]
+                for item in items:
+                    with self.lock:
+                        table.put_item(Item=item)
+            return {'UnprocessedItems': unprocessed}
+        finally:
+            with self.lock:
+                self.writes_in_flight -= 1
+
+
+class LocalSecretsManager:
+    def __init__(self):
+        self.requests_count = 0
+
+    def get_secret_value(self, SecretId, **kwargs):
+        assert SecretId == REDSHIFT_SECRET
+        self.requests_count += 1
+        return {'SecretString': json.dumps({'dbname': REDSHIFT_DB_NAME, 'dbClusterIdentifier': REDSHIFT_CLUSTER_IDENTIFIER})}
+
+
+class LocalRedshiftData:
+    def __init__(self):
+        self.statements = {}
+        # Statuses returned by the next describe_statement calls, statements are FINISHED otherwise
+        self.statuses = []
+
+    def execute_statement(self, **kwargs):
+        statement_id = str(uuid.uuid4())
+        self.statements[statement_id] = kwargs
+        return {'Id': statement_id}
+
+    def batch_execute_statement(self, **kwargs):
+        return self.execute_statement(**kwargs)
+
+    def describe_statement(self, Id, **kwargs):
+        status = self.statuses.pop(0) if self.statuses else 'FINISHED'
+        statement = {'Id': Id, 'Status': status}
+        if status == 'FAILED':
+            statement['Error'] = 'Load into table calculated_emissions failed'
+        return statement
+
+
+class LocalLambda:
+    # Synchronous invocations of the handlers registered by function name, in the calling process
+    def __init__(self):
+        self.functions = {}
+        self.invocations = 0
+        self.lock = threading.Lock()
+
+    def invoke(self, FunctionName, Payload=b'', **kwargs):
+        with self.lock:
+            self.invocations += 1
+        try:
+            payload = self.functions[FunctionName](json.loads(Payload), None)
+        except Exception as error:
+            return {'StatusCode': 200, 'FunctionError': 'Unhandled',
+                    'Payload': StreamingBody(io.BytesIO(json.dumps({'errorMessage': str(error), 'errorType': type(error).__name__}).encode('utf-8')), None)}
+        body = json.dumps(payload).encode('utf-8')
+        return {'StatusCode': 200, 'Payload': StreamingBody(io.BytesIO(body), len(body))}
+
+
+class LocalAWS:
+    def __init__(self, retain_writes=True):
+        self.retain_writes = True
+        self.s3 = LocalS3(self)
+        self.dynamodb = LocalDynamoDB(self)
+        self.dynamodb_client = LocalDynamoDBClient(self.dynamodb)
+        self.secretsmanager = LocalSecretsManager()
+        self.redshift = LocalRedshiftData()
+        self.lambda_ = LocalLambda()
+        load_emission_factors(self.dynamodb.create_table(EMISSION_FACTORS_TABLE_NAME, ['category', 'activity']))
+        self.dynamodb.create_table(CALCULATOR_OUTPUT_TABLE_NAME, ['activity_event_id'])
+        self.dynamodb.create_table(CALCULATOR_CHECKPOINT_TABLE_NAME, ['object_key'])
+        # When retain_writes is False, written objects and items are only counted
+        self.retain_writes = retain_writes
+
+    def client(self, service_name, *args, **kwargs):
+        return {
+            's3': self.s3,
+            'dynamodb': self.dynamodb_client,
+            'secretsmanager': self.secretsmanager,
+            'redshift-data': self.redshift,
+            'lambda': self.lambda_,
+        }[service_name]
+
+    def resource(self, service_name, *args, **kwargs):
+        return {
+            'dynamodb': self.dynamodb,
+        }[service_name]
+
+    def environment(self):
+        return {
+            'EMISSIONS_FACTOR_TABLE_NAME': EMISSION_FACTORS_TABLE_NAME,
+            'CALCULATOR_OUTPUT_TABLE_NAME': CALCULATOR_OUTPUT_TABLE_NAME,
+            'CALCULATOR_CHECKPOINT_TABLE_NAME': CALCULATOR_CHECKPOINT_TABLE_NAME,
+            'TRANSFORMED_BUCKET_NAME': INPUT_BUCKET_NAME,
+            'OUTPUT_S3_BUCKET_NAME': OUTPUT_BUCKET_NAME,
+            'REDSHIFT_SECRET': REDSHIFT_SECRET,
+            'REDSHIFT_ROLE_ARN': 'arn:aws:iam::000000000000:role/local-redshift-role',
+        }
+
+
+def install(aws):
+    # Outside of pytest (see conftest.py): route boto3 to the stand-ins and configure the calculator
+    boto3.client = aws.client
+    boto3.resource = aws.resource
+    os.environ.update(aws.environment())
+    return aws
+
+
+def read_emission_factors_snapshot():
+    with open(EMISSION_FACTORS_SNAPSHOT) as snapshot:
+        return json.load(snapshot)
+
+
+def load_emission_factors(table):
+    # Same item layout as the one written by the CDK stack (see generateItem)
+    for emission_factor in read_emission_factors_snapshot():
+        ghg = emission_factor['emissions_factor_standards']['ghg']
+        coefficients = dict(ghg['coefficients'])
+        coefficients['AR4_kgco2e'] = coefficients.pop('AR4-kgco2e')
+        coefficients['AR5_kgco2e'] = coefficients.pop('AR5-kgco2e')
+        table.put_item(Item={
+            'category': emission_factor['category'],
+            'activity': emission_factor['activity'],
+            'scope': Decimal(emission_factor['scope']),
+            'emissions_factor_standards': {
+                'ghg': {
+                    'coefficients': coefficients,
+                    'last_updated': ghg['last_updated'],
+                    'source': ghg['source'],
+                    'source_origin': ghg['source_origin'],
+                }
+            }
+        })
+    table.items_written = 0
+    table.requests_count = 0
+
+
+# Activity_events of two emission factors of the snapshot, in scope 2 (no asset or timestamp) and 1
+QUEBEC_EVENT = {"scope": 2, "category": "grid-region-location-based", "activity": "Quebec", "raw_data": 453, "units": "kwH"}
+DIESEL_EVENT = {"asset_id": "vehicle-1", "origin_measurement_timestamp": "2022-06-26 02:31:29", "scope": 1, "category": "mobile-combustion",
+                "activity": "Diesel Fuel - Diesel Passenger Cars", "raw_data": 100, "units": "gal"}
+
+
+def activity_event(activity_event_id, template=DIESEL_EVENT, **fields):
+    # Fields of an activity_event, fields set to None are kept as null
+    activity_event = {"activity_event_id": activity_event_id}
+    activity_event.update(template)
+    activity_event.update(fields)
+    return activity_event
+
+
+class RejectedEvents:
+    # Stands for the dead letters of an object (full_calculator_lambda._DeadLetters): rejected activity_events are kept in a list
+    def __init__(self):
+        self.rejected = []
+
+    def add(self, error, activity_event, line_number=None):
+        self.rejected.append((error, activity_event, line_number))
+
+
+def enrich(calculator, activity_events, dead_letters=None):
+    # Fields of activity_events parsed and enriched as the lines of an object, without rollup
+    return calculator._append_emissions_batch([calculator._parse_activity_event(dict(fields)) for fields in activity_events], None,
+                                              dead_letters if dead_letters is not None else RejectedEvents())
+
+
+def add_events_object(aws, key, activity_events, bucket=INPUT_BUCKET_NAME):
+    # activity_events are fields, or lines written as is
+    lines = [line if isinstance(line, str) else json.dumps(line) for line in activity_events]
+    aws.s3.add_object(bucket, key, "\n".join(lines).encode('utf-8'))
+
+
+def read_output_object(aws, url):
+    # Body of an s3:// URL of the output bucket
+    return aws.s3.read_object(OUTPUT_BUCKET_NAME, url[len("s3://" + OUTPUT_BUCKET_NAME + "/"):])
+
+
+def read_csv_rows(aws, url):
+    return list(csv.reader(io.StringIO(read_output_object(aws, url).decode('utf-8'))))
+
+
+def read_manifest(aws, manifest_url):
+    return json.loads(read_output_object(aws, manifest_url))
+
+
+def read_manifest_rows(aws, manifest_url):
+    # Rows of the CSV objects listed in a manifest, in its order
+    return [row for entry in read_manifest(aws, manifest_url)['entries'] for row in read_csv_rows(aws, entry['url'])]
+
+
+def last_statement(aws):
+    return list(aws.redshift.statements.values())[-1]
+
+
+def redshift_database(calculator):
+    # SQLite database with the tables of the calculator, to run the statements of its loads (see run_load).
+    # The Redshift types give the columns a numeric affinity.
+    database = sqlite3.connect(':memory:')
+    database.create_function('DATE_TRUNC', 2, lambda unit, timestamp: timestamp[:7] + '-01' if timestamp else None)
+    for table, columns in [("calculated_emissions", calculator.REDSHIFT_COLUMNS), ("calculated_emissions_staging", calculator.REDSHIFT_COLUMNS),
+                           ("calculated_emissions_rollup", calculator.ROLLUP_COLUMNS), ("calculated_emissions_rollup_staging", calculator.ROLLUP_COLUMNS)]:
+        database.execute("CREATE TABLE " + table + " (" + ", ".join(name + " " + data_type for name, data_type in columns) + ")")
+    return database
+
+
+def _copy(database, table, rows, empty_as_null):
+    # As in Redshift, empty fields are loaded as NULL, except in text columns without EMPTYASNULL
+    text_columns = [data_type.lower() == "text" for _, _, data_type, *_ in database.execute("PRAGMA table_info(" + table + ")")]
+    rows = [[None if value == "" and (empty_as_null or not text) else value for value, text in zip(row, text_columns)] for row in rows]
+    if rows:
+        database.executemany("INSERT INTO " + table + " VALUES (" + ", ".join("?" * len(rows[0])) + ")", rows)
+
+
+def run_load(database, aws, statement):
+    # Runs the statements of a load on SQLite: temporary tables are emptied, and the COPY statements are replaced by
+    # inserts of the staged rows
+    for sql in statement['Sqls']:
+        if sql.startswith("CREATE TEMP TABLE"):
+            database.execute("DELETE FROM " + sql.split()[3])
+        elif sql.startswith("COPY"):
+            table, url = sql.split()[1], sql.split("'")[1]
+            _copy(database, table, read_manifest_rows(aws, url) if "MANIFEST" in sql else read_csv_rows(aws, url), "EMPTYASNULL" in sql)
+        else:
+            database.execute(sql)
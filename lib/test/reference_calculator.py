@@ -0,0 +1,24 @@
+# Scalar calculation of the emissions of an activity_event, one event and one emission factor lookup at a time, as the
+# calculator did before it calculated whole chunks at once. Kept as the reference of the batch calculation
+# (test_calculation_engine.py).
+
+
+def _calculate_emission(raw_data, factor):
+    return float(raw_data) * float(0 if factor == '' else factor) / 1000
+
+
+def append_emissions(calculator, activity_event):
+    # activity_event is the dict of its fields, its emissions_output is added with the emission factors of calculator
+    emissions_factor = calculator._get_emission_factors()[(activity_event['category'], activity_event['activity'])]
+    coefficients = emissions_factor['emissions_factor_standards']['ghg']['coefficients']
+
+    raw_data = activity_event['raw_data']
+    co2_emissions = _calculate_emission(raw_data, coefficients['co2_factor'])
+    ch4_emissions = _calculate_emission(raw_data, coefficients['ch4_factor'])
+    n2o_emissions = _calculate_emission(raw_data, coefficients['n2o_factor'])
+    co2e_emissions = calculator._calculate_co2e(co2_emissions, ch4_emissions, n2o_emissions)
+    co2e_ar4_emissions = calculator._calculate_co2e(co2_emissions, ch4_emissions, n2o_emissions, calculator.GWP_SETS['AR4'])
+    co2e_ar6_emissions = calculator._calculate_co2e(co2_emissions, ch4_emissions, n2o_emissions, calculator.GWP_SETS['AR6'])
+    activity_event['emissions_output'] = calculator._emissions_output(co2_emissions, ch4_emissions, n2o_emissions, co2e_emissions,
+                                                                      float(coefficients['AR5_kgco2e']), co2e_ar4_emissions, co2e_ar6_emissions)
+    return activity_event
@@ -0,0 +1,150 @@
+import csv
+import importlib
+import json
+import os
+import sys
+import pytest
+from local_aws import (INPUT_BUCKET_NAME, OUTPUT_BUCKET_NAME, EMISSION_FACTORS_SNAPSHOT, activity_event, add_events_object, last_statement,
+                       read_manifest, read_output_object, redshift_database, run_load)
+
+
+@pytest.fixture
+def backfill(calculator):
+    # Imported again with the calculator of the test
+    sys.modules.pop('backfill', None)
+    yield importlib.import_module('backfill')
+    sys.modules.pop('backfill', None)
+
+
+def _write_source(path, activity_events):
+    # Local file of activity_events, as add_events_object
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as source_file:
+        source_file.write("".join((line if isinstance(line, str) else json.dumps(line)) + "\n" for line in activity_events))
+
+
+def _state_records(output):
+    with open(os.path.join(output, "backfill-state.jsonl")) as state_file:
+        return [json.loads(line) for line in state_file]
+
+
+def test_local_backfill(backfill, tmp_path):
+    source, output = str(tmp_path / "source"), str(tmp_path / "output")
+    _write_source(os.path.join(source, "2021", "events-1.json"), [activity_event("backfill-%d" % index) for index in range(2500)])
+    _write_source(os.path.join(source, "2022", "events-2.json"), [activity_event("backfill-a"), "not json", activity_event("backfill-b", raw_data=50)])
+    assert backfill.main([source, output, '--workers', '2', '--emission-factors', EMISSION_FACTORS_SNAPSHOT]) == 0
+    with open(os.path.join(output, "2021", "events-1.json.csv")) as shard:
+        rows = list(csv.reader(shard))
+    assert len(rows) == 2500 and rows[0][0] == "backfill-0"
+    with open(os.path.join(output, "dead-letters", "2022", "events-2.json")) as dead_letters:
+        assert json.loads(dead_letters.read())['line_number'] == 2
+    with open(os.path.join(output, "manifest.json")) as manifest_file:
+        manifest = json.load(manifest_file)
+    assert [entry['url'] for entry in manifest['entries']] == [os.path.join(output, "2021", "events-1.json.csv"), os.path.join(output, "2022", "events-2.json.csv")]
+    assert manifest['entries'][1]['meta']['content_length'] == os.path.getsize(os.path.join(output, "2022", "events-2.json.csv"))
+    records = {record['source']: record for record in _state_records(output)}
+    assert records[os.path.join("2022", "events-2.json")]['events_count'] == 2 and records[os.path.join("2022", "events-2.json")]['rejected_count'] == 1
+    assert records[os.path.join("2022", "events-2.json")]['emission_factors_version'] == '2022-05-22'
+    assert not [name for _, _, names in os.walk(output) for name in names if name.endswith('.partial')]
+
+
+def test_backfill_is_resumed(backfill, tmp_path):
+    source, output = str(tmp_path / "source"), str(tmp_path / "output")
+    for index in range(3):
+        _write_source(os.path.join(source, "events-%d.json" % index), [activity_event("backfill-%d" % index)])
+    assert backfill.main([source, output, '--workers', '2', '--emission-factors', EMISSION_FACTORS_SNAPSHOT]) == 0
+    # Interrupted while writing the state of a file
+    with open(os.path.join(output, "backfill-state.jsonl"), 'a') as state_file:
+        state_file.write('{"source": "events-')
+    _write_source(os.path.join(source, "events-1.json"), [activity_event("backfill-1"), activity_event("backfill-1b")])
+    _write_source(os.path.join(source, "events-3.json"), [activity_event("backfill-3")])
+    assert backfill.main([source, output, '--workers', '2', '--emission-factors', EMISSION_FACTORS_SNAPSHOT]) == 0
+    records = [json.loads(line) for line in open(os.path.join(output, "backfill-state.jsonl")).read().splitlines()[4:]]
+    assert sorted(record['source'] for record in records) == ["events-1.json", "events-3.json"]
+    with open(os.path.join(output, "manifest.json")) as manifest_file:
+        assert len(json.load(manifest_file)['entries']) == 4
+
+
+def test_s3_file_is_backfilled_and_loaded(backfill, local_aws, tmp_path):
+    # Files of an S3 prefix are processed the same way, in the calling process here to use the local stand-ins
+    add_events_object(local_aws, "history/events-1.json", [activity_event("backfill-1"), activity_event("backfill-2")])
+    backfill._init_worker('csv.gz', EMISSION_FACTORS_SNAPSHOT)
+    output = "s3://" + OUTPUT_BUCKET_NAME + "/backfill"
+    [(relative_path, _, _)] = backfill._list_sources("s3://" + INPUT_BUCKET_NAME + "/history")
+    record = backfill._backfill_source("s3://" + INPUT_BUCKET_NAME + "/history", output, relative_path)
+    assert record['shard'] == "events-1.json.csv.gz" and record['events_count'] == 2
+    assert record['content_length'] == len(read_output_object(local_aws, output + "/events-1.json.csv.gz"))
+    load = backfill._load(output, [record])
+    assert load['status'] == 'FINISHED' and load['rollup_rows'] == 1
+    [statement] = local_aws.redshift.statements.values()
+    assert statement['Sqls'][1].startswith("COPY calculated_emissions_staging FROM 's3://" + OUTPUT_BUCKET_NAME + "/backfill/manifests/backfill-")
+    assert "GZIP" in statement['Sqls'][1]
+    manifest = read_manifest(local_aws, load['manifest'])
+    assert [entry['url'] for entry in manifest['entries']] == ["s3://" + OUTPUT_BUCKET_NAME + "/backfill/events-1.json.csv.gz"]
+
+
+def test_load_waits_for_the_copy(backfill, calculator, local_aws, monkeypatch):
+    # The Lambda function would report the COPY as still running after REDSHIFT_STATEMENT_TIMEOUT_SECONDS
+    monkeypatch.setattr(calculator, 'REDSHIFT_STATEMENT_TIMEOUT_SECONDS', 0)
+    monkeypatch.setattr(calculator.time, 'sleep', lambda seconds: None)
+    add_events_object(local_aws, "history/events-1.json", [activity_event("backfill-1")])
+    backfill._init_worker('csv', EMISSION_FACTORS_SNAPSHOT)
+    output = "s3://" + OUTPUT_BUCKET_NAME + "/backfill"
+    record = backfill._backfill_source("s3://" + INPUT_BUCKET_NAME + "/history", output, "events-1.json")
+    local_aws.redshift.statuses = ['SUBMITTED', 'STARTED', 'STARTED']
+    assert backfill._load(output, [record])['status'] == 'FINISHED'
+    assert local_aws.redshift.statuses == []
+
+
+def test_loads_replace_the_rows_already_loaded(backfill, local_aws, calculator, tmp_path):
+    database = redshift_database(calculator)
+    # Loaded by the Lambda function first
+    add_events_object(local_aws, "scope1-cleansed-data/events-1.json", [activity_event("backfill-1"), activity_event("backfill-2")])
+    calculator.lambda_handler({}, None)
+    run_load(database, local_aws, last_statement(local_aws))
+    add_events_object(local_aws, "history/events-1.json", [activity_event("backfill-1", raw_data=10), activity_event("backfill-2", raw_data=10)])
+    backfill._init_worker('csv', EMISSION_FACTORS_SNAPSHOT)
+    output = "s3://" + OUTPUT_BUCKET_NAME + "/backfill"
+    record = backfill._backfill_source("s3://" + INPUT_BUCKET_NAME + "/history", output, "events-1.json")
+    for _ in range(2):
+        backfill._load(output, [record])
+        run_load(database, local_aws, last_statement(local_aws))
+    assert database.execute("SELECT activity_event_id, raw_data FROM calculated_emissions ORDER BY 1").fetchall() == [("backfill-1", 10), ("backfill-2", 10)]
+    assert database.execute("SELECT events_count, raw_data FROM calculated_emissions_rollup").fetchall() == [(2, 20.0)]
+
+
+def test_large_file_is_split_across_processes(backfill, tmp_path):
+    source, output = str(tmp_path / "source"), str(tmp_path / "output")
+    _write_source(os.path.join(source, "events-1.json"), [activity_event("backfill-%d" % index) for index in range(300)])
+    _write_source(os.path.join(source, "events-2.json"), [activity_event("backfill-small")])
+    assert backfill.main([source, output, '--workers', '2', '--split-size', '8192', '--emission-factors', EMISSION_FACTORS_SNAPSHOT]) == 0
+    records = {record['source']: record for record in _state_records(output)}
+    parts = records["events-1.json"]['parts']
+    assert len(parts) > 2 and parts[0]['shard'] == "events-1.json.part-00001.csv" and records["events-1.json"]['events_count'] == 300
+    assert sum(row[5] for row in records["events-1.json"]['rollup']) == 300
+    with open(os.path.join(output, "manifest.json")) as manifest_file:
+        urls = [entry['url'] for entry in json.load(manifest_file)['entries']]
+    assert urls == [os.path.join(output, part['shard']) for part in parts] + [os.path.join(output, "events-2.json.csv")]
+    rows = []
+    for url in urls[:-1]:
+        with open(url) as shard:
+            rows += list(csv.reader(shard))
+    assert [row[0] for row in rows] == ["backfill-%d" % index for index in range(300)]
+    # Completed, the file is not processed again
+    assert backfill.main([source, output, '--workers', '2', '--split-size', '8192', '--emission-factors', EMISSION_FACTORS_SNAPSHOT]) == 0
+    assert len(_state_records(output)) == 2
+
+
+def test_files_differing_by_extension_have_their_own_shards(backfill, tmp_path):
+    source, output = str(tmp_path / "source"), str(tmp_path / "output")
+    for name in ["events", "events.json", "events.ndjson"]:
+        _write_source(os.path.join(source, name), [activity_event(name + "-%d" % index) for index in range(300)])
+    assert backfill.main([source, output, '--workers', '2', '--split-size', '8192', '--emission-factors', EMISSION_FACTORS_SNAPSHOT]) == 0
+    with open(os.path.join(output, "manifest.json")) as manifest_file:
+        urls = [entry['url'] for entry in json.load(manifest_file)['entries']]
+    assert len(set(urls)) == len(urls) > 6
+    rows = []
+    for url in urls:
+        with open(url) as shard:
+            rows += list(csv.reader(shard))
+    assert sorted(row[0] for row in rows) == sorted(name + "-%d" % index for name in ["events", "events.json", "events.ndjson"] for index in range(300))
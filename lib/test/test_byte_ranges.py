@@ -0,0 +1,119 @@
+import json
+import boto3
+from local_aws import (INPUT_BUCKET_NAME, OUTPUT_BUCKET_NAME, CALCULATOR_OUTPUT_TABLE_NAME, CALCULATOR_CHECKPOINT_TABLE_NAME,
+                       activity_event, add_events_object, last_statement, read_csv_rows, read_manifest, read_manifest_rows)
+
+OBJECT_KEY = "scope1-cleansed-data/large.json"
+# 200 activity_events, with a line that is not JSON in the middle
+OBJECT_LINES = [activity_event("large-%d" % index, asset_id="vehicle-%d" % (index % 3), raw_data=index) for index in range(200)]
+OBJECT_LINES.insert(100, "not json")
+
+
+def _loaded_rows(local_aws):
+    # URLs and rows of the staged objects listed in the manifest of the last load
+    manifest_url = last_statement(local_aws)['Sqls'][0].split("'")[1]
+    return [entry['url'] for entry in read_manifest(local_aws, manifest_url)['entries']], read_manifest_rows(local_aws, manifest_url)
+
+
+def test_plan_byte_ranges(calculator, monkeypatch):
+    monkeypatch.setattr(calculator, 'BYTE_RANGE_PROBE_SIZE', 4)
+    body = b"a\nbb\n" + b"c" * 30 + b"\nddd\neeee\n\nf"
+    byte_ranges = calculator._plan_byte_ranges(len(body), 5, lambda start, end: body[start:end])
+    # Contiguous ranges of whole lines, the long line is a range of its own
+    assert byte_ranges == [(0, 5), (5, 36), (36, 45), (45, 47)]
+    assert calculator._plan_byte_ranges(len(body), 100, lambda start, end: body[start:end]) == [(0, len(body))]
+
+
+def test_large_object_is_split_in_parts(local_aws, calculator, monkeypatch):
+    monkeypatch.setattr(calculator, 'BYTE_RANGE_SPLIT_SIZE', 8 * 1024)
+    add_events_object(local_aws, OBJECT_KEY, OBJECT_LINES)
+    result = calculator.lambda_handler({}, None)
+    assert result['errors'] == [] and result['objects_count'] == 1
+    assert result['events_count'] == 200 and result['rejected_count'] == 1
+    urls, rows = _loaded_rows(local_aws)
+    assert len(urls) > 2 and urls[1] == "s3://" + OUTPUT_BUCKET_NAME + "/scope1-cleansed-data/large.json.part-00002.csv"
+    assert [row[0] for row in rows] == ["large-%d" % index for index in range(200)]
+    assert len(local_aws.dynamodb.Table(CALCULATOR_OUTPUT_TABLE_NAME).items) == 200
+    # The rollup of the parts is loaded in one piece
+    rollup = read_csv_rows(local_aws, last_statement(local_aws)['Sqls'][2].split("'")[1])
+    assert sum(int(row[5]) for row in rollup) == 200 and sum(float(row[6]) for row in rollup) == sum(range(200))
+    checkpoint = local_aws.dynamodb.Table(CALCULATOR_CHECKPOINT_TABLE_NAME).items[(OBJECT_KEY,)]
+    assert checkpoint['status'] == 'loaded' and checkpoint['events_count'] == 200 and checkpoint['rejected_count'] == 1
+    [dead_letters_key] = [key for (bucket, key) in local_aws.s3.objects if key.startswith("dead-letters/")]
+    dead_letter = json.loads(local_aws.s3.read_object(OUTPUT_BUCKET_NAME, dead_letters_key))
+    assert dead_letters_key.startswith("dead-letters/scope1-cleansed-data/large.json.part-") and dead_letter['object_key'] == OBJECT_KEY
+    body = local_aws.s3.read_object(INPUT_BUCKET_NAME, OBJECT_KEY)
+    start, end = dead_letter['byte_range']
+    assert body[start:end].split(b"\n")[dead_letter['line_number'] - 1] == b"not json"
+
+
+def test_objects_differing_by_extension_have_their_own_keys(local_aws, calculator, monkeypatch):
+    monkeypatch.setattr(calculator, 'BYTE_RANGE_SPLIT_SIZE', 8 * 1024)
+    keys = ["scope1-cleansed-data/large", "scope1-cleansed-data/large.json", "scope1-cleansed-data/large.ndjson"]
+    for key in keys:
+        add_events_object(local_aws, key, [activity_event("%s-%d" % (key, index), raw_data=index) for index in range(200)] + ["not json"])
+    result = calculator.lambda_handler({}, None)
+    assert result['errors'] == [] and result['objects_count'] == 3 and result['events_count'] == 600
+    urls, rows = _loaded_rows(local_aws)
+    assert len(set(urls)) == len(urls) > 6 and urls[0] == "s3://" + OUTPUT_BUCKET_NAME + "/scope1-cleansed-data/large.part-00001.csv"
+    assert sorted(row[0] for row in rows) == sorted("%s-%d" % (key, index) for key in keys for index in range(200))
+    dead_letters_keys = [key for (bucket, key) in local_aws.s3.objects if key.startswith("dead-letters/")]
+    assert sorted(key.rsplit(".part-", 1)[0] for key in dead_letters_keys) == ["dead-letters/" + key for key in keys]
+
+
+def test_parts_are_processed_by_worker_invocations(local_aws, calculator, monkeypatch):
+    monkeypatch.setattr(calculator, 'BYTE_RANGE_SPLIT_SIZE', 8 * 1024)
+    monkeypatch.setattr(calculator, 'BYTE_RANGE_WORKER_FUNCTION', 'local-byte-range-worker')
+    responses = []
+
+    def byte_range_handler(event, context):
+        responses.append(calculator.byte_range_handler(event, context))
+        return responses[-1]
+
+    local_aws.lambda_.functions['local-byte-range-worker'] = byte_range_handler
+    add_events_object(local_aws, OBJECT_KEY, OBJECT_LINES)
+    result = calculator.lambda_handler({}, None)
+    assert result['errors'] == [] and result['events_count'] == 200
+    urls, rows = _loaded_rows(local_aws)
+    assert local_aws.lambda_.invocations == len(urls) > 2
+    assert [row[0] for row in rows] == ["large-%d" % index for index in range(200)]
+    # The staged parts are passed through S3, and deleted once read
+    assert all(list(response) == ["staged_part_key"] for response in responses)
+    assert sorted(response['staged_part_key'] for response in responses) == [
+        "scope1-cleansed-data/large.json.part-%05d.staged-part.json" % number for number in range(1, len(urls) + 1)]
+    assert not [key for (bucket, key) in local_aws.s3.objects if key.endswith(".staged-part.json")]
+    rollup = read_csv_rows(local_aws, last_statement(local_aws)['Sqls'][2].split("'")[1])
+    assert sum(int(row[5]) for row in rollup) == 200 and sum(float(row[6]) for row in rollup) == sum(range(200))
+
+
+def test_worker_invocations_are_not_retried(local_aws, calculator, monkeypatch):
+    # A retried invocation would process the part again while the first one still runs
+    options = {}
+
+    def client(service_name, **kwargs):
+        options[service_name] = kwargs
+        return local_aws.client(service_name)
+
+    monkeypatch.setattr(boto3, 'client', client)
+    calculator._client('lambda')
+    assert options['lambda']['config'].retries == {'max_attempts': 0}
+    assert options['lambda']['config'].read_timeout == 900
+
+
+def test_object_fails_with_any_of_its_parts(local_aws, calculator, monkeypatch):
+    monkeypatch.setattr(calculator, 'BYTE_RANGE_SPLIT_SIZE', 8 * 1024)
+    monkeypatch.setattr(calculator, 'BYTE_RANGE_WORKER_FUNCTION', 'local-byte-range-worker')
+
+    def byte_range_handler(event, context):
+        if event['part']['number'] == 2:
+            # The object is overwritten after its split
+            local_aws.s3.add_object(INPUT_BUCKET_NAME, OBJECT_KEY, b"")
+        return calculator.byte_range_handler(event, context)
+
+    local_aws.lambda_.functions['local-byte-range-worker'] = byte_range_handler
+    monkeypatch.setattr(calculator, 'BYTE_RANGE_WORKER_CONCURRENCY', 1)
+    add_events_object(local_aws, OBJECT_KEY, OBJECT_LINES)
+    result = calculator.lambda_handler({}, None)
+    assert [error['object_key'] for error in result['errors']] == [OBJECT_KEY] and "PreconditionFailed" in result['errors'][0]['error']
+    assert result['objects_count'] == 0 and result['load'] is None
+    assert (OBJECT_KEY,) not in local_aws.dynamodb.Table(CALCULATOR_CHECKPOINT_TABLE_NAME).items
@@ -0,0 +1,63 @@
+import copy
+import math
+import pytest
+from local_aws import RejectedEvents, enrich, read_emission_factors_snapshot
+from reference_calculator import append_emissions
+
+
+def _activity_events():
+    activity_events = []
+    for index, emission_factor in enumerate(read_emission_factors_snapshot()):
+        for raw_data in [0, 1, 103.45, "13.5", 1e6 + index]:
+            activity_events.append({
+                "activity_event_id": "engine-%d-%s" % (index, raw_data),
+                "scope": int(emission_factor['scope']),
+                "category": emission_factor['category'],
+                "activity": emission_factor['activity'],
+                "raw_data": raw_data,
+                "units": emission_factor['emissions_factor_standards']['ghg']['coefficients']['units'],
+            })
+    return activity_events
+
+
+def _assert_same_emissions(batch_events, scalar_events):
+    assert len(batch_events) == len(scalar_events)
+    for batch_event, scalar_event in zip(batch_events, scalar_events):
+        scalar_output = scalar_event['emissions_output']
+        for gas in ['co2', 'ch4', 'n2o', 'co2e', 'co2e_ar4', 'co2e_ar6']:
+            assert math.isclose(getattr(batch_event, gas), scalar_output['calculated_emissions'][gas]['amount'], rel_tol=1e-12)
+        assert batch_event.emissions_factor == scalar_output['emissions_factor']['amount']
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_batch_matches_scalar_calculation(calculator, monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(calculator, 'numpy_missing', True)
+    activity_events = _activity_events()
+    scalar_events = [append_emissions(calculator, activity_event) for activity_event in copy.deepcopy(activity_events)]
+    batch_events = enrich(calculator, activity_events)
+    _assert_same_emissions(batch_events, scalar_events)
+
+
+def test_batch_calculation_of_scope1_event(calculator):
+    activity_event = {"activity_event_id": "test-1", "scope": 1, "category": "mobile-combustion", "activity": "Diesel Fuel - Diesel Passenger Cars", "raw_data": 103.45, "units": "gal"}
+    emissions_output = calculator._dynamodb_item_fields(enrich(calculator, [activity_event])[0])['emissions_output']
+    assert math.isclose(emissions_output['calculated_emissions']['co2']['amount'], 1.0562245000000001, rel_tol=1e-9)
+    assert math.isclose(emissions_output['calculated_emissions']['ch4']['amount'], 1.1638125e-06, rel_tol=1e-9)
+    assert math.isclose(emissions_output['calculated_emissions']['n2o']['amount'], 2.327625e-06, rel_tol=1e-9)
+    assert math.isclose(emissions_output['calculated_emissions']['co2e']['amount'], 1.056873907375, rel_tol=1e-9)
+    assert emissions_output['emissions_factor']['amount'] == 10.2162775
+    assert math.isclose(emissions_output['calculated_emissions']['co2e_ar4']['amount'], 1.0569472275625, rel_tol=1e-9)
+    # 1.0562245 tonnes of CO2 + 27.9 * 1.1638125e-06 tonnes of CH4 + 273 * 2.327625e-06 tonnes of N2O
+    assert math.isclose(emissions_output['calculated_emissions']['co2e_ar6']['amount'], 1.05689241199375, rel_tol=1e-9)
+
+
+def test_batch_calculation_of_unknown_activity(calculator):
+    dead_letters = RejectedEvents()
+    unknown = {"activity_event_id": "unknown", "scope": 1, "category": "mobile-combustion", "activity": "Unknown", "raw_data": 1, "units": "gal"}
+    known = dict(unknown, activity_event_id="known", activity="Diesel Fuel - Diesel Passenger Cars")
+    assert [activity_event.activity_event_id for activity_event in enrich(calculator, [unknown, known], dead_letters)] == ["known"]
+    [(error, fields, _)] = dead_letters.rejected
+    assert isinstance(error, KeyError) and fields == unknown
@@ -0,0 +1,67 @@
+from local_aws import CALCULATOR_CHECKPOINT_TABLE_NAME, QUEBEC_EVENT, activity_event, add_events_object
+
+
+OBJECT_KEY = "scope2-bill-extracted-data/checkpoint-%04d.json"
+
+
+def _activity_events(index, raw_data=453):
+    return [activity_event("checkpoint-%d" % index, QUEBEC_EVENT, raw_data=raw_data)]
+
+
+def test_all_pages_are_listed(local_aws, calculator, monkeypatch):
+    monkeypatch.setattr(calculator, 'MAX_CONCURRENT_OBJECTS', 16)
+    for index in range(1005):
+        add_events_object(local_aws, OBJECT_KEY % index, _activity_events(index))
+    result = calculator.lambda_handler({}, None)
+    assert result['objects_count'] == 1005
+    assert len(local_aws.dynamodb.Table(CALCULATOR_CHECKPOINT_TABLE_NAME).items) == 1005
+
+
+def test_only_new_or_changed_objects_are_processed(local_aws, calculator):
+    for index in range(3):
+        add_events_object(local_aws, OBJECT_KEY % index, _activity_events(index))
+    assert calculator.lambda_handler({}, None)['objects_count'] == 3
+    assert calculator.lambda_handler({}, None) == {'objects_count': 0, 'events_count': 0, 'rejected_count': 0, 'errors': [], 'load': None}
+    add_events_object(local_aws, OBJECT_KEY % 1, _activity_events(1, raw_data=454))
+    add_events_object(local_aws, OBJECT_KEY % 3, _activity_events(3))
+    result = calculator.lambda_handler({}, None)
+    assert result['objects_count'] == 2
+    assert len(local_aws.redshift.statements) == 2
+
+
+def test_failed_objects_are_processed_again(local_aws, calculator):
+    for index in range(2):
+        add_events_object(local_aws, OBJECT_KEY % index, _activity_events(index))
+    local_aws.s3.failing_keys.add(OBJECT_KEY % 1)
+    assert len(calculator.lambda_handler({}, None)['errors']) == 1
+    local_aws.s3.failing_keys.clear()
+    result = calculator.lambda_handler({}, None)
+    assert result['objects_count'] == 1 and result['errors'] == []
+
+
+def test_pending_copy_is_checked_by_next_invocation(local_aws, calculator, monkeypatch):
+    monkeypatch.setattr(calculator, 'REDSHIFT_STATEMENT_TIMEOUT_SECONDS', 0)
+    checkpoints = local_aws.dynamodb.Table(CALCULATOR_CHECKPOINT_TABLE_NAME)
+    for index in range(2):
+        add_events_object(local_aws, OBJECT_KEY % index, _activity_events(index))
+    local_aws.redshift.statuses = ['STARTED']
+    load = calculator.lambda_handler({}, None)['load']
+    assert {checkpoint['status'] for checkpoint in checkpoints.items.values()} == {'staged'}
+    assert {checkpoint['statement_id'] for checkpoint in checkpoints.items.values()} == {load['statement_id']}
+    # Still running: the objects are not processed again
+    local_aws.redshift.statuses = ['STARTED']
+    assert calculator.lambda_handler({}, None)['objects_count'] == 0
+    # Finished: the checkpoints are updated
+    local_aws.redshift.statuses = ['FINISHED']
+    assert calculator.lambda_handler({}, None)['objects_count'] == 0
+    assert {checkpoint['status'] for checkpoint in checkpoints.items.values()} == {'loaded'}
+
+
+def test_failed_copy_is_processed_again(local_aws, calculator, monkeypatch):
+    monkeypatch.setattr(calculator, 'REDSHIFT_STATEMENT_TIMEOUT_SECONDS', 0)
+    for index in range(2):
+        add_events_object(local_aws, OBJECT_KEY % index, _activity_events(index))
+    local_aws.redshift.statuses = ['STARTED']
+    calculator.lambda_handler({}, None)
+    local_aws.redshift.statuses = ['FAILED']
+    assert calculator.lambda_handler({}, None)['objects_count'] == 2
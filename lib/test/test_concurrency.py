@@ -0,0 +1,35 @@
+from local_aws import OUTPUT_BUCKET_NAME, CALCULATOR_OUTPUT_TABLE_NAME, QUEBEC_EVENT, activity_event, add_events_object, read_manifest
+
+
+OBJECT_KEY = "scope2-bill-extracted-data/concurrency-%02d.json"
+
+
+def _activity_events(index):
+    return [activity_event("concurrency-%d" % index, QUEBEC_EVENT, raw_data=453 + index)]
+
+
+def test_objects_are_processed_concurrently(local_aws, calculator, monkeypatch):
+    monkeypatch.setattr(calculator, 'MAX_CONCURRENT_OBJECTS', 8)
+    local_aws.s3.latency = 0.05
+    for index in range(20):
+        add_events_object(local_aws, OBJECT_KEY % index, _activity_events(index))
+    result = calculator.lambda_handler({}, None)
+    assert result['objects_count'] == 20 and result['errors'] == []
+    assert local_aws.s3.max_reads_in_flight == 8
+    assert len(local_aws.dynamodb.Table(CALCULATOR_OUTPUT_TABLE_NAME).items) == 20
+    # Manifest entries keep the order of the listed objects
+    manifest = read_manifest(local_aws, result['load']['manifest'])
+    assert [entry['url'] for entry in manifest['entries']] == ["s3://" + OUTPUT_BUCKET_NAME + "/" + OBJECT_KEY % index + ".csv" for index in range(20)]
+
+
+def test_errors_are_collected_per_object(local_aws, calculator):
+    for index in range(3):
+        add_events_object(local_aws, OBJECT_KEY % index, _activity_events(index))
+    local_aws.s3.failing_keys.add(OBJECT_KEY % 1)
+    result = calculator.lambda_handler({}, None)
+    assert result['objects_count'] == 2
+    assert [error['object_key'] for error in result['errors']] == [OBJECT_KEY % 1]
+    assert "AccessDenied" in result['errors'][0]['error']
+    assert result['load']['status'] == 'FINISHED'
+    manifest = read_manifest(local_aws, result['load']['manifest'])
+    assert len(manifest['entries']) == 2
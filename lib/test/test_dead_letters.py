@@ -0,0 +1,61 @@
+import json
+import pytest
+from local_aws import OUTPUT_BUCKET_NAME, CALCULATOR_OUTPUT_TABLE_NAME, CALCULATOR_CHECKPOINT_TABLE_NAME, activity_event, add_events_object
+
+
+def _activity_event(activity_event_id, **fields):
+    # Lines of the object
+    return json.dumps(activity_event(activity_event_id, **dict({"geo": "[30.14392,-97.59394]"}, **fields)))
+
+
+def _dead_letters(local_aws, object_key):
+    return [json.loads(line) for line in local_aws.s3.read_object(OUTPUT_BUCKET_NAME, "dead-letters/" + object_key).decode('utf-8').splitlines()]
+
+
+def test_invalid_events_are_dead_lettered(local_aws, calculator):
+    lines = [
+        _activity_event("valid-1"),
+        '{"activity_event_id": "truncated-1", "scope": 1',
+        _activity_event("no-units-1", units=None),
+        _activity_event("raw-data-1", raw_data="n/a"),
+        _activity_event("geo-1", geo="[30.14392]"),
+        _activity_event("timestamp-1", origin_measurement_timestamp="26/06/2022"),
+        "",
+        _activity_event("unknown-1", activity="Atlantis"),
+        _activity_event("valid-2", raw_data="13.5", scope="1"),
+        # Too large for a float, and nested too deeply for the JSON decoder
+        _activity_event("overflow-1", raw_data=10 ** 400),
+        "[" * 100000 + "]" * 100000,
+    ]
+    add_events_object(local_aws, "scope1-cleansed-data/dead-letters.json", lines)
+    result = calculator.lambda_handler({}, None)
+    assert result['errors'] == [] and result['events_count'] == 2 and result['rejected_count'] == 8
+    assert set(local_aws.dynamodb.Table(CALCULATOR_OUTPUT_TABLE_NAME).items) == {("valid-1",), ("valid-2",)}
+    dead_letters = _dead_letters(local_aws, "scope1-cleansed-data/dead-letters.json")
+    # Activity_events without emissions factor are rejected after the parse, at the end of their chunk
+    assert [dead_letter['line_number'] for dead_letter in dead_letters] == [2, 3, 4, 5, 6, 10, 11, 8]
+    assert "units" in dead_letters[1]['error'] and "raw_data" in dead_letters[2]['error'] and "Atlantis" in dead_letters[7]['error']
+    assert dead_letters[0]['activity_event'] == lines[1]
+    assert "raw_data" in dead_letters[5]['error'] and "recursion" in dead_letters[6]['error']
+    assert dead_letters[7]['activity_event']['activity_event_id'] == "unknown-1"
+    checkpoint = local_aws.dynamodb.Table(CALCULATOR_CHECKPOINT_TABLE_NAME).items[("scope1-cleansed-data/dead-letters.json",)]
+    assert checkpoint['events_count'] == 2 and checkpoint['rejected_count'] == 8
+
+
+def test_object_with_only_rejected_events(local_aws, calculator):
+    add_events_object(local_aws, "scope1-cleansed-data/dead-letters.json", [activity_event("unknown-1", activity="Atlantis")])
+    result = calculator.lambda_handler({}, None)
+    assert result['objects_count'] == 1 and result['rejected_count'] == 1 and result['load'] is None
+    assert len(_dead_letters(local_aws, "scope1-cleansed-data/dead-letters.json")) == 1
+
+
+def test_events_are_parsed_once(calculator):
+    activity_event = calculator._parse_activity_event(json.loads(_activity_event("parsed-1", raw_data="13.5", scope="2", supplier={"name": "fleet"})))
+    assert activity_event.raw_data == 13.5 and activity_event.scope == 2
+    assert (activity_event.geo_lat, activity_event.geo_lon) == (30.14392, -97.59394)
+    assert calculator._activity_event_fields(activity_event)['supplier'] == {"name": "fleet"}
+    with pytest.raises(AttributeError):
+        activity_event.emissions_output = {}
+    for fields in [{"raw_data": float('nan')}, {"raw_data": True}, {"raw_data": 10 ** 400}, {"scope": 1.5}, {"geo": "[91, 0]"}, {"category": ""}]:
+        with pytest.raises(ValueError):
+            calculator._parse_activity_event(json.loads(_activity_event("invalid-1", **fields)))
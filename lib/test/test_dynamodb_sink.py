@@ -0,0 +1,45 @@
+import json
+import pytest
+from decimal import Decimal
+from local_aws import CALCULATOR_OUTPUT_TABLE_NAME, activity_event, enrich
+
+
+def _activity_events(calculator, count, ids_count=60):
+    return enrich(calculator, [activity_event("sink-%d" % (index % ids_count), raw_data=0.1 + index, supplier={"name": "fleet", "ids": [index, True, None]}) for index in range(count)])
+
+
+def test_items_are_the_same_as_with_the_json_round_trip(local_aws, calculator):
+    activity_events = _activity_events(calculator, 60)
+    metrics = calculator._save_enriched_events_to_dynamodb(activity_events)
+    assert metrics['items'] == 60 and metrics['batches'] == 3 and metrics['requests'] == 3
+    items = local_aws.dynamodb.Table(CALCULATOR_OUTPUT_TABLE_NAME).items
+    for activity_event in activity_events:
+        assert items[(activity_event.activity_event_id,)] == json.loads(json.dumps(calculator._dynamodb_item_fields(activity_event)), parse_float=Decimal)
+
+
+def test_last_event_wins_for_duplicated_ids(local_aws, calculator):
+    metrics = calculator._save_enriched_events_to_dynamodb(_activity_events(calculator, 100))
+    assert metrics['items'] == 60
+    assert local_aws.dynamodb.Table(CALCULATOR_OUTPUT_TABLE_NAME).items[("sink-0",)]['raw_data'] == Decimal(repr(0.1 + 60))
+
+
+def test_batches_are_written_in_parallel(local_aws, calculator, monkeypatch):
+    local_aws.dynamodb.latency = 0.02
+    calculator._save_enriched_events_to_dynamodb(_activity_events(calculator, 1000, ids_count=1000))
+    assert local_aws.dynamodb_client.max_writes_in_flight == calculator.DYNAMODB_WRITE_CONCURRENCY
+    assert len(local_aws.dynamodb.Table(CALCULATOR_OUTPUT_TABLE_NAME).items) == 1000
+
+
+def test_unprocessed_items_are_retried(local_aws, calculator, monkeypatch):
+    monkeypatch.setattr(calculator, 'DYNAMODB_WRITE_BASE_BACKOFF_SECONDS', 0.001)
+    local_aws.dynamodb_client.unprocessed_batches = 3
+    metrics = calculator._save_enriched_events_to_dynamodb(_activity_events(calculator, 25))
+    assert metrics['requests'] == 4
+    assert len(local_aws.dynamodb.Table(CALCULATOR_OUTPUT_TABLE_NAME).items) == 25
+
+
+def test_writes_fail_when_items_stay_unprocessed(local_aws, calculator, monkeypatch):
+    monkeypatch.setattr(calculator, 'DYNAMODB_WRITE_BASE_BACKOFF_SECONDS', 0.001)
+    local_aws.dynamodb_client.unprocessed_batches = calculator.DYNAMODB_WRITE_MAX_ATTEMPTS
+    with pytest.raises(RuntimeError, match="unprocessed"):
+        calculator._save_enriched_events_to_dynamodb(_activity_events(calculator, 25))
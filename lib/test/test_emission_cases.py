@@ -0,0 +1,24 @@
+import math
+import pytest
+from emission_cases import EMISSION_CASES
+from local_aws import INPUT_BUCKET_NAME, CALCULATOR_OUTPUT_TABLE_NAME
+
+
+@pytest.mark.parametrize('events_objects', EMISSION_CASES)
+def test_emission_cases(local_aws, calculator, events_objects):
+    # Same cases as the end-to-end test, checked in the DynamoDB output instead of Redshift
+    for events_object in events_objects:
+        local_aws.s3.add_object(INPUT_BUCKET_NAME, events_object['key'], events_object['body'])
+    result = calculator.lambda_handler({}, None)
+    assert result['errors'] == []
+    output_table = local_aws.dynamodb.Table(CALCULATOR_OUTPUT_TABLE_NAME)
+    for events_object in events_objects:
+        for expected in events_object['expected']:
+            emissions_output = output_table.items[(expected.activity_event_id,)]['emissions_output']
+            calculated_emissions = emissions_output['calculated_emissions']
+            assert math.isclose(calculated_emissions['co2']['amount'], expected.co2, rel_tol=1e-5)
+            assert math.isclose(calculated_emissions['ch4']['amount'], expected.ch4, rel_tol=1e-5)
+            assert math.isclose(calculated_emissions['n2o']['amount'], expected.n2o, rel_tol=1e-5)
+            assert math.isclose(calculated_emissions['co2e']['amount'], expected.co2e_ar5, rel_tol=1e-5)
+            assert math.isclose(calculated_emissions['co2e_ar4']['amount'], expected.co2e_ar4, rel_tol=1e-5)
+            assert math.isclose(emissions_output['emissions_factor']['amount'], expected.emissions_factor_ar5, rel_tol=1e-5)
@@ -0,0 +1,42 @@
+from local_aws import EMISSION_FACTORS_SNAPSHOT, EMISSION_FACTORS_TABLE_NAME, read_emission_factors_snapshot
+
+
+def test_factors_are_loaded_once(local_aws, calculator):
+    table = local_aws.dynamodb.Table(EMISSION_FACTORS_TABLE_NAME)
+    for emission_factor in read_emission_factors_snapshot():
+        assert calculator._get_emission_factors()[(emission_factor['category'], emission_factor['activity'])]['scope'] == int(emission_factor['scope'])
+    # 236 factors in pages of 100 items
+    assert table.requests_count == 3
+    assert calculator.emission_factors_cache_state['version'] == '2022-05-22'
+
+
+def test_lookup_uses_category_and_activity_in_order(local_aws, calculator):
+    table = local_aws.dynamodb.Table(EMISSION_FACTORS_TABLE_NAME)
+    table.put_item(Item={'category': 'a', 'activity': 'b', 'emissions_factor_standards': {'ghg': {'last_updated': '2022-05-22'}}})
+    table.put_item(Item={'category': 'b', 'activity': 'a', 'emissions_factor_standards': {'ghg': {'last_updated': '2022-05-22'}}})
+    assert calculator._get_emission_factors()[('a', 'b')]['category'] == 'a'
+    assert calculator._get_emission_factors()[('b', 'a')]['category'] == 'b'
+    assert ('Quebec', 'Quebec') not in calculator._get_emission_factors()
+
+
+def test_factors_are_reloaded_after_ttl(local_aws, calculator, monkeypatch):
+    table = local_aws.dynamodb.Table(EMISSION_FACTORS_TABLE_NAME)
+    factors = calculator._get_emission_factors()
+    monkeypatch.setattr(calculator, 'EMISSION_FACTORS_CACHE_TTL_SECONDS', 0)
+    # Same version: the cached index is kept
+    assert calculator._get_emission_factors() is factors
+    updated_factor = dict(table.get_item(Key={'category': 'grid-region-location-based', 'activity': 'Quebec'})['Item'])
+    updated_factor['emissions_factor_standards'] = {'ghg': {'coefficients': {}, 'last_updated': '2023-01-01'}}
+    table.put_item(Item=updated_factor)
+    assert calculator._get_emission_factors()[('grid-region-location-based', 'Quebec')] == updated_factor
+    assert calculator.emission_factors_cache_state['version'] == '2023-01-01'
+
+
+def test_factors_from_snapshot(local_aws, calculator, monkeypatch):
+    scanned_factors = calculator._get_emission_factors()
+    monkeypatch.setattr(calculator, 'EMISSION_FACTORS_SNAPSHOT_PATH', EMISSION_FACTORS_SNAPSHOT)
+    version, index = calculator._load_emission_factors()
+    assert version == '2022-05-22'
+    assert index.keys() == scanned_factors.keys()
+    for key, emission_factor in index.items():
+        assert emission_factor['emissions_factor_standards']['ghg']['coefficients'] == scanned_factors[key]['emissions_factor_standards']['ghg']['coefficients']
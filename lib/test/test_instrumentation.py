@@ -0,0 +1,72 @@
+import json
+import logging
+import time
+import timeit
+from local_aws import QUEBEC_EVENT, activity_event, add_events_object
+
+
+OBJECT_KEY = "scope2-bill-extracted-data/metrics.json"
+
+
+def _activity_events(events_count):
+    return [activity_event("metrics-%d" % index, QUEBEC_EVENT, raw_data=453 + index) for index in range(events_count)]
+
+
+def _emf_lines(output):
+    return [json.loads(line) for line in output.splitlines() if line.startswith('{"') and '"_aws"' in line]
+
+
+def test_metrics_are_logged_as_emf(local_aws, calculator, monkeypatch, capsys):
+    monkeypatch.setattr(calculator, 'EVENTS_CHUNK_SIZE', 100)
+    add_events_object(local_aws, OBJECT_KEY, _activity_events(250))
+    calculator.lambda_handler({}, None)
+    [emf] = _emf_lines(capsys.readouterr().out)
+    [directive] = emf['_aws']['CloudWatchMetrics']
+    assert directive['Namespace'] == 'CarbonCalculator' and directive['Dimensions'] == [['FunctionName']]
+    units = {metric['Name']: metric['Unit'] for metric in directive['Metrics']}
+    for name in ['ListTime', 'CheckpointsTime', 'ReadTime', 'EnrichTime', 'FactorLookupTime', 'RedshiftStagingTime', 'DynamoDBWriteTime', 'RedshiftLoadTime', 'InvocationTime']:
+        assert units[name] == 'Milliseconds' and emf[name] >= 0
+    assert units['StagedBytes'] == 'Bytes' and emf['StagedBytes'] > 0
+    assert emf['EventsProcessed'] == 250 and emf['DynamoDBItemsWritten'] == 250 and emf['ObjectsProcessed'] == 1
+    # The emission factors are loaded for the first chunk, then read from the cache
+    assert emf['EmissionFactorsCacheMisses'] == 1 and emf['EmissionFactorsCacheHits'] == 2
+    assert emf['FunctionName'] == 'local'
+
+
+def test_disabled_instrumentation_overhead_is_negligible(local_aws, calculator, monkeypatch, capsys):
+    monkeypatch.setattr(calculator, 'METRICS_ENABLED', False)
+    monkeypatch.setattr(calculator, 'EVENTS_CHUNK_SIZE', 100)
+    add_events_object(local_aws, OBJECT_KEY, _activity_events(1000))
+    # Count the instrumentation calls of an invocation
+    calls = []
+    timed, count = calculator._timed, calculator._count
+    monkeypatch.setattr(calculator, '_timed', lambda name: calls.append(name) or timed(name))
+    monkeypatch.setattr(calculator, '_count', lambda name, value=1: calls.append(name) or count(name, value))
+    started_at = time.perf_counter()
+    calculator.lambda_handler({}, None)
+    invocation_seconds = time.perf_counter() - started_at
+    assert _emf_lines(capsys.readouterr().out) == []
+
+    def disabled_timer():
+        with timed('ReadTime'):
+            pass
+    call_seconds = max(timeit.timeit(disabled_timer, number=10000), timeit.timeit(lambda: count('EventsProcessed'), number=10000)) / 10000
+    assert len(calls) * call_seconds < invocation_seconds / 1000
+
+
+def test_cprofile_profiler(local_aws, calculator, monkeypatch, caplog):
+    monkeypatch.setattr(calculator, 'CALCULATOR_PROFILER', 'cprofile')
+    add_events_object(local_aws, OBJECT_KEY, _activity_events(10))
+    with caplog.at_level(logging.INFO):
+        calculator.lambda_handler({}, None)
+    [profile] = [record.getMessage() for record in caplog.records if record.getMessage().startswith('Profile of the invocation')]
+    # The objects are processed in other threads, their profiles are merged
+    assert '_process_events_object' in profile and '_append_emissions_batch' in profile
+
+
+def test_tracemalloc_profiler(local_aws, calculator, monkeypatch, caplog):
+    monkeypatch.setattr(calculator, 'CALCULATOR_PROFILER', 'tracemalloc')
+    add_events_object(local_aws, OBJECT_KEY, _activity_events(10))
+    with caplog.at_level(logging.INFO):
+        calculator.lambda_handler({}, None)
+    assert any(record.getMessage().startswith('Peak traced memory') for record in caplog.records)
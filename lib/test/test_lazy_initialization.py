@@ -0,0 +1,59 @@
+import importlib
+import os
+import subprocess
+import sys
+import boto3
+import pytest
+from local_aws import QUEBEC_EVENT, activity_event, add_events_object
+
+
+def test_import_creates_no_client(monkeypatch):
+    created = []
+    monkeypatch.setattr(boto3, 'client', lambda *args, **kwargs: created.append(args))
+    monkeypatch.setattr(boto3, 'resource', lambda *args, **kwargs: created.append(args))
+    sys.modules.pop('full_calculator_lambda', None)
+    try:
+        importlib.import_module('full_calculator_lambda')
+    finally:
+        sys.modules.pop('full_calculator_lambda', None)
+    assert created == []
+
+
+def test_import_loads_no_optional_package():
+    # In a new interpreter, as in a new Lambda container: the packages can already be imported by other tests
+    lambda_path = os.path.join(os.path.dirname(__file__), '..', 'lambda')
+    script = "import sys; sys.path.insert(0, %r); import full_calculator_lambda; print(' '.join(sorted({'numpy', 'pyarrow', 'zstandard'} & set(sys.modules))))" % lambda_path
+    assert subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True).stdout.strip() == ""
+
+
+def test_numpy_is_imported_by_the_first_calculation(local_aws, calculator):
+    pytest.importorskip('numpy')
+    assert calculator.numpy is None
+    calculator.lambda_handler({}, None)
+    assert calculator.numpy is None
+    add_events_object(local_aws, "scope2-bill-extracted-data/lazy-1.json", [activity_event("lazy-1", QUEBEC_EVENT)])
+    calculator.lambda_handler({}, None)
+    assert calculator.numpy is not None
+
+
+def test_clients_are_created_once_on_first_use(local_aws, calculator, monkeypatch):
+    created = []
+    monkeypatch.setattr(boto3, 'client', lambda service_name: created.append(service_name) or local_aws.client(service_name))
+    calculator.lambda_handler({}, None)
+    add_events_object(local_aws, "scope2-bill-extracted-data/lazy-1.json", [activity_event("lazy-1", QUEBEC_EVENT)])
+    calculator.lambda_handler({}, None)
+    assert sorted(created) == ['dynamodb', 'redshift-data', 's3', 'secretsmanager']
+
+
+def test_secret_is_only_read_for_a_copy_and_cached(local_aws, calculator, monkeypatch):
+    calculator.lambda_handler({}, None)
+    assert local_aws.secretsmanager.requests_count == 0
+    add_events_object(local_aws, "scope2-bill-extracted-data/lazy-1.json", [activity_event("lazy-1", QUEBEC_EVENT)])
+    calculator.lambda_handler({}, None)
+    add_events_object(local_aws, "scope2-bill-extracted-data/lazy-2.json", [activity_event("lazy-2", QUEBEC_EVENT)])
+    calculator.lambda_handler({}, None)
+    assert local_aws.secretsmanager.requests_count == 1
+    monkeypatch.setattr(calculator, 'REDSHIFT_SECRET_CACHE_TTL_SECONDS', 0)
+    add_events_object(local_aws, "scope2-bill-extracted-data/lazy-3.json", [activity_event("lazy-3", QUEBEC_EVENT)])
+    calculator.lambda_handler({}, None)
+    assert local_aws.secretsmanager.requests_count == 2
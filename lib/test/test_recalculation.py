@@ -0,0 +1,130 @@
+import copy
+import importlib
+import json
+import sys
+from local_aws import (CALCULATOR_CHECKPOINT_TABLE_NAME, EMISSION_FACTORS_SNAPSHOT, EMISSION_FACTORS_TABLE_NAME, DIESEL_EVENT,
+                       QUEBEC_EVENT, activity_event, add_events_object, last_statement, read_manifest_rows, redshift_database, run_load)
+
+DIESEL = (DIESEL_EVENT['category'], DIESEL_EVENT['activity'])
+QUEBEC = (QUEBEC_EVENT['category'], QUEBEC_EVENT['activity'])
+DIESEL_KEY = "scope1-cleansed-data/diesel.json"
+QUEBEC_KEY = "scope2-bill-extracted-data/quebec.json"
+
+
+def _activity_events(key, template, raw_data=100, count=2):
+    return [activity_event("%s-%d" % (key, index), template, asset_id="asset-%d" % index, raw_data=raw_data) for index in range(count)]
+
+
+def _index(calculator, emission_factors):
+    return calculator._index_emission_factors(emission_factors)
+
+
+def test_changed_factor_pairs(calculator):
+    previous = calculator._read_emission_factors_snapshot(EMISSION_FACTORS_SNAPSHOT)
+    current = copy.deepcopy(previous)
+    factors = _index(calculator, current)
+    factors[DIESEL]['emissions_factor_standards']['ghg']['coefficients']['co2_factor'] = '10.3'
+    # Same coefficients, with another notation and update date
+    factors[QUEBEC]['emissions_factor_standards']['ghg']['coefficients']['co2_factor'] = str(float(factors[QUEBEC]['emissions_factor_standards']['ghg']['coefficients']['co2_factor']))
+    factors[QUEBEC]['emissions_factor_standards']['ghg']['last_updated'] = '2023-01-01'
+    removed = current.pop()
+    added = dict(copy.deepcopy(current[0]), activity="New activity")
+    current.append(added)
+    changed_pairs = calculator._changed_factor_pairs(_index(calculator, previous), _index(calculator, current))
+    assert changed_pairs == {DIESEL, (removed['category'], removed['activity']), (added['category'], added['activity'])}
+
+
+def test_version_is_recorded_on_rows_and_checkpoints(local_aws, calculator):
+    add_events_object(local_aws, DIESEL_KEY, _activity_events(DIESEL_KEY, DIESEL_EVENT))
+    result = calculator.lambda_handler({}, None)
+    rows = read_manifest_rows(local_aws, result['load']['manifest'])
+    assert {dict(zip(calculator.REDSHIFT_COLUMN_NAMES, row))['emissions_factor_version'] for row in rows} == {'2022-05-22'}
+    checkpoint = local_aws.dynamodb.Table(CALCULATOR_CHECKPOINT_TABLE_NAME).items[(DIESEL_KEY,)]
+    assert checkpoint['factor_pairs'] == {json.dumps(list(DIESEL))} and checkpoint['emission_factors_version'] == '2022-05-22'
+    assert result['load']['status'] == 'FINISHED'
+
+
+def test_only_stale_objects_are_recalculated(local_aws, calculator):
+    add_events_object(local_aws, DIESEL_KEY, _activity_events(DIESEL_KEY, DIESEL_EVENT))
+    add_events_object(local_aws, QUEBEC_KEY, _activity_events(QUEBEC_KEY, QUEBEC_EVENT))
+    calculator.lambda_handler({}, None)
+    assert calculator._mark_stale_objects({DIESEL, ("stationary-combustion", "Unused")}) == [DIESEL_KEY]
+    result = calculator.lambda_handler({}, None)
+    assert result['objects_count'] == 1 and result['events_count'] == 2
+    statement = last_statement(local_aws)
+    assert statement['Sqls'][0] == "CREATE TEMP TABLE calculated_emissions_staging (LIKE calculated_emissions);"
+    assert statement['Sqls'][-1] == "DELETE FROM calculated_emissions_rollup WHERE events_count = 0;"
+    assert {checkpoint['status'] for checkpoint in local_aws.dynamodb.Table(CALCULATOR_CHECKPOINT_TABLE_NAME).items.values()} == {'loaded'}
+    assert calculator.lambda_handler({}, None)['objects_count'] == 0
+
+
+def test_recalculation_replaces_rows_and_rollups(local_aws, calculator):
+    database = redshift_database(calculator)
+    add_events_object(local_aws, DIESEL_KEY, _activity_events(DIESEL_KEY, DIESEL_EVENT))
+    add_events_object(local_aws, "scope1-cleansed-data/other.json", _activity_events("scope1-cleansed-data/other.json", DIESEL_EVENT, count=1))
+    calculator.lambda_handler({}, None)
+    run_load(database, local_aws, last_statement(local_aws))
+    # The object changes: one event less, and other raw_data
+    add_events_object(local_aws, DIESEL_KEY, _activity_events(DIESEL_KEY, DIESEL_EVENT, raw_data=10, count=1))
+    calculator.lambda_handler({}, None)
+    run_load(database, local_aws, last_statement(local_aws))
+    rows = database.execute("SELECT activity_event_id, raw_data FROM calculated_emissions ORDER BY activity_event_id").fetchall()
+    # The event that is no longer in the object is kept: rows are only replaced by activity_event_id
+    assert rows == [("scope1-cleansed-data/diesel.json-0", 10), ("scope1-cleansed-data/diesel.json-1", 100), ("scope1-cleansed-data/other.json-0", 100)]
+    rollup = database.execute("SELECT asset_id, events_count, raw_data FROM calculated_emissions_rollup ORDER BY asset_id").fetchall()
+    assert rollup == [("asset-0", 2, 110.0), ("asset-1", 1, 100.0)]
+
+
+def test_missing_rollup_keys_are_replaced(local_aws, calculator):
+    # Rows without asset_id or timestamp have NULL keys in both tables, which the subtraction of their totals matches
+    database = redshift_database(calculator)
+    add_events_object(local_aws, QUEBEC_KEY, [activity_event("quebec-0", QUEBEC_EVENT), activity_event("quebec-1", QUEBEC_EVENT)])
+    calculator.lambda_handler({}, None)
+    run_load(database, local_aws, last_statement(local_aws))
+    add_events_object(local_aws, QUEBEC_KEY, [activity_event("quebec-0", QUEBEC_EVENT, raw_data=10), activity_event("quebec-1", QUEBEC_EVENT)])
+    calculator.lambda_handler({}, None)
+    run_load(database, local_aws, last_statement(local_aws))
+    assert database.execute("SELECT DISTINCT asset_id, origin_measurement_timestamp, source FROM calculated_emissions").fetchall() == [(None, None, None)]
+    rollup = database.execute("SELECT asset_id, month, events_count, raw_data FROM calculated_emissions_rollup").fetchall()
+    assert rollup == [(None, None, 2, 463.0)]
+
+
+def test_stale_objects_wait_for_their_emission_factors(local_aws, calculator):
+    add_events_object(local_aws, QUEBEC_KEY, _activity_events(QUEBEC_KEY, QUEBEC_EVENT))
+    calculator.lambda_handler({}, None)
+    calculator._mark_stale_objects({QUEBEC}, '2023-01-01')
+    # The warm container reloads its cached emission factors, which are still older in the table
+    result = calculator.lambda_handler({}, None)
+    assert result['objects_count'] == 0
+    checkpoint = local_aws.dynamodb.Table(CALCULATOR_CHECKPOINT_TABLE_NAME).items[(QUEBEC_KEY,)]
+    assert checkpoint['status'] == 'stale' and checkpoint['stale_emission_factors_version'] == '2023-01-01'
+    ghg = local_aws.dynamodb.Table(EMISSION_FACTORS_TABLE_NAME).items[QUEBEC]['emissions_factor_standards']['ghg']
+    ghg['coefficients']['co2_factor'] = '0.002'
+    ghg['last_updated'] = '2023-01-01'
+    result = calculator.lambda_handler({}, None)
+    assert result['objects_count'] == 1
+    rows = [dict(zip(calculator.REDSHIFT_COLUMN_NAMES, row)) for row in read_manifest_rows(local_aws, result['load']['manifest'])]
+    assert {row['emissions_factor_version'] for row in rows} == {'2023-01-01'}
+    checkpoint = local_aws.dynamodb.Table(CALCULATOR_CHECKPOINT_TABLE_NAME).items[(QUEBEC_KEY,)]
+    assert checkpoint['status'] == 'loaded' and checkpoint['emission_factors_version'] == '2023-01-01'
+    assert 'stale_emission_factors_version' not in checkpoint
+
+
+def test_recalculate_command(local_aws, calculator, tmp_path):
+    sys.modules.pop('recalculate', None)
+    recalculate = importlib.import_module('recalculate')
+    add_events_object(local_aws, DIESEL_KEY, _activity_events(DIESEL_KEY, DIESEL_EVENT))
+    add_events_object(local_aws, QUEBEC_KEY, _activity_events(QUEBEC_KEY, QUEBEC_EVENT))
+    calculator.lambda_handler({}, None)
+    emission_factors = calculator._read_emission_factors_snapshot(EMISSION_FACTORS_SNAPSHOT)
+    _index(calculator, emission_factors)[QUEBEC]['emissions_factor_standards']['ghg']['coefficients']['co2_factor'] = '0.002'
+    snapshot = tmp_path / "emissions_factor_model_2023-01-01.json"
+    snapshot.write_text(json.dumps(emission_factors))
+    assert recalculate.main([EMISSION_FACTORS_SNAPSHOT, str(snapshot), '--dry-run']) == 0
+    assert {checkpoint['status'] for checkpoint in local_aws.dynamodb.Table(CALCULATOR_CHECKPOINT_TABLE_NAME).items.values()} == {'loaded'}
+    assert recalculate.main([EMISSION_FACTORS_SNAPSHOT, str(snapshot)]) == 0
+    checkpoints = local_aws.dynamodb.Table(CALCULATOR_CHECKPOINT_TABLE_NAME).items
+    assert checkpoints[(QUEBEC_KEY,)]['status'] == 'stale'
+    assert checkpoints[(QUEBEC_KEY,)]['stale_emission_factors_version'] == '2022-05-22'
+    assert checkpoints[(DIESEL_KEY,)]['status'] == 'loaded'
+    sys.modules.pop('recalculate', None)
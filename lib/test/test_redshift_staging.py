@@ -0,0 +1,88 @@
+import csv
+import io
+import os
+import re
+import pytest
+from local_aws import OUTPUT_BUCKET_NAME, QUEBEC_EVENT, activity_event, add_events_object, enrich, read_manifest, read_output_object
+
+STACK_DEFINITION = os.path.join(os.path.dirname(__file__), '..', 'carbon-calculator-lambda-stack.ts')
+
+
+def _enriched_event(calculator, activity_event_id, **fields):
+    fields = activity_event(activity_event_id, **dict({"asset_id": "vehicle-1234", "geo": "[30.14392,-97.59394]", "source": "company_fleet_management_database", "raw_data": 103.45}, **fields))
+    return enrich(calculator, [fields])[0]
+
+
+def _table_columns(table_name):
+    with open(STACK_DEFINITION) as stack_definition:
+        table_definition = re.search(r'tableName: "' + table_name + r'",\s*tableColumns: \[(.*?)\]', stack_definition.read(), re.S).group(1)
+    return re.findall(r'\{ name: "(\w+)", dataType: "([^"]+)"\}', table_definition)
+
+
+def test_columns_match_redshift_table(calculator):
+    assert calculator.REDSHIFT_COLUMNS == _table_columns("calculated_emissions")
+
+
+def test_rollup_columns_match_redshift_table(calculator):
+    assert calculator.ROLLUP_COLUMNS == _table_columns("calculated_emissions_rollup")
+
+
+def test_csv_fields_are_escaped(calculator):
+    activity_events = [
+        _enriched_event(calculator, activity_event_id="staging-1", source='fleet, "north"\nregion', asset_id="vehicle,1"),
+        _enriched_event(calculator, activity_event_id="staging-2", asset_id=None, geo=None, origin_measurement_timestamp=None),
+    ]
+    csv_body = io.StringIO()
+    calculator._write_events_csv(csv_body, activity_events)
+    rows = list(csv.reader(io.StringIO(csv_body.getvalue())))
+    assert len(rows) == 2
+    assert all(len(row) == len(calculator.REDSHIFT_COLUMNS) for row in rows)
+    first_row = dict(zip(calculator.REDSHIFT_COLUMN_NAMES, rows[0]))
+    assert first_row['source'] == 'fleet, "north"\nregion'
+    assert first_row['asset_id'] == 'vehicle,1'
+    assert first_row['geo_lat'] == '30.14392'
+    assert first_row['geo_lon'] == '-97.59394'
+    assert float(first_row['co2_amount']) == 1.0562245000000001
+    second_row = dict(zip(calculator.REDSHIFT_COLUMN_NAMES, rows[1]))
+    assert second_row['asset_id'] == second_row['geo_lat'] == second_row['origin_measurement_timestamp'] == ''
+
+
+def _add_events_objects(local_aws):
+    add_events_object(local_aws, "scope1-cleansed-data/load-1.json", [activity_event("load-1", raw_data=103.45)])
+    add_events_object(local_aws, "scope1-cleansed-data/load-empty.json", [])
+    add_events_object(local_aws, "scope2-bill-extracted-data/load-2.json", [activity_event("load-2", QUEBEC_EVENT)])
+
+
+def test_one_copy_per_invocation(local_aws, calculator, monkeypatch):
+    monkeypatch.setattr(calculator.time, 'sleep', lambda seconds: None)
+    local_aws.redshift.statuses = ['SUBMITTED', 'STARTED', 'FINISHED']
+    _add_events_objects(local_aws)
+    result = calculator.lambda_handler({}, None)
+    [(statement_id, statement)] = local_aws.redshift.statements.items()
+    assert result == {'objects_count': 3, 'events_count': 2, 'rejected_count': 0, 'errors': [], 'load': {'statement_id': statement_id, 'status': 'FINISHED', 'manifest': result['load']['manifest'], 'rollup_rows': 2}}
+    manifest_key = result['load']['manifest'][len("s3://" + OUTPUT_BUCKET_NAME + "/"):]
+    assert statement['Sqls'][0] == "COPY calculated_emissions FROM 's3://" + OUTPUT_BUCKET_NAME + "/" + manifest_key + "' IAM_ROLE 'arn:aws:iam::000000000000:role/local-redshift-role' CSV EMPTYASNULL TIMEFORMAT AS 'YYYY-MM-DD HH:MI:SS' MANIFEST;"
+    manifest = read_manifest(local_aws, result['load']['manifest'])
+    assert [entry['url'] for entry in manifest['entries']] == ["s3://" + OUTPUT_BUCKET_NAME + "/scope1-cleansed-data/load-1.json.csv", "s3://" + OUTPUT_BUCKET_NAME + "/scope2-bill-extracted-data/load-2.json.csv"]
+    for entry in manifest['entries']:
+        assert entry['mandatory'] is True
+        assert entry['meta']['content_length'] == len(read_output_object(local_aws, entry['url']))
+
+
+def test_copy_still_running_is_reported_as_pending(local_aws, calculator, monkeypatch):
+    monkeypatch.setattr(calculator, 'REDSHIFT_STATEMENT_TIMEOUT_SECONDS', 0)
+    local_aws.redshift.statuses = ['STARTED']
+    _add_events_objects(local_aws)
+    assert calculator.lambda_handler({}, None)['load']['status'] == 'STARTED'
+
+
+def test_failed_copy_is_raised(local_aws, calculator):
+    local_aws.redshift.statuses = ['FAILED']
+    _add_events_objects(local_aws)
+    with pytest.raises(RuntimeError, match='Load into table calculated_emissions failed'):
+        calculator.lambda_handler({}, None)
+
+
+def test_no_copy_without_events(local_aws, calculator):
+    assert calculator.lambda_handler({}, None) == {'objects_count': 0, 'events_count': 0, 'rejected_count': 0, 'errors': [], 'load': None}
+    assert local_aws.redshift.statements == {}
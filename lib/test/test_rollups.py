@@ -0,0 +1,97 @@
+import importlib
+import math
+import sys
+from local_aws import CALCULATOR_OUTPUT_TABLE_NAME, activity_event, add_events_object, last_statement, read_csv_rows, redshift_database, run_load
+
+
+def _loaded_rollup(local_aws):
+    [statement] = local_aws.redshift.statements.values()
+    return statement['Sqls'], read_csv_rows(local_aws, statement['Sqls'][2].split("'")[1])
+
+
+def test_rollup_totals_are_merged_across_objects(local_aws, calculator):
+    add_events_object(local_aws, "scope1-cleansed-data/rollup-1.json", [
+        activity_event("rollup-1"),
+        activity_event("rollup-2", raw_data=50, origin_measurement_timestamp="2022-06-01 00:00:00"),
+        activity_event("rollup-3", origin_measurement_timestamp="2022-07-01 00:00:00"),
+    ])
+    add_events_object(local_aws, "scope1-cleansed-data/rollup-2.json", [
+        activity_event("rollup-4", raw_data=25),
+        activity_event("rollup-5", asset_id=None, origin_measurement_timestamp=None),
+    ])
+    result = calculator.lambda_handler({}, None)
+    assert result['load']['rollup_rows'] == 3
+    sqls, rows = _loaded_rollup(local_aws)
+    assert sqls[0].startswith("COPY calculated_emissions FROM")
+    assert sqls[1] == "CREATE TEMP TABLE calculated_emissions_rollup_staging (LIKE calculated_emissions_rollup);"
+    totals = {tuple(row[:5]): row[5:] for row in rows}
+    assert set(totals) == {
+        ("1", "mobile-combustion", "Diesel Fuel - Diesel Passenger Cars", "vehicle-1", "2022-06-01"),
+        ("1", "mobile-combustion", "Diesel Fuel - Diesel Passenger Cars", "vehicle-1", "2022-07-01"),
+        ("1", "mobile-combustion", "Diesel Fuel - Diesel Passenger Cars", "", ""),
+    }
+    june = totals[("1", "mobile-combustion", "Diesel Fuel - Diesel Passenger Cars", "vehicle-1", "2022-06-01")]
+    assert june[:2] == ["3", "175.0"]
+    items = local_aws.dynamodb.Table(CALCULATOR_OUTPUT_TABLE_NAME).items
+    expected_co2e = sum(items[(activity_event_id,)]['emissions_output']['calculated_emissions']['co2e']['amount'] for activity_event_id in ["rollup-1", "rollup-2", "rollup-4"])
+    assert math.isclose(float(june[5]), expected_co2e, rel_tol=1e-12)
+
+
+def test_failed_objects_are_not_rolled_up(local_aws, calculator):
+    add_events_object(local_aws, "scope1-cleansed-data/rollup-1.json", [activity_event("rollup-1")])
+    add_events_object(local_aws, "scope1-cleansed-data/rollup-2.json", [activity_event("rollup-2")])
+    local_aws.s3.failing_keys.add("scope1-cleansed-data/rollup-2.json")
+    result = calculator.lambda_handler({}, None)
+    assert len(result['errors']) == 1
+    _, rows = _loaded_rollup(local_aws)
+    assert [row[5] for row in rows] == ["1"]
+
+
+def test_merge_is_additive(local_aws, calculator):
+    # Runs the load twice on SQLite: the second merge updates the rows inserted by the first one
+    add_events_object(local_aws, "scope1-cleansed-data/rollup-1.json", [activity_event("rollup-1"), activity_event("rollup-2", asset_id=None, origin_measurement_timestamp=None)])
+    calculator.lambda_handler({}, None)
+    [statement] = local_aws.redshift.statements.values()
+    database = redshift_database(calculator)
+    for _ in range(2):
+        run_load(database, local_aws, statement)
+    merged = database.execute("SELECT asset_id, month, events_count, raw_data FROM calculated_emissions_rollup ORDER BY asset_id").fetchall()
+    assert merged == [(None, None, 2, 200.0), ("vehicle-1", "2022-06-01", 2, 200.0)]
+
+
+def test_rollup_is_rebuilt_from_the_history(local_aws, calculator, capsys):
+    sys.modules.pop('rebuild_rollup', None)
+    rebuild_rollup = importlib.import_module('rebuild_rollup')
+    add_events_object(local_aws, "scope1-cleansed-data/rollup-1.json", [
+        activity_event("rollup-1"),
+        activity_event("rollup-2", raw_data=50, origin_measurement_timestamp="2022-07-01 00:00:00"),
+        activity_event("rollup-3", asset_id=None, origin_measurement_timestamp=None),
+        activity_event("rollup-4", asset_id=None),
+    ])
+    calculator.lambda_handler({}, None)
+    statement = last_statement(local_aws)
+    database = redshift_database(calculator)
+    run_load(database, local_aws, statement)
+    # The history: the same rows, loaded without EMPTYASNULL and before the rollup table
+    history = redshift_database(calculator)
+    run_load(history, local_aws, {'Sqls': [statement['Sqls'][0].replace(" EMPTYASNULL", "")]})
+    assert history.execute("SELECT COUNT(*) FROM calculated_emissions WHERE asset_id = ''").fetchone() == (2,)
+    capsys.readouterr()
+    assert rebuild_rollup.main(['--dry-run']) == 0
+    assert capsys.readouterr().out.splitlines() == calculator._rebuild_rollup_sqls()
+    for _ in range(2):
+        assert rebuild_rollup.main([]) == 0
+        run_load(history, local_aws, last_statement(local_aws))
+    query = "SELECT * FROM calculated_emissions ORDER BY activity_event_id"
+    assert history.execute(query).fetchall() == database.execute(query).fetchall()
+    query = "SELECT * FROM calculated_emissions_rollup ORDER BY asset_id, month"
+    rebuilt, loaded = history.execute(query).fetchall(), database.execute(query).fetchall()
+    assert [row[:6] for row in rebuilt] == [row[:6] for row in loaded] == [
+        (1, "mobile-combustion", "Diesel Fuel - Diesel Passenger Cars", None, None, 1),
+        (1, "mobile-combustion", "Diesel Fuel - Diesel Passenger Cars", None, "2022-06-01", 1),
+        (1, "mobile-combustion", "Diesel Fuel - Diesel Passenger Cars", "vehicle-1", "2022-06-01", 1),
+        (1, "mobile-combustion", "Diesel Fuel - Diesel Passenger Cars", "vehicle-1", "2022-07-01", 1),
+    ]
+    for rebuilt_row, loaded_row in zip(rebuilt, loaded):
+        assert all(math.isclose(rebuilt_total, loaded_total, rel_tol=1e-12) for rebuilt_total, loaded_total in zip(rebuilt_row[6:], loaded_row[6:]))
+    sys.modules.pop('rebuild_rollup', None)
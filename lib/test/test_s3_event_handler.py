@@ -0,0 +1,77 @@
+import json
+import pytest
+from urllib.parse import quote_plus
+from local_aws import INPUT_BUCKET_NAME, CALCULATOR_OUTPUT_TABLE_NAME, QUEBEC_EVENT, activity_event, add_events_object
+
+
+def _s3_record(local_aws, key, bucket=INPUT_BUCKET_NAME):
+    return {
+        "eventVersion": "2.1",
+        "eventSource": "aws:s3",
+        "eventName": "ObjectCreated:Put",
+        "s3": {
+            "bucket": {"name": bucket},
+            "object": {"key": quote_plus(key, safe='/'), "eTag": local_aws.s3.etag(INPUT_BUCKET_NAME, key).strip('"')}
+        }
+    }
+
+
+def _sqs_record(message_id, s3_notification):
+    return {"messageId": message_id, "eventSource": "aws:sqs", "body": json.dumps(s3_notification)}
+
+
+def test_s3_notification(local_aws, calculator):
+    add_events_object(local_aws, "scope2-bill-extracted-data/event 1,a.json", [activity_event("event 1,a", QUEBEC_EVENT)])
+    add_events_object(local_aws, "scope2-bill-extracted-data/not-notified.json", [activity_event("not-notified", QUEBEC_EVENT)])
+    result = calculator.s3_event_handler({"Records": [_s3_record(local_aws, "scope2-bill-extracted-data/event 1,a.json")]}, None)
+    assert result['objects_count'] == 1 and result['batchItemFailures'] == []
+    assert list(local_aws.dynamodb.Table(CALCULATOR_OUTPUT_TABLE_NAME).items) == [("event 1,a",)]
+
+
+def test_failed_s3_notification_is_raised(local_aws, calculator):
+    add_events_object(local_aws, "scope2-bill-extracted-data/event-1.json", [activity_event("event-1", QUEBEC_EVENT)])
+    local_aws.s3.failing_keys.add("scope2-bill-extracted-data/event-1.json")
+    with pytest.raises(RuntimeError):
+        calculator.s3_event_handler({"Records": [_s3_record(local_aws, "scope2-bill-extracted-data/event-1.json")]}, None)
+
+
+def test_sqs_batch_reports_failed_messages(local_aws, calculator):
+    add_events_object(local_aws, "scope2-bill-extracted-data/event-1.json", [activity_event("event-1", QUEBEC_EVENT)])
+    add_events_object(local_aws, "scope2-bill-extracted-data/event-2.json", [activity_event("event-2", QUEBEC_EVENT)])
+    local_aws.s3.failing_keys.add("scope2-bill-extracted-data/event-2.json")
+    add_events_object(local_aws, "scope1-cleansed-data/event-3.json", [activity_event("event-3", QUEBEC_EVENT)])
+    add_events_object(local_aws, "other-prefix/event-4.json", [activity_event("event-4", QUEBEC_EVENT)])
+    event = {"Records": [
+        _sqs_record("message-1", {"Records": [_s3_record(local_aws, "scope2-bill-extracted-data/event-1.json")]}),
+        _sqs_record("message-2", {"Records": [_s3_record(local_aws, "scope2-bill-extracted-data/event-2.json"), _s3_record(local_aws, "scope1-cleansed-data/event-3.json")]}),
+        _sqs_record("message-3", {"Service": "Amazon S3", "Event": "s3:TestEvent", "Bucket": INPUT_BUCKET_NAME}),
+        _sqs_record("message-4", {"Records": [_s3_record(local_aws, "other-prefix/event-4.json"), _s3_record(local_aws, "scope1-cleansed-data/event-3.json", bucket="other-bucket")]}),
+    ]}
+    result = calculator.s3_event_handler(event, None)
+    assert result['batchItemFailures'] == [{"itemIdentifier": "message-2"}]
+    assert result['objects_count'] == 2
+    assert result['load']['status'] == 'FINISHED'
+    assert len(local_aws.redshift.statements) == 1
+
+
+def test_malformed_messages_only_fail_themselves(local_aws, calculator):
+    add_events_object(local_aws, "scope2-bill-extracted-data/event-1.json", [activity_event("event-1", QUEBEC_EVENT)])
+    no_object = _s3_record(local_aws, "scope2-bill-extracted-data/event-1.json")
+    del no_object['s3']['object']
+    event = {"Records": [
+        _sqs_record("message-1", {"Records": [_s3_record(local_aws, "scope2-bill-extracted-data/event-1.json")]}),
+        {"messageId": "message-2", "eventSource": "aws:sqs", "body": "not json"},
+        _sqs_record("message-3", {"Records": [no_object]}),
+    ]}
+    result = calculator.s3_event_handler(event, None)
+    assert result['batchItemFailures'] == [{"itemIdentifier": "message-2"}, {"itemIdentifier": "message-3"}]
+    assert result['objects_count'] == 1 and result['load']['status'] == 'FINISHED'
+
+
+def test_notifications_of_processed_objects_are_skipped(local_aws, calculator):
+    add_events_object(local_aws, "scope2-bill-extracted-data/event-1.json", [activity_event("event-1", QUEBEC_EVENT)])
+    event = {"Records": [_sqs_record("message-1", {"Records": [_s3_record(local_aws, "scope2-bill-extracted-data/event-1.json")]})]}
+    assert calculator.s3_event_handler(event, None)['objects_count'] == 1
+    # Duplicated delivery, and the sweep afterwards
+    assert calculator.s3_event_handler(event, None)['objects_count'] == 0
+    assert calculator.lambda_handler({}, None)['objects_count'] == 0
@@ -0,0 +1,73 @@
+import csv
+import datetime
+import gzip
+import io
+from decimal import Decimal
+import pytest
+from local_aws import OUTPUT_BUCKET_NAME, add_events_object
+
+ACTIVITY_EVENTS = [
+    {"activity_event_id": "format-1", "asset_id": "vehicle,1234", "geo": "[30.14392,-97.59394]", "origin_measurement_timestamp": "2022-06-26 02:31:29", "scope": 1, "category": "mobile-combustion", "activity": "Diesel Fuel - Diesel Passenger Cars", "source": "company_fleet_management_database", "raw_data": 103.45, "units": "gal"},
+    {"activity_event_id": "format-2", "supplier": "eversource", "scope": 2, "category": "grid-region-location-based", "activity": "Quebec", "raw_data": 453, "units": "kwH"},
+]
+
+
+def _read_csv(body):
+    return list(csv.reader(io.StringIO(body.decode('utf-8'))))
+
+
+def _read_parquet(body):
+    import pyarrow.parquet
+    table = pyarrow.parquet.read_table(io.BytesIO(body))
+    return table.schema, table.to_pylist()
+
+
+@pytest.mark.parametrize('staging_format,extension,copy_options,read', [
+    ('csv', '.csv', "CSV EMPTYASNULL TIMEFORMAT AS 'YYYY-MM-DD HH:MI:SS'", _read_csv),
+    ('csv.gz', '.csv.gz', "CSV GZIP EMPTYASNULL TIMEFORMAT AS 'YYYY-MM-DD HH:MI:SS'", lambda body: _read_csv(gzip.decompress(body))),
+    ('csv.zst', '.csv.zst', "CSV ZSTD EMPTYASNULL TIMEFORMAT AS 'YYYY-MM-DD HH:MI:SS'", lambda body: _read_csv(pytest.importorskip('zstandard').ZstdDecompressor().decompressobj().decompress(body))),
+])
+def test_csv_staging_round_trip(local_aws, calculator, monkeypatch, staging_format, extension, copy_options, read):
+    if staging_format == 'csv.zst':
+        pytest.importorskip('zstandard')
+    monkeypatch.setattr(calculator, 'REDSHIFT_STAGING_FORMAT', staging_format)
+    add_events_object(local_aws, "scope1-cleansed-data/formats.json", ACTIVITY_EVENTS)
+    calculator.lambda_handler({}, None)
+    rows = read(local_aws.s3.read_object(OUTPUT_BUCKET_NAME, "scope1-cleansed-data/formats.json" + extension))
+    assert [row[0] for row in rows] == ["format-1", "format-2"]
+    assert all(len(row) == len(calculator.REDSHIFT_COLUMNS) for row in rows)
+    assert rows[0][1] == "vehicle,1234"
+    assert float(rows[1][calculator.REDSHIFT_COLUMN_NAMES.index('co2_amount')]) == 0.0005436
+    [statement] = local_aws.redshift.statements.values()
+    assert statement['Sqls'][0].endswith(".manifest' IAM_ROLE 'arn:aws:iam::000000000000:role/local-redshift-role' " + copy_options + " MANIFEST;")
+
+
+def test_parquet_staging_round_trip(local_aws, calculator, monkeypatch):
+    pytest.importorskip('pyarrow')
+    monkeypatch.setattr(calculator, 'REDSHIFT_STAGING_FORMAT', 'parquet')
+    add_events_object(local_aws, "scope1-cleansed-data/formats.json", ACTIVITY_EVENTS)
+    calculator.lambda_handler({}, None)
+    schema, rows = _read_parquet(local_aws.s3.read_object(OUTPUT_BUCKET_NAME, "scope1-cleansed-data/formats.json.parquet"))
+    assert [(field.name, str(field.type)) for field in schema] == [(name, {
+        'text': 'string',
+        'integer': 'int32',
+        'timestamptz': 'timestamp[us, tz=UTC]',
+        'decimal(10,6)': 'decimal128(10, 6)',
+        'decimal(32,16)': 'decimal128(32, 16)',
+    }[data_type]) for name, data_type in calculator.REDSHIFT_COLUMNS]
+    assert rows[0]['asset_id'] == "vehicle,1234"
+    assert rows[0]['geo_lat'] == Decimal("30.143920")
+    assert rows[0]['origin_measurement_timestamp'] == datetime.datetime(2022, 6, 26, 2, 31, 29, tzinfo=datetime.timezone.utc)
+    assert rows[0]['scope'] == 1
+    assert rows[0]['co2_amount'] == Decimal("1.0562245000000001")
+    assert rows[1]['asset_id'] is None and rows[1]['geo_lat'] is None and rows[1]['origin_measurement_timestamp'] is None
+    assert rows[1]['raw_data'] == Decimal("453.0000000000000000")
+    [statement] = local_aws.redshift.statements.values()
+    assert statement['Sqls'][0].endswith(".manifest' IAM_ROLE 'arn:aws:iam::000000000000:role/local-redshift-role' FORMAT AS PARQUET MANIFEST;")
+
+
+def test_unknown_staging_format(local_aws, calculator, monkeypatch):
+    monkeypatch.setattr(calculator, 'REDSHIFT_STAGING_FORMAT', 'avro')
+    add_events_object(local_aws, "scope1-cleansed-data/formats.json", ACTIVITY_EVENTS[:1])
+    with pytest.raises(ValueError):
+        calculator.lambda_handler({}, None)
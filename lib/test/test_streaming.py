@@ -0,0 +1,69 @@
+import json
+import os
+import tracemalloc
+from local_aws import INPUT_BUCKET_NAME, OUTPUT_BUCKET_NAME, CALCULATOR_OUTPUT_TABLE_NAME
+
+# Set STREAMING_TEST_EVENTS=10000000 to stream a ~3 GB synthetic object
+LARGE_EVENTS_COUNT = int(os.environ.get('STREAMING_TEST_EVENTS', '10000'))
+SMALL_EVENTS_COUNT = LARGE_EVENTS_COUNT // 4
+
+
+def _synthetic_lines(events_count):
+    for index in range(events_count):
+        activity_event = {
+            "activity_event_id": "synthetic-%d" % index,
+            "asset_id": "vehicle-%d" % (index % 500),
+            "geo": "[30.14392,-97.59394]",
+            "origin_measurement_timestamp": "2022-06-26 02:31:29",
+            "scope": 1,
+            "category": "mobile-combustion",
+            "activity": "Diesel Fuel - Diesel Passenger Cars",
+            "source": "company_fleet_management_database",
+            "raw_data": 103.45 + index % 100,
+            "units": "gal"
+        }
+        yield (json.dumps(activity_event) + "\n").encode('utf-8')
+
+
+def _process_synthetic_object(local_aws, calculator, events_count):
+    key = "scope1-cleansed-data/synthetic-%d.json" % events_count
+    local_aws.s3.add_generated_object(INPUT_BUCKET_NAME, key, lambda: _synthetic_lines(events_count))
+    output_table = local_aws.dynamodb.Table(CALCULATOR_OUTPUT_TABLE_NAME)
+    items_written = output_table.items_written
+    tracemalloc.start()
+    try:
+        calculator.lambda_handler({}, None)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        local_aws.s3.delete_object(Bucket=INPUT_BUCKET_NAME, Key=key)
+    assert output_table.items_written - items_written == events_count
+    return peak
+
+
+def test_memory_does_not_depend_on_object_size(local_aws, calculator, monkeypatch):
+    # Small chunks and parts (the local S3 does not enforce the 5 MiB minimum) keep the test fast
+    monkeypatch.setattr(calculator, 'EVENTS_CHUNK_SIZE', 500)
+    monkeypatch.setattr(calculator, 'STAGING_PART_SIZE', 128 * 1024)
+    local_aws.retain_writes = False
+    small_peak = _process_synthetic_object(local_aws, calculator, SMALL_EVENTS_COUNT)
+    bytes_written = local_aws.s3.bytes_written
+    large_peak = _process_synthetic_object(local_aws, calculator, LARGE_EVENTS_COUNT)
+    # The large object is staged with several multipart parts
+    assert local_aws.s3.bytes_written - bytes_written > 2 * calculator.STAGING_PART_SIZE
+    # Peak memory is bound by the chunk and part sizes, not by the number of events
+    assert large_peak < small_peak * 1.5
+
+
+def test_staged_csv_matches_input_lines(local_aws, calculator):
+    key = "scope1-cleansed-data/synthetic-lines.json"
+    body = b"".join(_synthetic_lines(2500))
+    local_aws.s3.add_object(INPUT_BUCKET_NAME, key, body)
+    calculator.lambda_handler({}, None)
+    csv_body = local_aws.s3.read_object(OUTPUT_BUCKET_NAME, key + ".csv").decode('utf-8')
+    rows = csv_body.splitlines()
+    assert len(rows) == 2500
+    assert rows[0].startswith("synthetic-0,vehicle-0,30.14392,-97.59394,2022-06-26 02:31:29,1,")
+    assert rows[-1].startswith("synthetic-2499,")
+    [statement] = local_aws.redshift.statements.values()
+    assert statement['Sqls'][0].startswith("COPY calculated_emissions FROM 's3://" + OUTPUT_BUCKET_NAME + "/manifests/")